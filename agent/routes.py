@@ -1,5 +1,6 @@
 import os
 import json
+import asyncio
 import logging
 import time
 from datetime import datetime
@@ -20,6 +21,10 @@ from agent.tg_store import (
     notify_session_complete,
     check_agent_bot_status,
 )
+from services.upstream import upstream_client
+from services.sse import aiter_sse
+from services.reasoning import ThinkTagSplitter
+from services.disconnect import cancel_on_disconnect, disconnect_stats
 
 try:
     from services.providers import NVIDIA_API_KEY, NVIDIA_BASE_URL
@@ -110,8 +115,8 @@ async def agent_stream(req: Request, body: StreamRequest):
     async def stream_generator():
         total_chars = 0
         t_first = None
-        async with httpx.AsyncClient(
-            timeout=httpx.Timeout(connect=30.0, read=120.0, write=30.0, pool=10.0)
+        async with upstream_client(
+            "nvidia", timeout=httpx.Timeout(connect=30.0, read=120.0, write=30.0, pool=10.0)
         ) as client:
             try:
                 async with client.stream(
@@ -124,37 +129,50 @@ async def agent_stream(req: Request, body: StreamRequest):
                         yield f"data: {json.dumps({'type': 'error', 'content': f'API {resp.status_code}: {err.decode()[:100]}'})}\n\n"
                         return
 
-                    async for line in resp.aiter_lines():
-                        if not line or not line.startswith("data: "):
-                            continue
-                        raw = line[6:]
-                        if raw == "[DONE]":
-                            elapsed = time.time() - t_start
-                            ttft = (t_first - t_start) if t_first else None
-                            logger.info(f"[stream] ✅ done | model={body.model} phase={body.phase} chars={total_chars} total={elapsed:.2f}s ttft={f'{ttft:.2f}s' if ttft else 'n/a'}")
-                            yield "data: [DONE]\n\n"
+                    splitter = ThinkTagSplitter()
+                    done = False
+                    async for ev in aiter_sse(resp.aiter_bytes()):
+                        if ev.done:
+                            done = True
                             break
-                        try:
-                            data    = json.loads(raw)
-                            choices = data.get("choices", [])
-                            if not choices: continue
-                            delta   = choices[0].get("delta", {})
-
-                            reasoning = delta.get("reasoning_content") or \
-                                        (delta.get("model_extra") or {}).get("reasoning_content")
-                            if reasoning:
-                                yield f"data: {json.dumps({'type': 'thinking', 'content': reasoning})}\n\n"
-
-                            content = delta.get("content", "")
-                            if content:
-                                if t_first is None:
-                                    t_first = time.time()
-                                    logger.info(f"[stream] first token | model={body.model} phase={body.phase} ttft={t_first - t_start:.2f}s")
-                                total_chars += len(content)
-                                yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-                        except json.JSONDecodeError:
+                        data = ev.json()
+                        if not isinstance(data, dict):
                             continue
-
+                        choices = data.get("choices", [])
+                        if not choices: continue
+                        delta   = choices[0].get("delta", {})
+
+                        reasoning = delta.get("reasoning_content") or \
+                                    (delta.get("model_extra") or {}).get("reasoning_content")
+                        if reasoning:
+                            yield f"data: {json.dumps({'type': 'thinking', 'content': reasoning})}\n\n"
+
+                        content = delta.get("content", "")
+                        if content:
+                            if t_first is None:
+                                t_first = time.time()
+                                logger.info(f"[stream] first token | model={body.model} phase={body.phase} ttft={t_first - t_start:.2f}s")
+                            total_chars += len(content)
+                            # <think> داخل content (قد ينقسم الوسم بين chunks) → thinking
+                            for is_reasoning, text in splitter.feed(content):
+                                kind = "thinking" if is_reasoning else "content"
+                                yield f"data: {json.dumps({'type': kind, 'content': text})}\n\n"
+                    # ما احتُجز كبداية وسم محتملة — يُرسل سواء انتهى البث بـ [DONE] أم لا
+                    for is_reasoning, text in splitter.flush():
+                        kind = "thinking" if is_reasoning else "content"
+                        yield f"data: {json.dumps({'type': kind, 'content': text})}\n\n"
+                    if done:
+                        elapsed = time.time() - t_start
+                        ttft = (t_first - t_start) if t_first else None
+                        logger.info(f"[stream] ✅ done | model={body.model} phase={body.phase} chars={total_chars} total={elapsed:.2f}s ttft={f'{ttft:.2f}s' if ttft else 'n/a'}")
+                        yield "data: [DONE]\n\n"
+
+            except (asyncio.CancelledError, GeneratorExit):
+                # المتصفح أغلق الاتصال — الخروج من client.stream يقطع طلب NVIDIA فوراً
+                generated = total_chars // 4
+                disconnect_stats.record("agent", generated, payload["max_tokens"] - generated)
+                logger.info(f"[stream] client disconnected | model={body.model} phase={body.phase} chars={total_chars}")
+                raise
             except httpx.TimeoutException:
                 logger.warning(f"[stream] timeout | model={body.model} phase={body.phase} elapsed={time.time()-t_start:.1f}s")
                 yield f"data: {json.dumps({'type': 'error', 'content': 'Connection timeout'})}\n\n"
@@ -163,7 +181,7 @@ async def agent_stream(req: Request, body: StreamRequest):
                 yield f"data: {json.dumps({'type': 'error', 'content': str(e)[:200]})}\n\n"
 
     return StreamingResponse(
-        stream_generator(),
+        cancel_on_disconnect(req, stream_generator()),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
@@ -17,6 +17,8 @@ import httpx
 from fastapi import APIRouter, Request
 from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 
+from services.upstream import upstream_client
+
 logger = logging.getLogger(__name__)
 
 def _get_conn():
@@ -1473,7 +1475,7 @@ Start directly with the # H1 title."""
 
     content = ""
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
+        async with upstream_client("nvidia", timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
             async with client.stream(
                 "POST",
                 "https://integrate.api.nvidia.com/v1/chat/completions",
@@ -1671,7 +1673,7 @@ Start with # Title on the very first line. Nothing before it."""
     t0        = datetime.utcnow()
 
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
+        async with upstream_client("nvidia", timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
             async with client.stream(
                 "POST",
                 "https://integrate.api.nvidia.com/v1/chat/completions",
@@ -1782,7 +1784,7 @@ OUTPUT: Complete Arabic markdown article only."""
 
     content = ""
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
+        async with upstream_client("nvidia", timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
             async with client.stream(
                 "POST",
                 "https://integrate.api.nvidia.com/v1/chat/completions",
@@ -1874,7 +1876,7 @@ OUTPUT: Complete Arabic markdown article only."""
     t0        = datetime.utcnow()
 
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
+        async with upstream_client("nvidia", timeout=httpx.Timeout(1800.0, connect=30.0, read=1800.0)) as client:
             async with client.stream(
                 "POST",
                 "https://integrate.api.nvidia.com/v1/chat/completions",
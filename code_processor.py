@@ -7,6 +7,8 @@ import sys
 
 # 櫨 NEW: Import configuration from Provider Service 櫨
 from services.providers import NVIDIA_API_KEY, NVIDIA_BASE_URL
+from services.upstream import get_upstream_client
+from services.reasoning import ThinkTagSplitter
 # 櫨 NEW: Import Tool Registry to get tool details 櫨
 from tools.registry import TOOLS_DB
 
@@ -76,6 +78,22 @@ def log_debug(msg):
     print(f"\033[93m[DEBUG LOG]:\033[0m {msg}")
     sys.stdout.flush()
 
+def _delta_events(delta, splitter: ThinkTagSplitter) -> list:
+    """Turns one stream delta into thinking/code events (<think> tags may span chunks)."""
+    events = []
+    reasoning = getattr(delta, "reasoning_content", None) or \
+                (delta.model_extra and delta.model_extra.get("reasoning_content"))
+    if reasoning:
+        events.append({"type": "thinking", "content": reasoning})
+    if delta.content:
+        for is_reasoning, text in splitter.feed(delta.content):
+            events.append({"type": "thinking" if is_reasoning else "code", "content": text})
+    return events
+
+def _flush_events(splitter: ThinkTagSplitter) -> list:
+    return [{"type": "thinking" if is_reasoning else "code", "content": text}
+            for is_reasoning, text in splitter.flush()]
+
 async def process_code_merge_stream(
     instruction: str,
     files_data: list, 
@@ -241,14 +259,17 @@ Tools: POST to {PROJECT_HOST_URL}/api/tools/execute/{{TOOL_ID}}
 
     log_debug(f"Messages prepared. Count: {len(messages)}")
 
-    # 5. Call API
-    http_client = httpx.AsyncClient(timeout=httpx.Timeout(connect=15.0, read=120.0, write=30.0, pool=10.0))
+    # 5. Call API — العميل المشترك (pool) بدل عميل جديد لكل طلب
     client = AsyncOpenAI(
         base_url=NVIDIA_BASE_URL, 
         api_key=NVIDIA_API_KEY,
-        http_client=http_client
+        http_client=get_upstream_client("nvidia"),
+        timeout=httpx.Timeout(connect=15.0, read=120.0, write=30.0, pool=10.0),
     )
 
+    # البث المفتوح حالياً — يُغلق في finally عند انقطاع العميل فيتوقف NVIDIA عن التوليد
+    open_streams = []
+
     try:
         log_debug(">>> ATTEMPT 1: Initiating DeepSeek Terminus (Primary) with 5s TIMEOUT...")
 
@@ -263,6 +284,7 @@ Tools: POST to {PROJECT_HOST_URL}/api/tools/execute/{{TOOL_ID}}
                 stream=True,
                 extra_body={"chat_template_kwargs": {"thinking": True}}
             )
+            open_streams.append(stream)
             log_debug("   -> Request Sent. Waiting for first byte...")
             iterator = stream.__aiter__()
             first_chunk = await iterator.__anext__()
@@ -281,59 +303,19 @@ Tools: POST to {PROJECT_HOST_URL}/api/tools/execute/{{TOOL_ID}}
             raise e
 
         # --- PROCESSING THE STREAM (If successful) ---
-        is_thinking_block = False
-
-        # Process first chunk
-        delta = first_chunk.choices[0].delta
-        reasoning = getattr(delta, "reasoning_content", None) or \
-                    (delta.model_extra and delta.model_extra.get("reasoning_content"))
-
-        if reasoning:
-            yield {"type": "thinking", "content": reasoning}
-        elif delta.content:
-            text = delta.content
-            if "<think>" in text:
-                is_thinking_block = True
-                text = text.replace("<think>", "")
-            if "</think>" in text:
-                is_thinking_block = False
-                parts = text.split("</think>")
-                if parts[0]: yield {"type": "thinking", "content": parts[0]}
-                if len(parts) > 1 and parts[1]: yield {"type": "code", "content": parts[1]}
-            else:
-                if is_thinking_block: yield {"type": "thinking", "content": text}
-                else: yield {"type": "code", "content": text}
+        splitter = ThinkTagSplitter()
+
+        if getattr(first_chunk, "choices", None):
+            for event in _delta_events(first_chunk.choices[0].delta, splitter):
+                yield event
 
         # Process remaining chunks
         async for chunk in chunk_iterator:
             if not getattr(chunk, "choices", None): continue
-            delta = chunk.choices[0].delta
-
-            reasoning = getattr(delta, "reasoning_content", None) or \
-                        (delta.model_extra and delta.model_extra.get("reasoning_content"))
-
-            if reasoning:
-                yield {"type": "thinking", "content": reasoning}
-
-            if delta.content:
-                text = delta.content
-                # Intercept <think> tags if reasoning comes in main content stream
-                if "<think>" in text:
-                    is_thinking_block = True
-                    text = text.replace("<think>", "")
-                if "</think>" in text:
-                    is_thinking_block = False
-                    parts = text.split("</think>")
-                    if parts[0]:
-                        yield {"type": "thinking", "content": parts[0]}
-                    if len(parts) > 1 and parts[1]:
-                        yield {"type": "code", "content": parts[1]}
-                    continue
-
-                if is_thinking_block:
-                    yield {"type": "thinking", "content": text}
-                else:
-                    yield {"type": "code", "content": text}
+            for event in _delta_events(chunk.choices[0].delta, splitter):
+                yield event
+        for event in _flush_events(splitter):
+            yield event
 
         log_debug("DeepSeek Primary Stream Completed Successfully ✅")
 
@@ -351,36 +333,17 @@ Tools: POST to {PROJECT_HOST_URL}/api/tools/execute/{{TOOL_ID}}
                 stream=True,
                 extra_body={"chat_template_kwargs": {"thinking": True}} 
             )
+            open_streams.append(backup_completion)
 
             log_debug("DeepSeek v3.2 Fallback Connection Established. Streaming...")
-            is_thinking_block = False
+            splitter = ThinkTagSplitter()
 
             async for chunk in backup_completion:
                 if not getattr(chunk, "choices", None): continue
-                delta = chunk.choices[0].delta
-
-                reasoning = getattr(delta, "reasoning_content", None) or \
-                            (delta.model_extra and delta.model_extra.get("reasoning_content"))
-
-                if reasoning:
-                     yield {"type": "thinking", "content": reasoning}
-
-                if delta.content:
-                    text = delta.content
-                    if "<think>" in text:
-                        is_thinking_block = True
-                        text = text.replace("<think>", "")
-                    if "</think>" in text:
-                        is_thinking_block = False
-                        parts = text.split("</think>")
-                        if parts[0]: yield {"type": "thinking", "content": parts[0]}
-                        if len(parts) > 1 and parts[1]: yield {"type": "code", "content": parts[1]}
-                        continue
-
-                    if is_thinking_block:
-                        yield {"type": "thinking", "content": text}
-                    else:
-                        yield {"type": "code", "content": text}
+                for event in _delta_events(chunk.choices[0].delta, splitter):
+                    yield event
+            for event in _flush_events(splitter):
+                yield event
 
             log_debug("DeepSeek v3.2 Fallback Stream Completed ✅")
 
@@ -389,6 +352,14 @@ Tools: POST to {PROJECT_HOST_URL}/api/tools/execute/{{TOOL_ID}}
              log_debug(err_msg)
              yield {"type": "error", "content": err_msg}
 
+    except (asyncio.CancelledError, GeneratorExit):
+        log_debug("Client disconnected — cancelling upstream stream.")
+        raise
+
     finally:
-        await http_client.aclose()
-        log_debug("Process Finished. Client Closed.")
\ No newline at end of file
+        for stream in open_streams:
+            try:
+                await stream.close()
+            except BaseException:
+                pass
+        log_debug("Process Finished.")
\ No newline at end of file
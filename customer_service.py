@@ -5,7 +5,9 @@ import json
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import StreamingResponse, JSONResponse
 from openai import AsyncOpenAI
-from database import track_request_metrics
+from services.metrics_pipeline import track_request_metrics
+from services.upstream import get_upstream_client
+from services.semantic_cache import semantic_cache, tenant_namespace
 
 router = APIRouter()
 
@@ -18,7 +20,7 @@ if not AI_API_KEY:
     print("WARNING: AI API Key environment variable is not set. Customer service chat will be unavailable.")
     client = None
 else:
-    client = AsyncOpenAI(base_url=AI_BASE_URL, api_key=AI_API_KEY)
+    client = AsyncOpenAI(base_url=AI_BASE_URL, api_key=AI_API_KEY, http_client=get_upstream_client("nvidia"))
 
 # ==================== التسعيرات الدقيقة (بدون تسعيرة الأسبوع) ====================
 PRICING_DATA = {
@@ -482,9 +484,26 @@ async def support_chat(request: Request):
     # 4. Prepare Context
     input_tokens = estimate_tokens(user_message)
     system_prompt = detect_language_prompt(user_message, requested_lang)
+    cache_ns = tenant_namespace("support", "public", system_prompt)
 
     async def generate_stream():
         output_tokens = 0
+
+        # كاش دلالي: نفس السؤال بصياغة أخرى → نفس الرد بدون NVIDIA
+        cached, query_vec = await semantic_cache.lookup("support", cache_ns, user_message)
+        if cached is not None:
+            yield cached
+            if user_email:
+                track_request_metrics(
+                    email=user_email,
+                    latency_ms=int((time.time() - start_time) * 1000),
+                    tokens=input_tokens,
+                    is_error=False,
+                    is_internal=True
+                )
+            return
+
+        answer_parts = []
         try:
             # 5. Call Model
             stream = await client.chat.completions.create(
@@ -503,8 +522,11 @@ async def support_chat(request: Request):
                 content = chunk.choices[0].delta.content
                 if content:
                     output_tokens += estimate_tokens(content)
+                    answer_parts.append(content)
                     yield content
 
+            semantic_cache.store("support", cache_ns, query_vec, "".join(answer_parts))
+
             # 6. Log Metrics as INTERNAL
             if user_email:
                 track_request_metrics(
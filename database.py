@@ -355,6 +355,9 @@ def add_user_subscription(email, plan_key, plan_name, period, limits_dict=None):
         try: redis.set(f"user:{email}", json.dumps(user))
         except: pass
 
+    from services.limits import invalidate_premium_access
+    invalidate_premium_access(email)
+
     conn = get_db_connection()
     if conn:
         try:
@@ -407,6 +410,9 @@ def fix_broken_subscription_limits(email: str) -> dict:
         try: redis.set(f"user:{email}", json.dumps(user))
         except: pass
 
+    from services.limits import invalidate_premium_access
+    invalidate_premium_access(email)
+
     conn = get_db_connection()
     if conn:
         try:
@@ -517,6 +523,10 @@ def sync_all_usage_to_db():
     conn = get_db_connection()
     if not conn: return {"status": "error", "message": "TiDB not connected"}
 
+    # عدادات الاستخدام (total_tokens، latency_sum، ...) في hash user_metrics — تُدمج
+    # في usage قبل الحفظ وإلا تُحفظ أصفاراً وتضيع بانتهاء صلاحية الـ hash
+    from services.metrics_pipeline import metrics_pipeline
+
     try:
         keys = redis.keys("user:*")
         updated = 0
@@ -527,6 +537,7 @@ def sync_all_usage_to_db():
                     user_dict = json.loads(user_data) if isinstance(user_data, str) else user_data
                     email = user_dict.get("email")
                     if email:
+                        user_dict["usage"] = metrics_pipeline.user_usage(user_dict)
                         cur.execute("UPDATE users SET data = %s WHERE email = %s", (json.dumps(user_dict), email))
                         updated += 1
         return {"status": "success", "synced_users": updated}
@@ -645,6 +656,9 @@ def delete_user_account(email: str) -> dict:
             if old_key: redis.delete(f"api_key:{old_key}")
         except Exception: pass
 
+    from services.limits import invalidate_premium_access
+    invalidate_premium_access(email)
+
     conn = get_db_connection()
     if conn:
         try:
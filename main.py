@@ -23,9 +23,11 @@ from database import (
     hub_save_chat, hub_list_chats, hub_get_chat, hub_delete_chat,
 )
 from services.subscriptions import get_user_subscription_status
-from services.limits import check_premium_tool_access
-from services.providers import MODELS_METADATA, HIDDEN_MODELS
+from services.limits import match_premium_tool_path, premium_tool_rejection
+from services.providers import MODELS_METADATA, HIDDEN_MODELS, ttft_tracker, hf_space, provider_admission
 from services.request_router import router as chat_router
+from services.batches import router as batches_router, batch_worker
+from services.embeddings import router as embeddings_router
 from customer_service import router as customer_service_router
 from tools import router as tools_router
 from tools.registry import TOOLS_DB
@@ -34,6 +36,10 @@ from services.payments import router as payments_router
 from services.widget_service import router as widget_router
 from agent.routes import router as agent_v2_router, init_agent_db
 from services.admin import router as admin_router, track_page_visit
+from services.upstream import startup_upstream_clients, shutdown_upstream_clients
+from services.disconnect import cancel_on_disconnect
+from services.metrics_pipeline import metrics_pipeline
+from services.context_budget import load_tokenizer
 
 # ── Blog ──────────────────────────────────────────────────────────────────────
 from blog import blog_router
@@ -155,6 +161,30 @@ class PublicApiCORSMiddleware:
 
         await self.app(scope, receive, send)
 
+
+class PremiumToolsGuardMiddleware:
+    """
+    حارس الأدوات المميزة (Pure ASGI) — المنطق في services/limits.py.
+    المسار يُطابَق على trie مُجمَّع مسبقاً؛ أي مسار ليس تنفيذاً لأداة مميزة
+    يمر مباشرة بدون قراءة الجلسة أو أي I/O.
+    يجب أن يكون داخل SessionMiddleware حتى تتوفر scope["session"].
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or match_premium_tool_path(scope.get("path", "")) is None:
+            await self.app(scope, receive, send)
+            return
+
+        email = (scope.get("session") or {}).get("user_email")
+        rejection = premium_tool_rejection(email)
+        if rejection is not None:
+            await rejection(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
 # ============================================================================
 # APP SETUP
 # ============================================================================
@@ -162,6 +192,8 @@ class PublicApiCORSMiddleware:
 app = FastAPI(title="Orgteh Infra", docs_url=None, redoc_url=None)
 
 app.add_middleware(SecurityHeadersMiddleware)
+# ↓ يُضاف قبل SessionMiddleware ليكون داخلها (يقرأ scope["session"])
+app.add_middleware(PremiumToolsGuardMiddleware)
 app.add_middleware(CORSMiddleware,
     allow_origins=["*", "null"],   # null = srcdoc/blob iframes
     allow_credentials=True,
@@ -188,16 +220,34 @@ app.include_router(auth_router)
 app.include_router(payments_router)
 app.include_router(widget_router)
 app.include_router(chat_router)       # ← المحادثات: /api/chat, /api/chat/trial, /v1/chat/completions
+app.include_router(batches_router)    # ← الدفعات: /v1/batches (السعة الفائضة)
+app.include_router(embeddings_router) # ← التضمين: /v1/embeddings (تجميع الطلبات المتزامنة)
 app.include_router(blog_router)       # ← المدونة: /{lang}/blog, /api/admin/blog/generate
 
-# ── تهيئة جدول agent_sessions عند بدء التشغيل ────────────────────────────────
+# ── تهيئة جدول agent_sessions + عملاء المزودين المشتركين عند بدء التشغيل ──────
 @app.on_event("startup")
 async def _startup_init():
+    await startup_upstream_clients()
+    await asyncio.to_thread(load_tokenizer)
+    ttft_tracker.load()
+    ttft_tracker.start()
+    metrics_pipeline.start()
+    batch_worker.start()
+    hf_space.start()
     try:
         await init_agent_db()
     except Exception as _e:
         logging.getLogger("startup").warning(f"agent_db init: {_e}")
 
+@app.on_event("shutdown")
+async def _shutdown_cleanup():
+    await hf_space.stop()
+    await batch_worker.stop()
+    await metrics_pipeline.stop()
+    await provider_admission.shared.stop()
+    await shutdown_upstream_clients()
+    await ttft_tracker.stop()
+
 # ============================================================================
 # VISITOR TRACKING MIDDLEWARE
 # ============================================================================
@@ -207,17 +257,6 @@ async def visitor_tracking_middleware(request: Request, call_next):
     await track_page_visit(request)
     return await call_next(request)
 
-# ============================================================================
-# PREMIUM TOOLS GUARD MIDDLEWARE — المنطق في services/limits.py
-# ============================================================================
-
-@app.middleware("http")
-async def premium_tools_guard(request: Request, call_next):
-    rejection = await check_premium_tool_access(request)
-    if rejection is not None:
-        return rejection
-    return await call_next(request)
-
 # ============================================================================
 # HEALTH CHECK & WARM-UP
 # ============================================================================
@@ -253,7 +292,10 @@ async def fix_all_limits_endpoint():
     في Redis و TiDB — يُشغَّل مرة واحدة لتصحيح كل الحسابات دفعة واحدة.
     """
     from database import redis, get_db_connection
-    from services.limits import PLAN_CONFIGS, PLAN_NAME_MAP, get_limits_for_new_subscription, ALL_MODEL_KEYS
+    from services.limits import (
+        PLAN_CONFIGS, PLAN_NAME_MAP, get_limits_for_new_subscription, ALL_MODEL_KEYS,
+        invalidate_premium_access,
+    )
 
     now        = datetime.utcnow()
     fixed      = 0
@@ -373,6 +415,8 @@ async def fix_all_limits_endpoint():
     if conn:
         conn.close()
 
+    invalidate_premium_access()
+
     return JSONResponse({
         "ok":        True,
         "fixed":     fixed,
@@ -778,6 +822,34 @@ _PREVIEW_CORS = {
     "Access-Control-Max-Age":       "86400",
 }
 
+# رؤوس بث SSE للـ proxies — بدون تخزين مؤقت ولا buffering في nginx/Vercel
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _proxy_chat_stream(route: str, email: str, body: dict, prompt_tokens: int):
+    """
+    بث smart_chat_stream عبر طبقة الدمج: الطلبات المتطابقة المتزامنة لنفس المستخدم
+    تشترك في طلب upstream واحد. المتصل الأول يحجز مكان المزود ويُحتسب داخل
+    smart_chat_stream؛ المشتركون اللاحقون يُحتسبون هنا بنفس التقدير.
+    """
+    from services.providers import smart_chat_stream, acquire_provider_slot, MODEL_MAPPING
+    from services.coalescing import coalescer, coalesce_key
+    from services.metrics_pipeline import track_request_metrics
+
+    async def upstream():
+        try:
+            await acquire_provider_slot(is_priority=False, email=email)
+        except Exception:
+            pass  # non-fatal — proceed anyway
+        async for chunk in smart_chat_stream(body, email):
+            yield chunk
+
+    def account(chunks: int, ttft_ms: int):
+        track_request_metrics(email, ttft_ms, prompt_tokens + chunks,
+                              model_key=MODEL_MAPPING.get(body.get("model"), "unknown"))
+
+    return coalescer.stream(route, coalesce_key(route, email, body), upstream, account=account)
+
 @app.options("/api/preview-proxy")
 async def preview_proxy_preflight():
     """Respond to CORS preflight from null-origin iframes immediately."""
@@ -790,10 +862,8 @@ async def preview_proxy(request: Request):
     Proxy for AI calls from embedded preview iframes.
     api_key comes from the JSON body — avoids Authorization header
     so the request carries no credentials and ACAO:* is valid.
+    "stream": true → SSE pass-through; otherwise one buffered JSON completion.
     """
-    import json as _json
-    import time as _time
-
     def _cors_json(data: dict, status: int = 200):
         r = JSONResponse(data, status_code=status)
         r.headers.update(_PREVIEW_CORS)
@@ -818,54 +888,26 @@ async def preview_proxy(request: Request):
             return _cors_json({"error": "Invalid API key"}, 401)
 
         # 4. Always stream=True so smart_chat_stream works as an async generator
+        wants_stream = body.get("stream") is True
         body["stream"] = True
 
-        # 5. Acquire provider slot (required before smart_chat_stream)
-        from services.providers import smart_chat_stream, acquire_provider_slot
-        try:
-            await acquire_provider_slot(is_priority=False)
-        except Exception:
-            pass  # non-fatal — proceed anyway
-
-        # 6. Collect SSE chunks
-        chunks = []
-        async for chunk in smart_chat_stream(body, user["email"]):
-            if isinstance(chunk, bytes):
-                chunks.append(chunk.decode("utf-8", errors="ignore"))
-            else:
-                chunks.append(str(chunk))
-
-        # 7. Parse SSE → extract full content
-        full_content = ""
-        for line in "".join(chunks).splitlines():
-            line = line.strip()
-            if not line.startswith("data:") or "[DONE]" in line:
-                continue
-            try:
-                chunk_data = _json.loads(line[5:].strip())
-                # streaming delta
-                delta = chunk_data.get("choices", [{}])[0].get("delta", {})
-                full_content += delta.get("content", "")
-                # non-streaming message (fallback)
-                if not delta:
-                    msg = chunk_data.get("choices", [{}])[0].get("message", {})
-                    full_content += msg.get("content", "")
-            except Exception:
-                pass
+        # 5. Upstream stream (provider slot acquired inside; identical bursts coalesced)
+        from services.providers import estimate_tokens
+        from services.completion import collect_completion
+        prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in body.get("messages", []))
+        stream = _proxy_chat_stream("preview", user["email"], body, prompt_tokens)
+
+        # 6a. Streaming: forward chunks as they arrive (CORS headers on the stream itself)
+        if wants_stream:
+            return StreamingResponse(
+                cancel_on_disconnect(request, stream),
+                media_type="text/event-stream",
+                headers={**_PREVIEW_CORS, **_SSE_HEADERS},
+            )
 
-        # 8. Return OpenAI-compatible response
-        result = {
-            "id": "preview-" + str(int(_time.time())),
-            "object": "chat.completion",
-            "model": body.get("model", ""),
-            "choices": [{
-                "index": 0,
-                "message": {"role": "assistant", "content": full_content},
-                "finish_reason": "stop"
-            }],
-            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-        }
-        return _cors_json(result)
+        # 6b. Aggregate SSE deltas → OpenAI-compatible response
+        agg = await collect_completion(stream, body.get("model", ""), prompt_tokens)
+        return _cors_json(agg.result())
 
     except Exception as e:
         # Last-resort catch — always return JSON, never let Vercel return plain "Internal Server Error"
@@ -878,9 +920,6 @@ async def preview_proxy(request: Request):
 
 @app.post("/api/hub/ai-proxy")
 async def hub_ai_proxy(request: Request):
-    import json as _json
-    import time as _time
-
     email = get_current_user_email(request)
     if not email:
         return JSONResponse({"error": "Login required"}, 401)
@@ -893,39 +932,24 @@ async def hub_ai_proxy(request: Request):
     # Remove any api_key the client may have included (not needed here)
     body.pop("api_key", None)
     body.pop("orgteh_key", None)
+    wants_stream = body.get("stream") is True
     body["stream"] = True  # always stream so smart_chat_stream works as generator
 
-    from services.providers import smart_chat_stream, acquire_provider_slot
-    try:
-        await acquire_provider_slot(is_priority=False)
-    except Exception:
-        pass
+    from services.providers import estimate_tokens
+    from services.completion import collect_completion
+    prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in body.get("messages", []))
+    stream = _proxy_chat_stream("hub", email, body, prompt_tokens)
+
+    if wants_stream:
+        return StreamingResponse(cancel_on_disconnect(request, stream), media_type="text/event-stream",
+                                 headers=_SSE_HEADERS)
 
-    chunks = []
     try:
-        async for chunk in smart_chat_stream(body, email):
-            chunks.append(chunk.decode("utf-8", errors="ignore") if isinstance(chunk, bytes) else str(chunk))
+        agg = await collect_completion(stream, body.get("model", ""), prompt_tokens)
     except Exception as e:
         return JSONResponse({"error": str(e)}, 500)
 
-    full_content = ""
-    for line in "".join(chunks).splitlines():
-        line = line.strip()
-        if not line.startswith("data:") or "[DONE]" in line:
-            continue
-        try:
-            d = _json.loads(line[5:].strip())
-            full_content += d.get("choices", [{}])[0].get("delta", {}).get("content", "")
-        except Exception:
-            pass
-
-    return JSONResponse({
-        "id": "hub-proxy-" + str(int(_time.time())),
-        "object": "chat.completion",
-        "model": body.get("model", ""),
-        "choices": [{"index": 0, "message": {"role": "assistant", "content": full_content}, "finish_reason": "stop"}],
-        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-    })
+    return JSONResponse(agg.result())
 
 
 # ============================================================================
@@ -982,7 +1006,7 @@ async def process_code_endpoint(
                 await asyncio.sleep(0)
 
     return StreamingResponse(
-        event_generator(),
+        cancel_on_disconnect(request, event_generator()),
         media_type="application/x-ndjson",
         headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache, no-transform", "Content-Encoding": "identity"},
     )
@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+import contextlib
+
+import httpx
+
+# ============================================================================
+# GATEWAY BENCHMARK — قياس ما تضيفه البوابة فوق زمن الـ upstream
+# ============================================================================
+#  يشغل nexus_mock_upstream.py في عملية منفصلة (حتى لا يدخل وقت معالجه في
+#  القياس)، يوجه NVIDIA_BASE_URL إليه، ثم يستدعي handle_chat_request مباشرة
+#  بالتزامن المطلوب ويستهلك كل بث حتى نهايته. التقرير:
+#   - req/s، و TTFT (p50/p99) مقارنة بـ TTFT الـ mock ← فرق البوابة
+#   - CPU العملية لكل بث (time.process_time — البوابة + حلقة القياس الخفيفة)
+#   - أخطاء و bytes لكل بث
+#
+#  الوضع sse: سرعة SSEDecoder (MB/s و أحداث/ث، مع وبدون فك JSON). صحة الفك
+#  (مقارنة بمحلل مرجعي مع تقطيع عشوائي) في test_sse_decoder.py.
+#
+#  الحساب المستخدم ADMIN_EMAIL افتراضياً (بلا حصص). Redis/TiDB كما في بيئة
+#  التشغيل — المقاييس تُكتب كالمعتاد؛ استخدم بيئة تطوير.
+#
+#  أمثلة:
+#   python nexus_gateway_bench.py --requests 500 --concurrency 50 --ttft-ms 200 --itl-ms 10
+#   python nexus_gateway_bench.py --upstream http://127.0.0.1:8090/v1 --requests 200
+#   python nexus_gateway_bench.py sse --events 20000
+
+# --- CONFIGURATION ---
+MOCK_PORT         = 8091
+BENCH_MODEL       = "meta/llama-3.2-3b-instruct"
+REPORT_FILE       = "gateway_bench_report.json"
+MOCK_BOOT_TIMEOUT = 15.0
+PROMPT            = "Explain in one paragraph how server sent events work."
+MOCK_KEYS         = 64      # سعة طابور القبول = المفاتيح × RATE_LIMIT_PER_KEY — لا نقيس الحد بل البوابة
+
+
+def pct(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def ms(value):
+    return round(value * 1000, 1) if value is not None else None
+
+
+# --- MOCK UPSTREAM PROCESS ---
+
+def start_mock(args) -> subprocess.Popen:
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, "nexus_mock_upstream.py"),
+           "--port", str(args.mock_port), "--ttft-ms", str(args.ttft_ms), "--itl-ms", str(args.itl_ms),
+           "--tokens", str(args.tokens), "--reasoning-tokens", str(args.reasoning_tokens),
+           "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+           "--jitter", str(args.jitter)]
+    if args.replay:
+        cmd += ["--replay", args.replay]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    url = f"http://127.0.0.1:{args.mock_port}"
+    deadline = time.time() + MOCK_BOOT_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Mock upstream exited: {proc.stderr.read().decode(errors='replace')}")
+        try:
+            if httpx.get(f"{url}/__mock/stats", timeout=0.5).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("Mock upstream did not start in time")
+
+
+def stop_mock(proc):
+    if proc is None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+# --- GATEWAY BENCHMARK ---
+
+async def one_request(handle_chat_request, email: str, args) -> dict:
+    payload = {"model": args.model, "messages": [{"role": "user", "content": PROMPT}],
+               "max_tokens": args.tokens, "temperature": 0.7, "stream": True}
+    if args.reasoning_mode:
+        payload["reasoning_mode"] = args.reasoning_mode
+    t0 = time.perf_counter()
+    resp = await handle_chat_request(email, payload)
+    if not hasattr(resp, "body_iterator"):
+        return {"ok": False, "status": resp.status_code, "ttft": None,
+                "total": time.perf_counter() - t0, "bytes": 0}
+
+    ttft, size, done, error = None, 0, False, False
+    async for chunk in resp.body_iterator:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        size += len(chunk)
+        # تعليقات SSE (": waking up") ليست توكنات
+        if ttft is None and chunk.lstrip()[:5] == b"data:":
+            ttft = time.perf_counter() - t0
+        if b"[DONE]" in chunk:
+            done = True
+        if b'"error"' in chunk:
+            error = True
+    return {"ok": done and not error, "status": 200, "ttft": ttft,
+            "total": time.perf_counter() - t0, "bytes": size}
+
+
+async def run_batch(handle_chat_request, email: str, args, count: int) -> list:
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def guarded():
+        async with sem:
+            try:
+                return await one_request(handle_chat_request, email, args)
+            except Exception as e:
+                return {"ok": False, "status": type(e).__name__, "ttft": None, "total": 0.0, "bytes": 0}
+
+    return await asyncio.gather(*(guarded() for _ in range(count)))
+
+
+async def gateway_bench(args) -> dict:
+    from services import providers
+    from services.upstream import shutdown_upstream_clients
+    from services.request_router import handle_chat_request
+    from services.limits import ADMIN_EMAIL
+
+    providers.NVIDIA_BASE_URL = args.upstream.rstrip("/")
+    email = args.email or ADMIN_EMAIL
+
+    quiet = open(os.devnull, "w") if args.quiet else None
+    try:
+        with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+            await run_batch(handle_chat_request, email, args, args.warmup)
+            cpu0, wall0 = time.process_time(), time.perf_counter()
+            results = await run_batch(handle_chat_request, email, args, args.requests)
+            cpu, wall = time.process_time() - cpu0, time.perf_counter() - wall0
+    finally:
+        if quiet:
+            quiet.close()
+        await shutdown_upstream_clients()
+
+    ok     = [r for r in results if r["ok"]]
+    ttfts  = [r["ttft"] for r in ok if r["ttft"] is not None]
+    totals = [r["total"] for r in ok]
+    failed = {}
+    for r in results:
+        if not r["ok"]:
+            failed[str(r["status"])] = failed.get(str(r["status"]), 0) + 1
+    mock_ttft = args.ttft_ms / 1000 if not args.external else None
+
+    return {
+        "requests":          len(results),
+        "succeeded":         len(ok),
+        "failed":            failed,
+        "concurrency":       args.concurrency,
+        "wall_sec":          round(wall, 3),
+        "req_per_sec":       round(len(results) / wall, 2) if wall else None,
+        "ttft_ms_p50":       ms(pct(ttfts, 0.5)),
+        "ttft_ms_p99":       ms(pct(ttfts, 0.99)),
+        "ttft_ms_mean":      ms(statistics.mean(ttfts)) if ttfts else None,
+        "gateway_ttft_overhead_ms_p50": ms(pct(ttfts, 0.5) - mock_ttft) if ttfts and mock_ttft is not None else None,
+        "stream_ms_p50":     ms(pct(totals, 0.5)),
+        "stream_ms_p99":     ms(pct(totals, 0.99)),
+        "cpu_ms_total":      round(cpu * 1000, 1),
+        "cpu_ms_per_stream": round(cpu * 1000 / len(results), 3) if results else None,
+        "bytes_per_stream":  round(statistics.mean(r["bytes"] for r in ok)) if ok else 0,
+        "mock": {"ttft_ms": args.ttft_ms, "itl_ms": args.itl_ms, "tokens": args.tokens,
+                 "reasoning_tokens": args.reasoning_tokens} if not args.external else "external",
+    }
+
+
+# --- SSE DECODER: THROUGHPUT ---
+
+def sse_throughput(args) -> dict:
+    from services.sse import SSEDecoder, FAST_JSON
+
+    chunk = (b'data: {"id":"chatcmpl-x","object":"chat.completion.chunk","model":"m",'
+             b'"choices":[{"index":0,"delta":{"content":"token "},"finish_reason":null}]}\n\n')
+    body = chunk * args.events + b"data: [DONE]\n\n"
+    out = {"json_backend": "orjson" if FAST_JSON else "json", "events": args.events,
+           "body_mb": round(len(body) / 1e6, 2)}
+
+    for label, size in (("per_event", len(chunk)), ("net_4k", 4096), ("net_64k", 65536)):
+        for with_json in (False, True):
+            decoder = SSEDecoder()
+            t0 = time.perf_counter()
+            n = 0
+            for pos in range(0, len(body), size):
+                for ev in decoder.feed(body[pos:pos + size]):
+                    n += 1
+                    if with_json and not ev.done:
+                        ev.json()
+            n += len(decoder.flush())
+            dt = time.perf_counter() - t0
+            key = label + ("_json" if with_json else "")
+            out[key] = {"mb_per_sec": round(len(body) / 1e6 / dt, 1), "events_per_sec": round(n / dt)}
+            print(f"⚡ {key:<16} {out[key]['mb_per_sec']:>8} MB/s  {out[key]['events_per_sec']:>10} events/s")
+    return out
+
+
+# --- MAIN ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat gateway benchmark against a mock upstream")
+    parser.add_argument("mode", nargs="?", default="gateway", choices=("gateway", "sse"))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--model", default=BENCH_MODEL)
+    parser.add_argument("--email", help="account to bill (default: ADMIN_EMAIL, no quota checks)")
+    parser.add_argument("--upstream", help="use an already running upstream instead of spawning the mock")
+    parser.add_argument("--mock-port", type=int, default=MOCK_PORT)
+    parser.add_argument("--keys", type=int, default=MOCK_KEYS, help="fake NVIDIA keys given to the gateway")
+    parser.add_argument("--ttft-ms", type=float, default=200.0)
+    parser.add_argument("--itl-ms", type=float, default=10.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--reasoning-tokens", type=int, default=0)
+    parser.add_argument("--reasoning-mode", choices=("keep", "drop", "summarize"),
+                        help="gateway-side reasoning filter (services/reasoning.py)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--replay", help="cassette recorded with nexus_mock_upstream.py --record")
+    parser.add_argument("--quiet", action="store_true", help="silence gateway print logging during the run")
+    parser.add_argument("--events", type=int, default=20000, help="sse mode: events in the throughput body")
+    parser.add_argument("--report", default=REPORT_FILE)
+    args = parser.parse_args()
+
+    if args.mode == "sse":
+        report = {"throughput": sse_throughput(args)}
+    else:
+        args.external = bool(args.upstream)
+        proc = None
+        if not args.upstream:
+            # المفاتيح تُقرأ عند استيراد providers — مفاتيح وهمية تكفي للـ mock
+            os.environ["NVIDIA_API_KEYS"] = ",".join(f"mock-key-{i:04d}-xxxxxxxx" for i in range(args.keys))
+            proc = start_mock(args)
+            args.upstream = f"http://127.0.0.1:{args.mock_port}/v1"
+        print(f"🚀 {args.requests} requests × concurrency {args.concurrency} → {args.upstream}")
+        try:
+            report = asyncio.run(gateway_bench(args))
+            if proc is not None:
+                report["mock_stats"] = httpx.get(f"http://127.0.0.1:{args.mock_port}/__mock/stats").json()
+        finally:
+            stop_mock(proc)
+
+        print(f"📊 {report['req_per_sec']} req/s | TTFT p50 {report['ttft_ms_p50']}ms "
+              f"p99 {report['ttft_ms_p99']}ms | CPU {report['cpu_ms_per_stream']}ms/stream | "
+              f"ok {report['succeeded']}/{report['requests']}")
+        if report["failed"]:
+            print(f"⚠️ failures: {report['failed']}")
+
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"📝 Report saved to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import os
+import sys
+import json
+import time
+import codecs
+import random
+import asyncio
+import hashlib
+import argparse
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# ============================================================================
+# MOCK UPSTREAM — خادم NVIDIA/OpenAI وهمي لقياس البوابة بمعزل عن المزودين
+# ============================================================================
+#  nexus_tester.py يحتاج خادماً حياً ومفاتيح حقيقية؛ زمن NVIDIA يطغى على كل
+#  ما تضيفه البوابة. هذا الخادم يتكلم نفس البروتوكول (SSE بصيغة OpenAI):
+#   POST /v1/chat/completions   (stream true/false)
+#   POST /v1/embeddings
+#  مع TTFT وزمن بين التوكنات وعدد التوكنات قابلة للضبط، وحقن أخطاء 500 و 429
+#  (مع Retry-After) وقطع البث في منتصفه، و reasoning_content لمحاكاة نماذج التفكير.
+#
+#  أوضاع:
+#   synthetic (افتراضي)  — بث مولّد حسب الإعدادات
+#   --record URL         — يمرر الطلبات لـ upstream حقيقي ويحفظ كل بث (مع توقيته) في cassette
+#   --replay FILE        — يعيد البث المحفوظ بنفس التوقيت (أو مضروباً في --speed)
+#
+#  الإعدادات قابلة للتغيير أثناء التشغيل: POST /__mock/config  — GET /__mock/stats
+#
+#  تشغيل:  python nexus_mock_upstream.py --port 8090 --ttft-ms 300 --itl-ms 20
+#  ثم:     NVIDIA_BASE_URL للبوابة = http://127.0.0.1:8090/v1   (انظر nexus_gateway_bench.py)
+
+# --- CONFIGURATION ---
+DEFAULT_PORT     = 8090
+CASSETTE_FILE    = "mock_upstream_cassette.jsonl"
+EMBEDDING_DIMS   = 1024
+WORDS = ("the gateway streams tokens from the upstream model while the client waits "
+         "for each delta to arrive over server sent events").split()
+
+CONFIG = {
+    "ttft_ms":          300.0,   # زمن حتى أول توكن
+    "itl_ms":           20.0,    # زمن بين التوكنات
+    "jitter":           0.1,     # ± نسبة عشوائية على كل تأخير
+    "tokens":           64,      # توكنات الرد (إن لم يحدد الطلب max_tokens أقل)
+    "reasoning_tokens": 0,       # توكنات reasoning_content قبل الرد
+    "error_rate":       0.0,     # نسبة ردود 500
+    "rate_limit_rate":  0.0,     # نسبة ردود 429
+    "retry_after":      1,
+    "drop_rate":        0.0,     # نسبة البثوث المقطوعة في منتصفها (بدون [DONE])
+    "speed":            1.0,     # مُعامل توقيت replay (2.0 = أسرع مرتين)
+}
+
+STATS = {"requests": 0, "streams": 0, "completed": 0, "errors_injected": 0,
+         "rate_limited": 0, "dropped": 0, "replayed": 0, "recorded": 0, "embeddings": 0}
+
+MODE = {"record_url": None, "record_key": None, "replay": None, "cassette": CASSETTE_FILE}
+_rr  = {"i": 0}
+
+app = FastAPI(title="Nexus Mock Upstream")
+
+
+# --- HELPERS ---
+
+def _delay(ms: float) -> float:
+    j = CONFIG["jitter"]
+    return max(0.0, ms * (1 + random.uniform(-j, j))) / 1000
+
+
+def _chunk(cid: str, model: str, delta: dict, finish=None, usage=None) -> bytes:
+    obj = {"id": cid, "object": "chat.completion.chunk", "created": int(time.time()),
+           "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+    if usage is not None:
+        obj["usage"] = usage
+    return b"data: " + json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+def _request_key(body: dict) -> str:
+    """مفتاح الـ cassette: النموذج والرسائل فقط (بدون temperature وغيرها)."""
+    raw = json.dumps({"model": body.get("model"), "messages": body.get("messages")},
+                     sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
+
+
+def _token_counts(body: dict) -> tuple:
+    tokens = CONFIG["tokens"]
+    if body.get("max_tokens"):
+        tokens = min(tokens, int(body["max_tokens"]))
+    prompt = sum(len(str(m.get("content", ""))) // 4 for m in body.get("messages", []))
+    return max(1, tokens), prompt
+
+
+def _injected_error():
+    r = random.random()
+    if r < CONFIG["rate_limit_rate"]:
+        STATS["rate_limited"] += 1
+        return JSONResponse({"error": {"message": "Too Many Requests (mock)", "type": "rate_limit"}},
+                            status_code=429, headers={"Retry-After": str(CONFIG["retry_after"])})
+    if r < CONFIG["rate_limit_rate"] + CONFIG["error_rate"]:
+        STATS["errors_injected"] += 1
+        return JSONResponse({"error": {"message": "Internal error (mock)", "type": "server_error"}},
+                            status_code=500)
+    return None
+
+
+# --- SYNTHETIC STREAM ---
+
+async def _synthetic_stream(body: dict):
+    model = body.get("model", "mock-model")
+    cid = f"chatcmpl-mock-{random.getrandbits(48):012x}"
+    tokens, prompt = _token_counts(body)
+    reasoning = CONFIG["reasoning_tokens"]
+    drop_at = random.randint(1, tokens) if random.random() < CONFIG["drop_rate"] else None
+
+    await asyncio.sleep(_delay(CONFIG["ttft_ms"]))
+    yield _chunk(cid, model, {"role": "assistant", "content": ""})
+    for i in range(reasoning):
+        if i:
+            await asyncio.sleep(_delay(CONFIG["itl_ms"]))
+        yield _chunk(cid, model, {"reasoning_content": WORDS[i % len(WORDS)] + " "})
+    for i in range(tokens):
+        if i or reasoning:
+            await asyncio.sleep(_delay(CONFIG["itl_ms"]))
+        if drop_at is not None and i == drop_at:
+            STATS["dropped"] += 1
+            return
+        yield _chunk(cid, model, {"content": WORDS[i % len(WORDS)] + " "})
+    yield _chunk(cid, model, {}, finish="stop",
+                 usage={"prompt_tokens": prompt, "completion_tokens": tokens + reasoning,
+                        "total_tokens": prompt + tokens + reasoning})
+    yield b"data: [DONE]\n\n"
+    STATS["completed"] += 1
+
+
+def _synthetic_completion(body: dict) -> dict:
+    tokens, prompt = _token_counts(body)
+    message = {"role": "assistant", "content": " ".join(WORDS[i % len(WORDS)] for i in range(tokens))}
+    if CONFIG["reasoning_tokens"]:
+        message["reasoning_content"] = " ".join(WORDS[i % len(WORDS)] for i in range(CONFIG["reasoning_tokens"]))
+    STATS["completed"] += 1
+    return {"id": f"chatcmpl-mock-{random.getrandbits(48):012x}", "object": "chat.completion",
+            "created": int(time.time()), "model": body.get("model", "mock-model"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt, "completion_tokens": tokens,
+                      "total_tokens": prompt + tokens}}
+
+
+# --- RECORD / REPLAY ---
+
+def load_cassette(path: str) -> dict:
+    entries = {"by_key": {}, "all": []}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries["by_key"][entry["key"]] = entry
+            entries["all"].append(entry)
+    print(f"📼 Loaded {len(entries['all'])} recorded streams from {path}")
+    return entries
+
+
+async def _replay_stream(entry: dict):
+    speed = CONFIG["speed"] or 1.0
+    for delay_ms, text in entry["chunks"]:
+        await asyncio.sleep(delay_ms / 1000 / speed)
+        yield text.encode("utf-8")
+    STATS["completed"] += 1
+
+
+def _pick_recorded(body: dict):
+    cassette = MODE["replay"]
+    if not cassette or not cassette["all"]:
+        return None
+    entry = cassette["by_key"].get(_request_key(body))
+    if entry is None:
+        # طلب غير مسجل — الدوران على البثوث المحفوظة
+        entry = cassette["all"][_rr["i"] % len(cassette["all"])]
+        _rr["i"] += 1
+    return entry
+
+
+async def _record_stream(body: dict, auth: str):
+    """يمرر البث من upstream حقيقي كما هو ويحفظه مع الزمن بين الـ chunks."""
+    if MODE["record_key"]:
+        auth = f"Bearer {MODE['record_key']}"
+    headers = {"Authorization": auth, "Content-Type": "application/json"}
+    chunks = []
+    status = None
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")   # حرف قد ينقسم بين chunkين
+    last = time.monotonic()
+    async with httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=10.0)) as client:
+        async with client.stream("POST", f"{MODE['record_url']}/chat/completions",
+                                 headers=headers, json=body) as resp:
+            status = resp.status_code
+            async for raw in resp.aiter_bytes():
+                now = time.monotonic()
+                text = decoder.decode(raw)
+                chunks.append([round((now - last) * 1000, 1), text])
+                last = now
+                yield raw
+    if status == 200:
+        with open(MODE["cassette"], "a", encoding="utf-8") as f:
+            f.write(json.dumps({"key": _request_key(body), "model": body.get("model"),
+                                "chunks": chunks}, ensure_ascii=False) + "\n")
+        STATS["recorded"] += 1
+
+
+# --- ROUTES ---
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    STATS["requests"] += 1
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"error": {"message": "Invalid JSON"}}, status_code=400)
+
+    if MODE["record_url"]:
+        STATS["streams"] += 1
+        return StreamingResponse(_record_stream(body, request.headers.get("Authorization", "")),
+                                 media_type="text/event-stream")
+
+    error = _injected_error()
+    if error is not None:
+        return error
+
+    if not body.get("stream"):
+        await asyncio.sleep(_delay(CONFIG["ttft_ms"] + CONFIG["itl_ms"] * CONFIG["tokens"]))
+        return JSONResponse(_synthetic_completion(body))
+
+    STATS["streams"] += 1
+    entry = _pick_recorded(body)
+    if entry is not None:
+        STATS["replayed"] += 1
+        return StreamingResponse(_replay_stream(entry), media_type="text/event-stream")
+    return StreamingResponse(_synthetic_stream(body), media_type="text/event-stream")
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    STATS["requests"] += 1
+    STATS["embeddings"] += 1
+    body = await request.json()
+    error = _injected_error()
+    if error is not None:
+        return error
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    await asyncio.sleep(_delay(CONFIG["ttft_ms"]))
+    data = []
+    for i, text in enumerate(inputs):
+        rng = random.Random(hashlib.md5(str(text).encode("utf-8")).hexdigest())
+        data.append({"object": "embedding", "index": i,
+                     "embedding": [round(rng.uniform(-1, 1), 6) for _ in range(EMBEDDING_DIMS)]})
+    tokens = sum(max(1, len(str(t)) // 4) for t in inputs)
+    return {"object": "list", "data": data, "model": body.get("model", "mock-embed"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "mock-model", "object": "model"}]}
+
+
+@app.get("/__mock/config")
+async def get_config():
+    return {"config": CONFIG, "mode": {k: v for k, v in MODE.items() if k not in ("replay", "record_key")},
+            "replay_streams": len(MODE["replay"]["all"]) if MODE["replay"] else 0}
+
+
+@app.post("/__mock/config")
+async def set_config(request: Request):
+    updates = await request.json()
+    for key, value in updates.items():
+        if key in CONFIG:
+            CONFIG[key] = type(CONFIG[key])(value)
+    return {"config": CONFIG}
+
+
+@app.get("/__mock/stats")
+async def get_stats():
+    return STATS
+
+
+@app.post("/__mock/reset")
+async def reset_stats():
+    for key in STATS:
+        STATS[key] = 0
+    return STATS
+
+
+# --- MAIN ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock NVIDIA/OpenAI SSE upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--ttft-ms", type=float, default=CONFIG["ttft_ms"])
+    parser.add_argument("--itl-ms", type=float, default=CONFIG["itl_ms"])
+    parser.add_argument("--jitter", type=float, default=CONFIG["jitter"])
+    parser.add_argument("--tokens", type=int, default=CONFIG["tokens"])
+    parser.add_argument("--reasoning-tokens", type=int, default=CONFIG["reasoning_tokens"])
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"])
+    parser.add_argument("--rate-limit-rate", type=float, default=CONFIG["rate_limit_rate"])
+    parser.add_argument("--retry-after", type=int, default=CONFIG["retry_after"])
+    parser.add_argument("--drop-rate", type=float, default=CONFIG["drop_rate"])
+    parser.add_argument("--record", metavar="UPSTREAM_URL",
+                        help="proxy to a real upstream (e.g. https://integrate.api.nvidia.com/v1) and record")
+    parser.add_argument("--replay", metavar="CASSETTE", help="replay streams recorded with --record")
+    parser.add_argument("--cassette", default=CASSETTE_FILE, help="file written by --record")
+    parser.add_argument("--speed", type=float, default=CONFIG["speed"])
+    args = parser.parse_args()
+
+    for key in CONFIG:
+        CONFIG[key] = type(CONFIG[key])(getattr(args, key))
+    MODE["cassette"] = args.cassette
+    if args.record:
+        MODE["record_url"] = args.record.rstrip("/")
+        MODE["record_key"] = os.environ.get("MOCK_RECORD_API_KEY")
+        print(f"🔴 Recording {MODE['record_url']} → {args.cassette}")
+    if args.replay:
+        if not os.path.exists(args.replay):
+            print(f"❌ Cassette not found: {args.replay}")
+            sys.exit(1)
+        MODE["replay"] = load_cassette(args.replay)
+
+    print(f"🚀 Mock upstream on http://{args.host}:{args.port}/v1  "
+          f"(ttft={CONFIG['ttft_ms']}ms itl={CONFIG['itl_ms']}ms tokens={CONFIG['tokens']})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
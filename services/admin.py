@@ -17,6 +17,7 @@ from database import (
     get_visitor_stats,
 )
 from services.auth import get_current_user_email
+from services.limits import invalidate_premium_access
 
 # ============================================================================
 # CONSTANTS
@@ -293,6 +294,7 @@ async def admin_get_users(request: Request, gmail_only: bool = True):
     gmail_only=true (افتراضي): يعرض Gmail فقط ويتجاهل الإيميلات الوهمية.
     """
     verify_admin(request)
+    from services.metrics_pipeline import metrics_pipeline
     _redis = redis
     users: list = []
 
@@ -308,6 +310,7 @@ async def admin_get_users(request: Request, gmail_only: bool = True):
                     continue
                 if gmail_only and not _is_gmail(u["email"]):
                     continue
+                u["usage"] = metrics_pipeline.user_usage(u)
                 users.append({k: v for k, v in u.items() if k != "password"})
         except Exception as e:
             print(f"[Admin] Users load error: {e}")
@@ -428,6 +431,7 @@ class AdminEmailRequest(BaseModel):
 @router.post("/api/admin/revoke-plans")
 async def admin_revoke_plans(request: Request, data: AdminEmailRequest):
     verify_admin(request)
+    from services.metrics_pipeline import user_metrics_key
     _redis = redis
 
     user = get_user_by_email(data.email)
@@ -457,6 +461,8 @@ async def admin_revoke_plans(request: Request, data: AdminEmailRequest):
         except Exception:
             pass
 
+    invalidate_premium_access(data.email)
+
     return JSONResponse({
         "status": "success",
         "message": f"All plans revoked for {data.email}",
@@ -469,6 +475,7 @@ async def admin_revoke_plans(request: Request, data: AdminEmailRequest):
 @router.post("/api/admin/reset-usage")
 async def admin_reset_usage(request: Request, data: AdminEmailRequest):
     verify_admin(request)
+    from services.metrics_pipeline import user_metrics_key
     _redis = redis
 
     user = get_user_by_email(data.email)
@@ -499,6 +506,7 @@ async def admin_reset_usage(request: Request, data: AdminEmailRequest):
     if _redis:
         try:
             _redis.set(f"user:{data.email}", json.dumps(user))
+            _redis.delete(user_metrics_key(data.email, user["usage"]["date"]))
         except Exception:
             pass
 
@@ -513,3 +521,183 @@ async def trigger_db_sync(request: Request):
     verify_admin(request)
     result = sync_all_usage_to_db()
     return JSONResponse(result)
+
+# ============================================================================
+# API: UPSTREAM CLIENTS (TTFB + HTTP version لكل مزود)
+# ============================================================================
+
+@router.get("/api/admin/upstream-stats")
+async def admin_upstream_stats(request: Request):
+    verify_admin(request)
+    from services.upstream import get_upstream_stats
+    return JSONResponse(get_upstream_stats())
+
+# ============================================================================
+# API: PROVIDER ADMISSION (طابور القبول + أزمنة الانتظار)
+# ============================================================================
+
+@router.get("/api/admin/provider-admission")
+async def admin_provider_admission(request: Request):
+    verify_admin(request)
+    from services.providers import provider_admission
+    return JSONResponse(provider_admission.stats())
+
+# ============================================================================
+# API: PROVIDER KEYS (حالة كل مفتاح NVIDIA في المُجدوِل)
+# ============================================================================
+
+@router.get("/api/admin/provider-keys")
+async def admin_provider_keys(request: Request):
+    verify_admin(request)
+    from services.providers import key_scheduler
+    return JSONResponse({"keys": key_scheduler.snapshot()})
+
+# ============================================================================
+# API: HEDGING (ميزانية الطلبات الاحتياطية)
+# ============================================================================
+
+@router.get("/api/admin/hedging")
+async def admin_hedging(request: Request):
+    verify_admin(request)
+    from services.providers import hedge_budget
+    return JSONResponse(hedge_budget.stats())
+
+# ============================================================================
+# API: TTFT TIMEOUTS (مهلة أول chunk المتعلَّمة لكل نموذج ومفتاح)
+# ============================================================================
+
+@router.get("/api/admin/ttft-timeouts")
+async def admin_ttft_timeouts(request: Request):
+    verify_admin(request)
+    from services.providers import ttft_tracker
+    return JSONResponse(ttft_tracker.snapshot())
+
+# ============================================================================
+# API: CIRCUIT BREAKERS (حالة قاطع كل نموذج)
+# ============================================================================
+
+@router.get("/api/admin/circuit-breakers")
+async def admin_circuit_breakers(request: Request):
+    verify_admin(request)
+    from services.providers import circuit_breakers
+    return JSONResponse(circuit_breakers.snapshot())
+
+# ============================================================================
+# API: RESPONSE CACHE (كاش الردود المتطابقة)
+# ============================================================================
+
+@router.get("/api/admin/response-cache")
+async def admin_response_cache(request: Request):
+    verify_admin(request)
+    from services.request_router import response_cache
+    return JSONResponse(response_cache.stats())
+
+# ============================================================================
+# API: SEMANTIC CACHE (كاش الأسئلة المتشابهة — الدعم والـ widgets)
+# ============================================================================
+
+@router.get("/api/admin/semantic-cache")
+async def admin_semantic_cache(request: Request):
+    verify_admin(request)
+    from services.semantic_cache import semantic_cache
+    return JSONResponse(semantic_cache.stats())
+
+# ============================================================================
+# API: IN-FLIGHT COALESCING (دمج الطلبات المتطابقة المتزامنة)
+# ============================================================================
+
+@router.get("/api/admin/coalescing")
+async def admin_coalescing(request: Request):
+    verify_admin(request)
+    from services.coalescing import coalescer
+    return JSONResponse(coalescer.stats())
+
+# ============================================================================
+# API: CLIENT DISCONNECTS (إلغاء upstream عند انقطاع العميل)
+# ============================================================================
+
+@router.get("/api/admin/disconnects")
+async def admin_disconnects(request: Request):
+    verify_admin(request)
+    from services.disconnect import disconnect_stats
+    return JSONResponse(disconnect_stats.stats())
+
+# ============================================================================
+# API: METRICS PIPELINE (طابور تسجيل الاستخدام غير المتزامن)
+# ============================================================================
+
+@router.get("/api/admin/metrics-pipeline")
+async def admin_metrics_pipeline(request: Request):
+    verify_admin(request)
+    from services.metrics_pipeline import metrics_pipeline
+    return JSONResponse(metrics_pipeline.stats())
+
+# ============================================================================
+# API: OFFLINE BATCHES (عامل /v1/batches)
+# ============================================================================
+
+@router.get("/api/admin/batches")
+async def admin_batches(request: Request):
+    verify_admin(request)
+    from services.batches import batch_worker
+    return JSONResponse(batch_worker.stats())
+
+# ============================================================================
+# API: EMBEDDINGS (مُجمِّع /v1/embeddings)
+# ============================================================================
+
+@router.get("/api/admin/embeddings")
+async def admin_embeddings(request: Request):
+    verify_admin(request)
+    from services.embeddings import embedding_batcher
+    return JSONResponse(embedding_batcher.stats())
+
+# ============================================================================
+# API: MODEL BULKHEADS (حدود التزامن ومدة البث لكل نموذج)
+# ============================================================================
+
+@router.get("/api/admin/model-bulkheads")
+async def admin_model_bulkheads(request: Request):
+    verify_admin(request)
+    from services.providers import model_bulkheads
+    return JSONResponse(model_bulkheads.stats())
+
+# ============================================================================
+# API: CONTEXT BUDGET (قص سجل المحادثة قبل الإرسال)
+# ============================================================================
+
+@router.get("/api/admin/context-budget")
+async def admin_context_budget(request: Request):
+    verify_admin(request)
+    from services.providers import context_budget
+    return JSONResponse(context_budget.stats())
+
+# ============================================================================
+# API: HF SPACE (qwen-mini — TTFT والإيقاظ والـ pinger)
+# ============================================================================
+
+@router.get("/api/admin/hf-space")
+async def admin_hf_space(request: Request):
+    verify_admin(request)
+    from services.providers import hf_space
+    return JSONResponse(hf_space.stats())
+
+# ============================================================================
+# API: MODEL ENDPOINTS (توجيه النماذج حسب زمن الاستجابة)
+# ============================================================================
+
+@router.get("/api/admin/endpoints")
+async def admin_endpoints(request: Request):
+    verify_admin(request)
+    from services.providers import endpoint_router
+    return JSONResponse(endpoint_router.stats())
+
+# ============================================================================
+# API: REASONING FILTER (حذف/تلخيص التفكير — bytes الموفرة)
+# ============================================================================
+
+@router.get("/api/admin/reasoning")
+async def admin_reasoning(request: Request):
+    verify_admin(request)
+    from services.reasoning import reasoning_stats
+    return JSONResponse(reasoning_stats.stats())
@@ -0,0 +1,323 @@
+import time
+import asyncio
+from collections import deque
+
+# ============================================================================
+# PROVIDER ADMISSION CONTROLLER
+# ============================================================================
+#  نافذة منزلقة (60 ثانية) على شكل ring buffer من أوقات القبول:
+#   - الطلبات القديمة تُزال من اليسار فقط → O(1) مُطفأة بدل فلترة القائمة كاملة.
+#   - المنتظرون ينامون حتى لحظة تحرر أقرب خانة بالضبط (أو حتى dispatch عند تغيّر
+#     السعة) — لا يوجد polling كل ثانية.
+#   - الطابور محدود؛ عند امتلائه يُرفض الطلب فوراً بـ AdmissionRejected، ومن
+#     تجاوز max_wait_sec في الطابور يُرفض بها أيضاً بدل الانتظار بلا نهاية.
+#
+#  WEIGHTED FAIR QUEUING: طابور فرعي (FIFO) لكل مستخدم ووزن حسب خطته
+#  (limits.PLAN_QUEUE_WEIGHTS). كل طلب منتظر يأخذ وسم إنهاء افتراضي
+#  finish = max(V, آخر finish للمستخدم) + 1/weight، والخانة المتحررة تذهب لأصغر
+#  وسم بين رؤوس الطوابير (self-clocked fair queuing) — مستخدم يرسل 100 طلب لا
+#  يؤخر غيره إلا بقدر حصته. عتبة الأولوية تبقى: رأس عادي (0.80) لا يمنع قبول رأس
+#  أولوية (0.95) بعده في الترتيب. كل القرارات في dispatch() وتعتمد على clock فقط،
+#  فيمكن اختبار الترتيب بساعة محاكاة واستدعاء dispatch() يدوياً.
+#   - مع shared (ClusterCapacity) القرار على مستوى كل العمال عبر Redis؛ بدونه
+#     أو عند تعطل Redis يأخذ كل عامل حصته فقط: capacity / local_share.
+#     shared لا يلمس Redis في مسار القبول — يطلب الدفعات في الخلفية ويستدعي
+#     dispatch() (on_capacity) بعد كل تحديث، فالمنتظرون لا يعيدون المحاولة دورياً.
+
+PRIORITY_THRESHOLD = 0.95   # مشتركو الخطط المدفوعة ضمن الحد اليومي
+NORMAL_THRESHOLD   = 0.80   # overdraft / تجربة / بروكسي
+BATCH_THRESHOLD    = 0.60   # /v1/batches — السعة الفائضة فقط، تحت حركة المستخدمين
+
+_WAIT_BUCKETS_MS = (0, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class AdmissionRejected(Exception):
+    """يُرفع عندما يكون طابور الانتظار ممتلئاً أو السعة صفر أو تجاوز الانتظار الحد."""
+
+
+class _Waiter:
+    __slots__ = ("user", "tier", "threshold", "finish", "enqueued", "deadline", "future")
+
+    def __init__(self, user, tier, threshold, finish, enqueued, deadline, future):
+        self.user      = user
+        self.tier      = tier
+        self.threshold = threshold
+        self.finish    = finish
+        self.enqueued  = enqueued
+        self.deadline  = deadline
+        self.future    = future
+
+
+def _new_hist() -> dict:
+    hist = {b: 0 for b in _WAIT_BUCKETS_MS}
+    hist["inf"] = 0
+    return hist
+
+
+def _observe(hist: dict, wait_ms: float):
+    for b in _WAIT_BUCKETS_MS:
+        if wait_ms <= b:
+            hist[b] += 1
+            return
+    hist["inf"] += 1
+
+
+class AdmissionController:
+    def __init__(self, capacity_rpm: int, window_sec: float = 60.0,
+                 max_queue: int = 200, clock=time.monotonic,
+                 shared=None, local_share: int = 1, max_wait_sec: float = 30.0):
+        self.capacity   = capacity_rpm
+        self.window     = window_sec
+        self.max_queue  = max_queue
+        self.shared     = shared
+        self.local_share = max(1, local_share)
+        self.max_wait   = max_wait_sec
+        self._clock     = clock
+        self._admitted  = deque()
+        self._waiting   = 0
+
+        # WFQ: طابور فرعي لكل مستخدم + آخر وسم إنهاء له + الزمن الافتراضي V
+        self._queues      = {}
+        self._last_finish = {}
+        self._vtime       = 0.0
+
+        self._stats = {
+            "admitted":        0,
+            "admitted_queued": 0,
+            "rejected":        0,
+            "timed_out":       0,
+            "wait_ms_sum":     0.0,
+            "wait_ms_max":     0.0,
+        }
+        self._wait_hist = _new_hist()
+        self._tiers     = {}
+        if shared is not None:
+            shared.on_capacity = self.dispatch
+
+    # ── Capacity model ──────────────────────────────────────────────────────
+
+    def _prune(self, now: float):
+        cutoff = now - self.window
+        admitted = self._admitted
+        while admitted and admitted[0] <= cutoff:
+            admitted.popleft()
+
+    def _local_capacity(self) -> float:
+        return self.capacity / self.local_share
+
+    def load(self) -> float:
+        if self.capacity <= 0:
+            return 1.0
+        if self.shared is not None:
+            cluster_load = self.shared.load(self.capacity)
+            if cluster_load is not None:
+                return cluster_load
+        self._prune(self._clock())
+        return len(self._admitted) / self._local_capacity()
+
+    def _try_admit(self, threshold: float) -> bool:
+        if self.capacity <= 0:
+            return False
+        now = self._clock()
+        self._prune(now)
+        if self.shared is not None:
+            verdict = self.shared.try_take(threshold, self.capacity)
+            if verdict is not None:
+                if verdict:
+                    self._admitted.append(now)
+                return verdict
+        if len(self._admitted) / self._local_capacity() < threshold:
+            self._admitted.append(now)
+            return True
+        return False
+
+    def _seconds_until_next_free(self) -> float:
+        if self.shared is not None and self.shared.available():
+            # الإيقاظ يأتي من shared.on_capacity عند وصول دفعة — الانتظار محدود بالمهلة فقط
+            return self.window
+        if not self._admitted:
+            return self.window
+        return max(0.0, self._admitted[0] + self.window - self._clock())
+
+    # ── Metrics ─────────────────────────────────────────────────────────────
+
+    def _tier(self, tier: str) -> dict:
+        t = self._tiers.get(tier)
+        if t is None:
+            t = self._tiers[tier] = {"queue_depth": 0, "admitted": 0, "admitted_queued": 0,
+                                     "rejected": 0, "timed_out": 0, "wait_ms_sum": 0.0,
+                                     "wait_histogram_ms": _new_hist()}
+        return t
+
+    def _record_wait(self, tier: str, wait_ms: float):
+        self._stats["admitted_queued"] += 1
+        self._stats["wait_ms_sum"] += wait_ms
+        self._stats["wait_ms_max"]  = max(self._stats["wait_ms_max"], wait_ms)
+        _observe(self._wait_hist, wait_ms)
+        t = self._tier(tier)
+        t["admitted_queued"] += 1
+        t["wait_ms_sum"]     += wait_ms
+        _observe(t["wait_histogram_ms"], wait_ms)
+
+    def _tier_stats(self) -> dict:
+        out = {}
+        for name, t in self._tiers.items():
+            queued = t["admitted_queued"]
+            out[name] = {
+                "queue_depth":       t["queue_depth"],
+                "admitted":          t["admitted"],
+                "admitted_queued":   queued,
+                "rejected":          t["rejected"],
+                "timed_out":         t["timed_out"],
+                "wait_ms_avg":       round(t["wait_ms_sum"] / queued, 1) if queued else 0.0,
+                "wait_histogram_ms": {str(k): v for k, v in t["wait_histogram_ms"].items()},
+            }
+        return out
+
+    def stats(self) -> dict:
+        queued = self._stats["admitted_queued"]
+        return {
+            "capacity_rpm":   self.capacity,
+            "load":           round(self.load(), 4),
+            "in_window":      len(self._admitted),
+            "queue_depth":    self._waiting,
+            "queued_users":   len(self._queues),
+            "max_queue":      self.max_queue,
+            "max_wait_sec":   self.max_wait,
+            "admitted":       self._stats["admitted"],
+            "admitted_queued": queued,
+            "rejected":       self._stats["rejected"],
+            "timed_out":      self._stats["timed_out"],
+            "wait_ms_avg":    round(self._stats["wait_ms_sum"] / queued, 1) if queued else 0.0,
+            "wait_ms_max":    round(self._stats["wait_ms_max"], 1),
+            "wait_histogram_ms": {str(k): v for k, v in self._wait_hist.items()},
+            "tiers":          self._tier_stats(),
+            "local_share":    self.local_share,
+            "cluster":        self.shared.stats() if self.shared is not None else None,
+        }
+
+    # ── Fair queue ──────────────────────────────────────────────────────────
+
+    def _enqueue(self, user: str, tier: str, threshold: float, weight: float) -> _Waiter:
+        now    = self._clock()
+        finish = max(self._vtime, self._last_finish.get(user, 0.0)) + 1.0 / max(weight, 0.01)
+        self._last_finish[user] = finish
+        w = _Waiter(user, tier, threshold, finish, now, now + self.max_wait,
+                    asyncio.get_running_loop().create_future())
+        self._queues.setdefault(user, deque()).append(w)
+        self._waiting += 1
+        self._tier(tier)["queue_depth"] += 1
+        return w
+
+    def _dequeue(self, w: _Waiter):
+        q = self._queues.get(w.user)
+        if q is None:
+            return
+        try:
+            q.remove(w)
+        except ValueError:
+            return
+        self._waiting -= 1
+        self._tier(w.tier)["queue_depth"] -= 1
+        if not q:
+            del self._queues[w.user]
+            if self._last_finish.get(w.user, 0.0) <= self._vtime:
+                self._last_finish.pop(w.user, None)
+
+    def _expire(self, now: float):
+        for q in list(self._queues.values()):
+            # نفس max_wait للجميع + FIFO لكل مستخدم → المنتهي دائماً في الرأس
+            while q and q[0].deadline <= now:
+                w = q[0]
+                self._dequeue(w)
+                self._stats["timed_out"] += 1
+                self._tier(w.tier)["timed_out"] += 1
+                if not w.future.done():
+                    w.future.set_exception(AdmissionRejected("Provider admission wait exceeded"))
+
+    def dispatch(self) -> int:
+        """يقبل المنتظرين بترتيب الوسم الافتراضي ما دامت السعة تسمح؛ يعيد عدد المقبولين."""
+        now = self._clock()
+        self._expire(now)
+        admitted = 0
+        while self._queues:
+            failed_at = None   # أدنى عتبة فشلت — كل رأس عتبته ≤ منها سيفشل أيضاً
+            served    = None
+            for q in sorted(self._queues.values(), key=lambda q: q[0].finish):
+                w = q[0]
+                if failed_at is not None and w.threshold <= failed_at:
+                    continue
+                if self._try_admit(w.threshold):
+                    served = w
+                    break
+                failed_at = w.threshold if failed_at is None else min(failed_at, w.threshold)
+            if served is None:
+                break
+            self._dequeue(served)
+            self._vtime = max(self._vtime, served.finish)
+            self._stats["admitted"] += 1
+            self._tier(served.tier)["admitted"] += 1
+            self._record_wait(served.tier, (now - served.enqueued) * 1000)
+            if not served.future.done():
+                served.future.set_result(True)
+            admitted += 1
+        if len(self._last_finish) > 4 * self.max_queue:
+            self._last_finish = {u: f for u, f in self._last_finish.items()
+                                 if f > self._vtime or u in self._queues}
+        return admitted
+
+    # ── Admission ───────────────────────────────────────────────────────────
+
+    async def acquire(self, is_priority: bool, user: str = None, tier: str = None,
+                      weight: float = 1.0):
+        threshold = PRIORITY_THRESHOLD if is_priority else NORMAL_THRESHOLD
+        user = user or "anonymous"
+        tier = tier or ("priority" if is_priority else "normal")
+
+        # المسار السريع: لا منتظرين → لا طابور
+        if self._waiting == 0 and self._try_admit(threshold):
+            self._stats["admitted"] += 1
+            self._tier(tier)["admitted"] += 1
+            return
+
+        if self.capacity <= 0 or self._waiting >= self.max_queue:
+            self._stats["rejected"] += 1
+            self._tier(tier)["rejected"] += 1
+            raise AdmissionRejected("Provider admission queue is full")
+
+        w = self._enqueue(user, tier, threshold, weight)
+        try:
+            while not w.future.done():
+                self.dispatch()
+                if w.future.done():
+                    break
+                timeout = min(self._seconds_until_next_free(), w.deadline - self._clock())
+                try:
+                    await asyncio.wait_for(asyncio.shield(w.future), timeout=max(timeout, 0.005))
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            self._dequeue(w)
+            if w.future.done() and not w.future.cancelled():
+                w.future.exception()   # رفض سابق لم يعد له من يقرأه
+            raise
+        w.future.result()
+
+    def try_acquire(self, is_priority: bool = False, threshold: float = None) -> bool:
+        """قبول فوري بدون انتظار — للطلبات الإضافية (تحوّط، دفعات) التي يمكن تأجيلها."""
+        if self._waiting:
+            return False
+        if threshold is None:
+            threshold = PRIORITY_THRESHOLD if is_priority else NORMAL_THRESHOLD
+        if self._try_admit(threshold):
+            self._stats["admitted"] += 1
+            return True
+        return False
+
+    async def notify_capacity(self):
+        """عند تغيّر السعة أو تحرير خانة يدوياً — يقبل من أصبح مسموحاً فوراً."""
+        self.dispatch()
+
+    async def set_capacity(self, capacity_rpm: int):
+        self.capacity = capacity_rpm
+        await self.notify_capacity()
@@ -0,0 +1,523 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from database import get_user_by_api_key, get_redis
+from services.admission import BATCH_THRESHOLD
+from services.limits import check_request_allowance
+from services.providers import (
+    smart_chat_stream, provider_admission, estimate_tokens, MODEL_MAPPING, HIDDEN_MODELS,
+)
+from services.completion import collect_completion
+from services.metrics_pipeline import track_request_metrics
+
+router = APIRouter()
+
+# ============================================================================
+# OFFLINE BATCHES — /v1/batches (ملف JSONL يُعالج في السعة الفائضة)
+# ============================================================================
+#  العميل يرفع ملف JSONL (سطر لكل طلب chat.completions بصيغة OpenAI Batch:
+#  {"custom_id", "method", "url", "body"} — أو body مباشرة) ويحصل على batch id.
+#  عامل في الخلفية يعالج العناصر بالترتيب، لكن فقط عندما يكون حمل النظام تحت
+#  BATCH_THRESHOLD (أقل من عتبة الحركة العادية) ولا يوجد أحد في طابور القبول —
+#  الحركة التفاعلية لها الأولوية دائماً.
+#
+#  التخزين في Redis:
+#    batch:{id}         → سجل الدفعة (JSON)
+#    batch:{id}:input   → قائمة الطلبات
+#    batch:{id}:output  → قائمة النتائج بنفس الترتيب — طولها = المؤشر
+#    batch:{id}:charged → custom_id العناصر التي خُصمت حصتها (لا تُخصم مرتين إذا
+#                         فقد عامل القفل وأعاد آخر تنفيذ العنصر)
+#  المؤشر مشتق من طول output، لذا الاستئناف بعد إعادة التشغيل تلقائي: أي عامل
+#  يلتقط الدفعة (قفل SET NX) يكمل من أول عنصر بلا نتيجة.
+#
+#  الحصة مخفّضة: كل عنصر يستهلك BATCH_QUOTA_RATIO من طلب يومي، والتوكنات تُحتسب
+#  بنفس النسبة. عند نفاد الحصة تتوقف الدفعة مؤقتاً وتُستأنف لاحقاً حتى expires_at.
+
+BATCH_MAX_ITEMS      = int(os.environ.get("BATCH_MAX_ITEMS", "10000"))
+BATCH_MAX_BYTES      = int(os.environ.get("BATCH_MAX_BYTES", str(20 * 1024 * 1024)))
+BATCH_CONCURRENCY    = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_QUOTA_RATIO    = float(os.environ.get("BATCH_QUOTA_RATIO", "0.5"))
+BATCH_POLL_SEC       = 2.0
+BATCH_WINDOW_SEC     = 24 * 3600
+BATCH_RETENTION_SEC  = 7 * 24 * 3600
+BATCH_QUOTA_RETRY    = 300            # ثوانٍ قبل إعادة المحاولة بعد نفاد الحصة
+BATCH_LOCK_SEC       = 60
+BATCH_HEARTBEAT_SEC  = BATCH_LOCK_SEC / 4   # تمديد القفل أثناء تنفيذ العناصر
+BATCH_PUSH_CHUNK     = 200
+BATCH_ENDPOINT       = "/v1/chat/completions"
+
+_ACTIVE_KEY = "batches:active"
+_TERMINAL   = ("completed", "failed", "expired", "cancelled")
+_PRIVATE    = ("email", "quota_credit", "retry_at")
+
+
+def _key(batch_id: str, suffix: str = "") -> str:
+    return f"batch:{batch_id}{':' + suffix if suffix else ''}"
+
+
+def _public(job: dict) -> dict:
+    return {k: v for k, v in job.items() if k not in _PRIVATE}
+
+
+def _load_job(r, batch_id: str) -> dict | None:
+    raw = r.get(_key(batch_id))
+    if not raw:
+        return None
+    return json.loads(raw) if isinstance(raw, str) else raw
+
+
+def _save_job(r, job: dict, ttl: int = None):
+    if ttl:
+        r.setex(_key(job["id"]), ttl, json.dumps(job))
+    else:
+        r.set(_key(job["id"]), json.dumps(job))
+
+
+def _auth(request: Request):
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    return get_user_by_api_key(auth_header.split(" ", 1)[1])
+
+
+def _err(message: str, status: int, code: str = "invalid_request"):
+    return JSONResponse({"error": {"message": message, "code": code}}, status_code=status)
+
+# ============================================================================
+# PARSING
+# ============================================================================
+
+def parse_batch_file(raw: bytes) -> tuple:
+    """(العناصر المطبّعة، رسالة خطأ أو None) — الخطأ يذكر رقم السطر."""
+    items, seen = [], set()
+    for n, line in enumerate(raw.decode("utf-8", errors="replace").splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            return None, f"line {n}: invalid JSON"
+        if not isinstance(obj, dict):
+            return None, f"line {n}: expected a JSON object"
+        body = obj.get("body", obj if "messages" in obj else None)
+        if not isinstance(body, dict) or not isinstance(body.get("messages"), list) or not body.get("model"):
+            return None, f"line {n}: body must include model and messages"
+        if obj.get("url", BATCH_ENDPOINT) != BATCH_ENDPOINT:
+            return None, f"line {n}: only {BATCH_ENDPOINT} is supported"
+        if body["model"] in HIDDEN_MODELS:
+            return None, f"line {n}: model '{body['model']}' unavailable"
+        custom_id = str(obj.get("custom_id") or f"request-{n}")
+        if custom_id in seen:
+            return None, f"line {n}: duplicate custom_id '{custom_id}'"
+        seen.add(custom_id)
+        body = {k: v for k, v in body.items() if k not in ("stream", "cache")}
+        items.append({"custom_id": custom_id, "body": body})
+        if len(items) > BATCH_MAX_ITEMS:
+            return None, f"too many requests (max {BATCH_MAX_ITEMS})"
+    if not items:
+        return None, "batch file is empty"
+    return items, None
+
+# ============================================================================
+# WORKER
+# ============================================================================
+
+class BatchWorker:
+    def __init__(self, redis_getter=get_redis, poll_sec: float = BATCH_POLL_SEC,
+                 concurrency: int = BATCH_CONCURRENCY):
+        self._get_redis  = redis_getter
+        self.poll_sec    = poll_sec
+        self.concurrency = concurrency
+        self._worker_id  = uuid.uuid4().hex[:12]
+        self._task       = None
+        self._stats      = {"items_ok": 0, "items_failed": 0, "deferred_capacity": 0,
+                            "paused_quota": 0, "jobs_completed": 0, "lock_lost": 0}
+
+    # ── Locking (عامل واحد لكل دفعة على مستوى العنقود) ──────────────────────
+
+    def _lock(self, r, batch_id: str) -> bool:
+        key = _key(batch_id, "lock")
+        try:
+            if r.set(key, self._worker_id, nx=True, ex=BATCH_LOCK_SEC):
+                return True
+            return r.get(key) == self._worker_id
+        except Exception:
+            return False
+
+    def _owns_lock(self, r, batch_id: str) -> bool:
+        try:
+            return r.get(_key(batch_id, "lock")) == self._worker_id
+        except Exception:
+            return False
+
+    def _refresh_lock(self, r, batch_id: str) -> bool:
+        """يمدد القفل إن كان ما زال لهذا العامل؛ False = انتهى وأخذه عامل آخر."""
+        if not self._owns_lock(r, batch_id):
+            return False
+        try:
+            r.expire(_key(batch_id, "lock"), BATCH_LOCK_SEC)
+            return True
+        except Exception:
+            return False
+
+    async def _heartbeat(self, r, batch_id: str):
+        # العناصر قد تستغرق أكثر من BATCH_LOCK_SEC (نماذج تفكير، max_tokens كبير) —
+        # بدون تمديد دوري ينتهي القفل ويبدأ عامل آخر نفس العناصر
+        while True:
+            await asyncio.sleep(BATCH_HEARTBEAT_SEC)
+            if not self._refresh_lock(r, batch_id):
+                print(f"[Batch] {batch_id} lock lost")
+                return
+
+    def _unlock(self, r, batch_id: str):
+        try:
+            if r.get(_key(batch_id, "lock")) == self._worker_id:
+                r.delete(_key(batch_id, "lock"))
+        except Exception:
+            pass
+
+    # ── Items ───────────────────────────────────────────────────────────────
+
+    async def _run_item(self, job: dict, item: dict) -> tuple:
+        """(النتيجة، دلتا المقاييس) — المقاييس تُسجَّل مع كتابة النتيجة فقط، لا هنا."""
+        body  = dict(item["body"], stream=True)
+        model = body["model"]
+        prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in body["messages"]
+                            if isinstance(m.get("content"), str))
+        result = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": item["custom_id"],
+                  "response": None, "error": None}
+        t0 = time.time()
+        try:
+            # بدون مستخدم: smart_chat_stream لا يسجل شيئاً — التسجيل (بالخصم المخفّض) هنا فقط
+            agg = await collect_completion(smart_chat_stream(body, None), model, prompt_tokens)
+        except Exception as e:
+            agg, error = None, str(e)
+        else:
+            error = "upstream_error" if agg.failed else None
+
+        model_key = MODEL_MAPPING.get(model, "unknown")
+        latency_ms = int((time.time() - t0) * 1000)
+        if error:
+            result["error"] = {"code": "upstream_error", "message": error}
+            result["response"] = {"status_code": 502, "request_id": result["id"], "body": None}
+            self._stats["items_failed"] += 1
+            return result, (latency_ms, int(prompt_tokens * BATCH_QUOTA_RATIO), model_key, True)
+
+        completion = agg.result()
+        result["response"] = {"status_code": 200, "request_id": result["id"], "body": completion}
+        tokens = completion.get("usage", {}).get("total_tokens", prompt_tokens)
+        self._stats["items_ok"] += 1
+        return result, (latency_ms, int(tokens * BATCH_QUOTA_RATIO), model_key, False)
+
+    async def _take_quota(self, job: dict, model: str) -> bool:
+        """كل عنصر = BATCH_QUOTA_RATIO من طلب؛ يُحجز طلب كامل من الحصة عند نفاد الرصيد."""
+        if job["quota_credit"] < BATCH_QUOTA_RATIO - 1e-9:
+            allowed, _ = await check_request_allowance(job["email"], model)
+            if not allowed:
+                return False
+            job["quota_credit"] += 1.0
+        job["quota_credit"] -= BATCH_QUOTA_RATIO
+        return True
+
+    def _finish(self, r, job: dict, status: str):
+        now = int(time.time())
+        job["status"] = status
+        job[f"{status}_at"] = now
+        _save_job(r, job, BATCH_RETENTION_SEC)
+        for suffix in ("input", "output", "charged"):
+            r.expire(_key(job["id"], suffix), BATCH_RETENTION_SEC)
+        r.srem(_ACTIVE_KEY, job["id"])
+        self._stats["jobs_completed"] += 1
+        print(f"[Batch] {job['id']} {status}: {job['request_counts']}")
+
+    def _fail_remaining(self, r, job: dict, cursor: int, code: str, message: str):
+        total = job["request_counts"]["total"]
+        while cursor < total:
+            raw_items = r.lrange(_key(job["id"], "input"), cursor, cursor + BATCH_PUSH_CHUNK - 1)
+            rows = []
+            for raw in raw_items:
+                item = json.loads(raw) if isinstance(raw, str) else raw
+                rows.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                                        "custom_id": item["custom_id"], "response": None,
+                                        "error": {"code": code, "message": message}}))
+            if not rows:
+                break
+            r.rpush(_key(job["id"], "output"), *rows)
+            job["request_counts"]["failed"] += len(rows)
+            cursor += len(rows)
+
+    async def _process(self, r, batch_id: str):
+        job = _load_job(r, batch_id)
+        if job is None or job["status"] in _TERMINAL:
+            r.srem(_ACTIVE_KEY, batch_id)
+            return
+        now = time.time()
+        cursor = int(r.llen(_key(batch_id, "output")))
+        total  = job["request_counts"]["total"]
+
+        if job["status"] == "cancelling":
+            self._fail_remaining(r, job, cursor, "batch_cancelled", "Batch was cancelled")
+            self._finish(r, job, "cancelled")
+            return
+        if now >= job["expires_at"]:
+            self._fail_remaining(r, job, cursor, "batch_expired", "Batch expired before this request ran")
+            self._finish(r, job, "expired")
+            return
+        if job.get("retry_at") and now < job["retry_at"]:
+            return
+
+        if job["status"] != "in_progress":
+            job["status"] = "in_progress"
+            job["in_progress_at"] = int(now)
+        job.pop("retry_at", None)
+        job.pop("paused_reason", None)
+
+        while cursor < total:
+            # السعة الفائضة فقط — لا انتظار في طابور القبول
+            slots = 0
+            while slots < self.concurrency and provider_admission.try_acquire(threshold=BATCH_THRESHOLD):
+                slots += 1
+            if slots == 0:
+                self._stats["deferred_capacity"] += 1
+                break
+
+            raw_items = r.lrange(_key(batch_id, "input"), cursor, cursor + slots - 1)
+            items = [json.loads(x) if isinstance(x, str) else x for x in raw_items]
+            runnable = []
+            for item in items:
+                if r.sismember(_key(batch_id, "charged"), item["custom_id"]):
+                    # خُصمت حصته في تنفيذ سابق فقد عامله القفل قبل كتابة النتيجة
+                    runnable.append(item)
+                    continue
+                if not await self._take_quota(job, item["body"]["model"]):
+                    job["paused_reason"] = "quota_exceeded"
+                    job["retry_at"] = int(time.time()) + BATCH_QUOTA_RETRY
+                    self._stats["paused_quota"] += 1
+                    break
+                r.sadd(_key(batch_id, "charged"), item["custom_id"])
+                runnable.append(item)
+            if runnable:
+                outcomes = await asyncio.gather(*(self._run_item(job, item) for item in runnable))
+                results = [result for result, _ in outcomes]
+                if not self._owns_lock(r, batch_id):
+                    # عامل آخر أخذ الدفعة — الكتابة هنا تكرر نتائجه وتزيح المؤشر، والمقاييس
+                    # يسجلها العامل الذي يكتب النتائج
+                    self._stats["lock_lost"] += 1
+                    print(f"[Batch] {batch_id} lock lost — discarding {len(results)} results")
+                    return
+                r.rpush(_key(batch_id, "output"), *(json.dumps(x, ensure_ascii=False) for x in results))
+                for _, (latency_ms, tokens, model_key, is_error) in outcomes:
+                    track_request_metrics(job["email"], latency_ms, tokens, model_key=model_key, is_error=is_error)
+                failed = sum(1 for x in results if x["error"])
+                job["request_counts"]["completed"] += len(results) - failed
+                job["request_counts"]["failed"]    += failed
+                cursor += len(results)
+
+            # الإلغاء قد يصل أثناء التنفيذ — اقرأ الحالة من Redis قبل الحفظ
+            latest = _load_job(r, batch_id)
+            if latest and latest["status"] == "cancelling":
+                job["status"] = "cancelling"
+            _save_job(r, job)
+            if job.get("paused_reason") or job["status"] == "cancelling":
+                return
+
+        if cursor >= total:
+            self._finish(r, job, "completed")
+        else:
+            _save_job(r, job)
+
+    # ── Loop ────────────────────────────────────────────────────────────────
+
+    async def tick(self):
+        r = self._get_redis()
+        if r is None:
+            return
+        for batch_id in list(r.smembers(_ACTIVE_KEY) or ()):
+            if not self._lock(r, batch_id):
+                continue
+            heartbeat = asyncio.ensure_future(self._heartbeat(r, batch_id))
+            try:
+                await self._process(r, batch_id)
+            except Exception as e:
+                print(f"[Batch] {batch_id} worker error: {e}")
+            finally:
+                heartbeat.cancel()
+                self._unlock(r, batch_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"[Batch] tick failed: {e}")
+            await asyncio.sleep(self.poll_sec)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # العنصر الجاري يُعاد بعد إعادة التشغيل (المؤشر = طول output)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        r = self._get_redis()
+        try:
+            active = len(r.smembers(_ACTIVE_KEY) or ()) if r is not None else 0
+        except Exception:
+            active = None
+        return {"running": self._task is not None, "active_batches": active,
+                "threshold": BATCH_THRESHOLD, "concurrency": self.concurrency,
+                "quota_ratio": BATCH_QUOTA_RATIO, **self._stats}
+
+
+batch_worker = BatchWorker()
+
+# ============================================================================
+# ENDPOINTS
+# ============================================================================
+
+@router.post("/v1/batches")
+async def create_batch(request: Request):
+    user = _auth(request)
+    if not user:
+        return _err("Invalid Orgteh API Key", 401, "invalid_api_key")
+    r = get_redis()
+    if r is None:
+        return _err("Batch storage unavailable", 503, "unavailable")
+
+    metadata = None
+    if request.headers.get("content-type", "").startswith("multipart/"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or not hasattr(upload, "read"):
+            return _err("multipart field 'file' (JSONL) is required", 400)
+        raw = await upload.read()
+        if form.get("metadata"):
+            try:
+                metadata = json.loads(form["metadata"])
+            except ValueError:
+                return _err("metadata must be JSON", 400)
+    else:
+        raw = await request.body()
+    if len(raw) > BATCH_MAX_BYTES:
+        return _err(f"batch file too large (max {BATCH_MAX_BYTES} bytes)", 413)
+
+    items, error = parse_batch_file(raw)
+    if error:
+        return _err(error, 400)
+
+    now = int(time.time())
+    batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+    job = {
+        "id":             batch_id,
+        "object":         "batch",
+        "endpoint":       BATCH_ENDPOINT,
+        "status":         "validating",
+        "created_at":     now,
+        "in_progress_at": None,
+        "expires_at":     now + BATCH_WINDOW_SEC,
+        "completed_at":   None,
+        "request_counts": {"total": len(items), "completed": 0, "failed": 0},
+        "metadata":       metadata,
+        "email":          user["email"],
+        "quota_credit":   0.0,
+    }
+    for i in range(0, len(items), BATCH_PUSH_CHUNK):
+        r.rpush(_key(batch_id, "input"),
+                *(json.dumps(x, ensure_ascii=False) for x in items[i:i + BATCH_PUSH_CHUNK]))
+    _save_job(r, job)
+    r.sadd(_ACTIVE_KEY, batch_id)
+    r.lpush(f"batches:user:{user['email']}", batch_id)
+    r.ltrim(f"batches:user:{user['email']}", 0, 99)
+    return JSONResponse(_public(job))
+
+
+@router.get("/v1/batches")
+async def list_batches(request: Request):
+    user = _auth(request)
+    if not user:
+        return _err("Invalid Orgteh API Key", 401, "invalid_api_key")
+    r = get_redis()
+    if r is None:
+        return _err("Batch storage unavailable", 503, "unavailable")
+    data = []
+    for batch_id in r.lrange(f"batches:user:{user['email']}", 0, 99) or ():
+        job = _load_job(r, batch_id)
+        if job is not None:
+            data.append(_public(job))
+    return JSONResponse({"object": "list", "data": data})
+
+
+def _owned_job(request: Request, batch_id: str):
+    user = _auth(request)
+    if not user:
+        return None, None, _err("Invalid Orgteh API Key", 401, "invalid_api_key")
+    r = get_redis()
+    if r is None:
+        return None, None, _err("Batch storage unavailable", 503, "unavailable")
+    job = _load_job(r, batch_id)
+    if job is None or job.get("email") != user["email"]:
+        return None, None, _err("Batch not found", 404, "not_found")
+    return r, job, None
+
+
+@router.get("/v1/batches/{batch_id}")
+async def get_batch(request: Request, batch_id: str):
+    _, job, error = _owned_job(request, batch_id)
+    return error or JSONResponse(_public(job))
+
+
+@router.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(request: Request, batch_id: str):
+    r, job, error = _owned_job(request, batch_id)
+    if error:
+        return error
+    if job["status"] not in _TERMINAL:
+        job["status"] = "cancelling"
+        job["cancelling_at"] = int(time.time())
+        _save_job(r, job)
+    return JSONResponse(_public(job))
+
+
+@router.get("/v1/batches/{batch_id}/results")
+async def batch_results(request: Request, batch_id: str):
+    """النتائج المكتملة حتى الآن كـ JSONL؛ ?include_pending=1 يضيف سطراً لكل عنصر لم يُعالج."""
+    r, job, error = _owned_job(request, batch_id)
+    if error:
+        return error
+    include_pending = request.query_params.get("include_pending") in ("1", "true")
+
+    async def lines():
+        start = 0
+        while True:
+            chunk = r.lrange(_key(batch_id, "output"), start, start + BATCH_PUSH_CHUNK - 1)
+            if not chunk:
+                break
+            for row in chunk:
+                yield (row if isinstance(row, str) else json.dumps(row)).encode("utf-8") + b"\n"
+            start += len(chunk)
+        if include_pending:
+            while True:
+                chunk = r.lrange(_key(batch_id, "input"), start, start + BATCH_PUSH_CHUNK - 1)
+                if not chunk:
+                    break
+                for raw in chunk:
+                    item = json.loads(raw) if isinstance(raw, str) else raw
+                    yield json.dumps({"custom_id": item["custom_id"], "status": "pending"}).encode("utf-8") + b"\n"
+                start += len(chunk)
+
+    return StreamingResponse(lines(), media_type="application/jsonl",
+                             headers={"Content-Disposition": f'attachment; filename="{batch_id}_output.jsonl"'})
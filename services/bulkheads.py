@@ -0,0 +1,205 @@
+import time
+import asyncio
+from collections import deque
+
+from services.admission import AdmissionRejected
+
+# ============================================================================
+# PER-MODEL BULKHEADS — حدود تزامن منفصلة لكل نموذج
+# ============================================================================
+#  طابور القبول (admission.py) يعد الطلبات في الدقيقة فقط: بث kimi-k2-thinking
+#  أو deepseek قد يبقى مفتوحاً دقائق بينما llama-8b ينتهي في ثانية، فتستهلك
+#  النماذج البطيئة كل الاتصالات والمفاتيح وتزاحم السريعة. هنا لكل نموذج حوض
+#  in-flight خاص (MODEL_CONCURRENCY_LIMITS) — امتلاء حوض kimi لا يمس llama.
+#
+#  قواعد الفيض (spillover): إذا امتلأ حوض نموذج يستعير خانة من حوض مشترك صغير
+#  (BULKHEAD_SPILL_SLOTS) بشرط ألا يكون النموذج في MODEL_NO_SPILL وألا يتجاوز
+#  وسيط مدة بثه BULKHEAD_SPILL_MAX_SEC — الحوض المشترك للنماذج القصيرة فقط.
+#  غير ذلك ينتظر خانة في حوضه حتى BULKHEAD_MAX_WAIT_SEC ثم BulkheadFull.
+#  الحدود لكل عامل (worker) — ليست مشتركة عبر Redis مثل سعة الـ RPM.
+
+_DURATION_BUCKETS_SEC = (1, 2, 5, 10, 30, 60, 120, 300, 600)
+_DURATION_SAMPLES     = 200
+
+
+class BulkheadFull(AdmissionRejected):
+    """حوض النموذج ممتلئ ولا يُسمح بالفيض ولم تتحرر خانة خلال المهلة."""
+
+
+class _Pool:
+    __slots__ = ("limit", "in_flight", "borrowed", "waiters", "durations", "hist",
+                 "duration_sum", "completed", "waited", "rejected", "spilled")
+
+    def __init__(self, limit: int):
+        self.limit        = limit
+        self.in_flight    = 0
+        self.borrowed     = 0
+        self.waiters      = deque()
+        self.durations    = deque(maxlen=_DURATION_SAMPLES)
+        self.hist         = {b: 0 for b in _DURATION_BUCKETS_SEC}
+        self.hist["inf"]  = 0
+        self.duration_sum = 0.0
+        self.completed    = 0
+        self.waited       = 0
+        self.rejected     = 0
+        self.spilled      = 0
+
+    def median_duration(self) -> float:
+        if not self.durations:
+            return 0.0
+        ordered = sorted(self.durations)
+        return ordered[len(ordered) // 2]
+
+
+class BulkheadLease:
+    __slots__ = ("model", "borrowed", "started", "released")
+
+    def __init__(self, model: str, borrowed: bool, started: float):
+        self.model    = model
+        self.borrowed = borrowed
+        self.started  = started
+        self.released = False
+
+
+class ModelBulkheads:
+    def __init__(self, limits: dict, default_limit: int = 16, spill_slots: int = 8,
+                 no_spill=(), spill_max_sec: float = 20.0, max_wait_sec: float = 10.0,
+                 clock=time.monotonic):
+        self.limits        = dict(limits)
+        self.default_limit = default_limit
+        self.spill_slots   = spill_slots
+        self.no_spill      = set(no_spill)
+        self.spill_max_sec = spill_max_sec
+        self.max_wait      = max_wait_sec
+        self._clock        = clock
+        self._pools        = {}
+        self._spill_in_use = 0
+
+    def _pool(self, model: str) -> _Pool:
+        p = self._pools.get(model)
+        if p is None:
+            p = self._pools[model] = _Pool(self.limits.get(model, self.default_limit))
+        return p
+
+    def can_spill(self, model: str) -> bool:
+        if model in self.no_spill:
+            return False
+        return self._pool(model).median_duration() <= self.spill_max_sec
+
+    def _try_take(self, model: str, p: _Pool):
+        if p.in_flight - p.borrowed < p.limit:
+            p.in_flight += 1
+            return BulkheadLease(model, False, self._clock())
+        if self._spill_in_use < self.spill_slots and self.can_spill(model):
+            self._spill_in_use += 1
+            p.in_flight += 1
+            p.borrowed  += 1
+            p.spilled   += 1
+            return BulkheadLease(model, True, self._clock())
+        return None
+
+    async def acquire(self, model: str) -> BulkheadLease:
+        p = self._pool(model)
+        if not p.waiters:
+            lease = self._try_take(model, p)
+            if lease is not None:
+                return lease
+
+        p.waited += 1
+        deadline = self._clock() + self.max_wait
+        loop = asyncio.get_running_loop()
+        while True:
+            fut = loop.create_future()
+            p.waiters.append(fut)
+            try:
+                await asyncio.wait_for(fut, timeout=max(0.0, deadline - self._clock()))
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._wake(p)   # أُوقظنا ثم أُلغينا — نمرر الإيقاظ للتالي
+                raise
+            finally:
+                if fut in p.waiters:
+                    p.waiters.remove(fut)
+            lease = self._try_take(model, p)
+            if lease is not None:
+                self._wake(p)   # ربما تبقت خانة أخرى للمنتظر التالي
+                return lease
+            if self._clock() >= deadline:
+                p.rejected += 1
+                raise BulkheadFull(f"Model {model} is at its concurrency limit")
+
+    @staticmethod
+    def _wake(p: _Pool):
+        while p.waiters:
+            fut = p.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+    def release(self, lease: BulkheadLease):
+        if lease is None or lease.released:
+            return
+        lease.released = True
+        p = self._pool(lease.model)
+        p.in_flight -= 1
+        duration = self._clock() - lease.started
+        p.durations.append(duration)
+        p.duration_sum += duration
+        p.completed    += 1
+        for b in _DURATION_BUCKETS_SEC:
+            if duration <= b:
+                p.hist[b] += 1
+                break
+        else:
+            p.hist["inf"] += 1
+
+        if lease.borrowed:
+            p.borrowed -= 1
+            self._spill_in_use -= 1
+            # خانة مشتركة تحررت — أول حوض منتظر مسموح له بالفيض
+            for model, other in self._pools.items():
+                if other.waiters and self.can_spill(model):
+                    self._wake(other)
+                    break
+        self._wake(p)
+
+    def stats(self) -> dict:
+        models = {}
+        for model, p in self._pools.items():
+            models[model] = {
+                "limit":            p.limit,
+                "in_flight":        p.in_flight,
+                "borrowed":         p.borrowed,
+                "waiting":          len(p.waiters),
+                "completed":        p.completed,
+                "waited":           p.waited,
+                "rejected":         p.rejected,
+                "spilled":          p.spilled,
+                "can_spill":        self.can_spill(model),
+                "duration_avg_sec": round(p.duration_sum / p.completed, 2) if p.completed else 0.0,
+                "duration_p50_sec": round(p.median_duration(), 2),
+                "duration_histogram_sec": {str(k): v for k, v in p.hist.items()},
+            }
+        return {
+            "default_limit": self.default_limit,
+            "spill_slots":   self.spill_slots,
+            "spill_in_use":  self._spill_in_use,
+            "spill_max_sec": self.spill_max_sec,
+            "no_spill":      sorted(self.no_spill),
+            "max_wait_sec":  self.max_wait,
+            "models":        models,
+        }
+
+
+def parse_limits(value: str) -> dict:
+    """kimi=6,deepseek=8 → {"kimi": 6, "deepseek": 8}؛ الإدخالات غير الصالحة تُتجاهل."""
+    limits = {}
+    for part in (value or "").split(","):
+        name, _, num = part.partition("=")
+        try:
+            limits[name.strip()] = max(1, int(num))
+        except ValueError:
+            continue
+    return limits
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+from collections import deque
+
+# ============================================================================
+# CIRCUIT BREAKERS — قاطع لكل نموذج NVIDIA (closed / open / half-open)
+# ============================================================================
+#  closed    : الطلبات تمر؛ نسبة الأخطاء/المهل في آخر CB_WINDOW_SEC تُراقب محلياً.
+#  open      : النموذج متعطل → الطلبات تذهب مباشرة لنموذج الطوارئ بلا انتظار مهلة.
+#  half-open : بعد انتهاء فترة الفتح يُسمح بطلب تجريبي واحد كل CB_PROBE_SEC
+#              (قفل SET NX في Redis → تجربة واحدة على مستوى العنقود)؛
+#              CB_CLOSE_AFTER نجاحات تغلق القاطع، وأي فشل يعيد فتحه بمدة مضاعفة.
+#  حالة الفتح تُكتب في Redis فيراها كل العمال؛ القراءة مُخزّنة محلياً ثانية واحدة.
+#  بدون Redis يعمل كل عامل بقاطع محلي.
+
+CB_FAILURE_RATE  = float(os.environ.get("CB_FAILURE_RATE", "0.5"))
+CB_MIN_REQUESTS  = int(os.environ.get("CB_MIN_REQUESTS", "10"))
+CB_CONSECUTIVE   = 5          # أخطاء متتالية تفتح القاطع حتى دون الحد الأدنى للطلبات
+CB_WINDOW_SEC    = 30.0
+CB_OPEN_SEC      = float(os.environ.get("CB_OPEN_SEC", "30"))
+CB_MAX_OPEN_SEC  = 300.0
+CB_PROBE_SEC     = 5.0
+CB_CLOSE_AFTER   = 2
+CB_SYNC_SEC      = 1.0
+CB_KEY_PREFIX    = "circuit"
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class _Breaker:
+    __slots__ = ("outcomes", "consecutive", "open_until", "opens",
+                 "probe_successes", "last_probe", "synced_at", "trips")
+
+    def __init__(self):
+        self.outcomes        = deque()    # (ts, ok)
+        self.consecutive     = 0
+        self.open_until      = None       # wall time؛ None = مغلق
+        self.opens           = 0          # عدد مرات الفتح المتتالية (للمضاعفة)
+        self.probe_successes = 0
+        self.last_probe      = 0.0
+        self.synced_at       = 0.0
+        self.trips           = 0
+
+
+class CircuitBreakers:
+    def __init__(self, redis_getter=None, clock=time.monotonic, wall_clock=time.time):
+        self._get_redis = redis_getter
+        self._clock     = clock
+        self._wall      = wall_clock
+        self._breakers  = {}
+        self._stats     = {"short_circuited": 0, "probes": 0}
+
+    def _b(self, model: str) -> _Breaker:
+        b = self._breakers.get(model)
+        if b is None:
+            b = self._breakers[model] = _Breaker()
+        return b
+
+    def _redis(self):
+        return self._get_redis() if self._get_redis else None
+
+    # ── Shared state ────────────────────────────────────────────────────────
+
+    def _sync(self, model: str, b: _Breaker):
+        now = self._clock()
+        if now - b.synced_at < CB_SYNC_SEC:
+            return
+        b.synced_at = now
+        r = self._redis()
+        if r is None:
+            return
+        try:
+            raw = r.get(f"{CB_KEY_PREFIX}:{model}")
+        except Exception:
+            return
+        if raw:
+            data = json.loads(raw)
+            if b.open_until is None or data["open_until"] > b.open_until:
+                b.open_until = data["open_until"]
+                b.opens      = data.get("opens", 1)
+                b.probe_successes = 0
+        elif b.open_until is not None and b.open_until <= self._wall():
+            # عامل آخر أغلق القاطع بعد تجارب ناجحة
+            self._close(b)
+
+    def _publish(self, model: str, b: _Breaker):
+        r = self._redis()
+        if r is None:
+            return
+        try:
+            if b.open_until is None:
+                r.delete(f"{CB_KEY_PREFIX}:{model}")
+            else:
+                ttl = int(b.open_until - self._wall() + CB_MAX_OPEN_SEC)
+                r.setex(f"{CB_KEY_PREFIX}:{model}", max(ttl, 1),
+                        json.dumps({"open_until": b.open_until, "opens": b.opens}))
+        except Exception as e:
+            print(f"[Circuit] publish failed for {model}: {e}")
+
+    def _try_probe_lock(self, model: str, b: _Breaker) -> bool:
+        r = self._redis()
+        if r is not None:
+            try:
+                return bool(r.set(f"{CB_KEY_PREFIX}:{model}:probe", "1", nx=True, ex=int(CB_PROBE_SEC)))
+            except Exception:
+                pass
+        now = self._clock()
+        if now - b.last_probe >= CB_PROBE_SEC:
+            b.last_probe = now
+            return True
+        return False
+
+    def _count_probe_success(self, model: str, b: _Breaker) -> int:
+        """نجاحات التجربة تُعد على مستوى العنقود — كل عامل قد ينفذ تجربة مختلفة."""
+        b.probe_successes += 1
+        r = self._redis()
+        if r is None:
+            return b.probe_successes
+        key = f"{CB_KEY_PREFIX}:{model}:ok"
+        try:
+            n = int(r.incr(key))
+            if n == 1:
+                r.expire(key, int(CB_MAX_OPEN_SEC))
+            return n
+        except Exception:
+            return b.probe_successes
+
+    def _reset_probe_count(self, model: str):
+        r = self._redis()
+        if r is None:
+            return
+        try:
+            r.delete(f"{CB_KEY_PREFIX}:{model}:ok")
+        except Exception:
+            pass
+
+    # ── Transitions ─────────────────────────────────────────────────────────
+
+    def _prune(self, b: _Breaker, now: float):
+        cutoff = now - CB_WINDOW_SEC
+        while b.outcomes and b.outcomes[0][0] <= cutoff:
+            b.outcomes.popleft()
+
+    def _state(self, b: _Breaker) -> str:
+        if b.open_until is None:
+            return CLOSED
+        return OPEN if self._wall() < b.open_until else HALF_OPEN
+
+    def _trip(self, model: str, b: _Breaker, reason: str):
+        b.opens += 1
+        b.trips += 1
+        duration = min(CB_MAX_OPEN_SEC, CB_OPEN_SEC * (2 ** (b.opens - 1)))
+        b.open_until = self._wall() + duration
+        b.probe_successes = 0
+        b.outcomes.clear()
+        b.consecutive = 0
+        print(f"[Circuit] OPEN {model} for {duration:.0f}s ({reason})")
+        self._publish(model, b)
+        self._reset_probe_count(model)
+
+    def _close(self, b: _Breaker):
+        b.open_until = None
+        b.opens = 0
+        b.probe_successes = 0
+        b.outcomes.clear()
+        b.consecutive = 0
+
+    # ── Public API ──────────────────────────────────────────────────────────
+
+    def allow(self, model: str) -> bool:
+        """هل نرسل للنموذج الآن؟ False = اذهب مباشرة لنموذج الطوارئ."""
+        b = self._b(model)
+        self._sync(model, b)
+        state = self._state(b)
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._try_probe_lock(model, b):
+            self._stats["probes"] += 1
+            return True
+        self._stats["short_circuited"] += 1
+        return False
+
+    def record_success(self, model: str):
+        b = self._b(model)
+        state = self._state(b)
+        if state == HALF_OPEN:
+            if self._count_probe_success(model, b) >= CB_CLOSE_AFTER:
+                print(f"[Circuit] CLOSED {model}")
+                self._close(b)
+                self._publish(model, b)
+                self._reset_probe_count(model)
+            return
+        if state == CLOSED:
+            now = self._clock()
+            b.outcomes.append((now, True))
+            b.consecutive = 0
+            self._prune(b, now)
+
+    def record_failure(self, model: str):
+        b = self._b(model)
+        state = self._state(b)
+        if state == HALF_OPEN:
+            self._trip(model, b, "probe failed")
+            return
+        if state == OPEN:
+            return
+
+        now = self._clock()
+        b.outcomes.append((now, False))
+        b.consecutive += 1
+        self._prune(b, now)
+
+        if b.consecutive >= CB_CONSECUTIVE:
+            self._trip(model, b, f"{b.consecutive} consecutive failures")
+            return
+        total = len(b.outcomes)
+        if total >= CB_MIN_REQUESTS:
+            failures = sum(1 for _, ok in b.outcomes if not ok)
+            if failures / total >= CB_FAILURE_RATE:
+                self._trip(model, b, f"{failures}/{total} failed in {CB_WINDOW_SEC:.0f}s")
+
+    def snapshot(self) -> dict:
+        now_wall = self._wall()
+        models = {}
+        for model, b in self._breakers.items():
+            self._sync(model, b)
+            failures = sum(1 for _, ok in b.outcomes if not ok)
+            models[model] = {
+                "state":          self._state(b),
+                "open_for_sec":   round(max(0.0, b.open_until - now_wall), 1) if b.open_until else 0.0,
+                "window_total":   len(b.outcomes),
+                "window_failures": failures,
+                "consecutive":    b.consecutive,
+                "trips":          b.trips,
+            }
+        return {"models": models, **self._stats}
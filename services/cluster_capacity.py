@@ -0,0 +1,324 @@
+import os
+import math
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("cluster_capacity")
+
+# ============================================================================
+# CLUSTER CAPACITY — سعة NVIDIA مشتركة بين كل العمال والنسخ عبر Redis
+# ============================================================================
+#  نافذة منزلقة تقريبية (sliding window counter) بعدادين لكل دقيقة:
+#     التقدير = عدد الدقيقة السابقة × (الجزء المتبقي منها) + عدد الدقيقة الحالية
+#  كل عامل يحجز "دفعة" (lease) من الخانات بـ INCRBY واحد ثم يستهلكها محلياً.
+#   - حجم الدفعة يتكيف لكل عتبة: يبدأ بخانة واحدة، يتضاعف (حتى LEASE_SIZE) إذا
+#     نفدت الدفعة قبل انتهائها، وينصف إذا انتهت وفيها بقية — عامل خامل لا يحجز
+#     أكثر مما يستخدم.
+#   - عند انتهاء الدفعة (LEASE_TTL_SEC) تُعاد بقيتها غير المستخدمة بـ DECRBY،
+#     فلا تبقى خانات محجوزة بلا طلبات في العداد المشترك.
+#   - مسار القبول لا يلمس Redis: try_take يستهلك الدفعة المحلية فقط، وإذا نفدت
+#     يطلب دفعة جديدة من مهمة خلفية واحدة (I/O في thread) ويعيد False. المهمة
+#     بعد كل تحديث تستدعي on_capacity (dispatch في AdmissionController) فيُقبل
+#     المنتظرون فوراً — لا polling لكل منتظر.
+#   - عند امتلاء العنقود يُحسب من العدادين متى ينزل التقدير تحت الحد (تلاشي
+#     الدقيقة السابقة)، ويُعاد الفحص عندها أو بعد LEASE_TTL_SEC على الأكثر (دفعات
+#     عمال آخرين قد تُعاد قبل ذلك) — فحص واحد للعامل، لا لكل منتظر.
+#  أي خطأ في Redis → try_take يعيد None ويعود AdmissionController للحد المحلي
+#  لمدة REDIS_RETRY_SEC قبل المحاولة مرة أخرى.
+
+LEASE_SIZE      = int(os.environ.get("PROVIDER_CAPACITY_LEASE_SIZE", "4"))
+LEASE_TTL_SEC   = 2.0
+MIN_RECHECK_SEC = 0.05
+ESTIMATE_MAX_AGE_SEC = 1.0
+REDIS_RETRY_SEC = 30.0
+KEY_PREFIX      = "provider_cap"
+
+
+class _Lease:
+    __slots__ = ("remaining", "expires", "key", "slot")
+
+    def __init__(self, remaining: int, expires: float, key: str, slot: int):
+        self.remaining = remaining
+        self.expires   = expires
+        self.key       = key
+        self.slot      = slot
+
+
+class ClusterCapacity:
+    def __init__(self, redis_getter, window_sec: float = 60.0,
+                 lease_size: int = LEASE_SIZE, key_prefix: str = KEY_PREFIX,
+                 clock=time.monotonic, wall_clock=time.time):
+        self._get_redis   = redis_getter
+        self.window       = window_sec
+        self.lease_size   = max(1, lease_size)
+        self.key_prefix   = key_prefix
+        self._clock       = clock
+        self._wall        = wall_clock
+        self.on_capacity  = None      # يضبطه AdmissionController — يُستدعى بعد كل تحديث
+
+        self._leases      = {}        # threshold → _Lease
+        self._sizes       = {}        # threshold → حجم الدفعة التالية
+        self._wanted      = set()     # عتبات تنتظر دفعة
+        self._recheck_at  = {}        # threshold → لا نسأل Redis قبل هذا الوقت (العنقود ممتلئ)
+        self._capacity    = 0
+        self._down_until  = 0.0
+        self._last_estimate = None    # (count, at)
+        self._estimate_wanted = False
+        self._task        = None
+        self._event       = None
+
+        self._stats = {"redis_calls": 0, "leased": 0, "given_back": 0, "returned_unused": 0,
+                       "redis_errors": 0, "refreshes": 0}
+
+    # ── Redis window (تُستدعى داخل thread) ─────────────────────────────────
+
+    def _keys(self) -> tuple:
+        now = self._wall()
+        slot = int(now // self.window)
+        frac = (now % self.window) / self.window
+        return slot, f"{self.key_prefix}:{slot - 1}", f"{self.key_prefix}:{slot}", frac
+
+    @staticmethod
+    def _int(value) -> int:
+        try:
+            return int(value or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def _window(self, r, prev_key: str, cur_key: str, frac: float) -> tuple:
+        """(عدد الدقيقة السابقة، وزنها الحالي، عدد الدقيقة الحالية)"""
+        prev, cur = r.mget(prev_key, cur_key)
+        prev = self._int(prev)
+        return prev, prev * (1.0 - frac), self._int(cur)
+
+    def _seconds_until_free(self, prev: int, cur: int, frac: float, limit: float) -> float:
+        """متى ينزل التقدير إلى limit - 1 إذا لم يحجز أحد شيئاً — من تلاشي النافذة فقط."""
+        target = limit - 1
+        left_in_slot = self.window * (1.0 - frac)
+        estimate = prev * (1.0 - frac) + cur
+        if prev > 0:
+            dt = (estimate - target) / (prev / self.window)
+            if dt <= left_in_slot:
+                return dt
+        if cur <= 0:
+            return left_in_slot
+        # بعد بداية الدقيقة التالية تصبح الحالية هي السابقة وتتلاشى
+        return left_in_slot + max(0.0, (cur - target) / (cur / self.window))
+
+    def _lease(self, r, limit: float, size: int) -> dict:
+        """يحجز حتى size خانة من السعة المشتركة."""
+        slot, prev_key, cur_key, frac = self._keys()
+        prev, prev_weighted, cur = self._window(r, prev_key, cur_key, frac)
+        calls = 1
+        want = min(size, int(limit - prev_weighted - cur))
+        if want <= 0:
+            return {"granted": 0, "estimate": prev_weighted + cur, "calls": calls, "given_back": 0,
+                    "wait": self._seconds_until_free(prev, cur, frac, limit)}
+
+        new_cur = self._int(r.incrby(cur_key, want))
+        calls += 1
+        if new_cur == want:
+            r.expire(cur_key, int(self.window * 2) + 5)
+            calls += 1
+
+        # عمال آخرون ربما حجزوا بالتوازي — أعد الزائد فوراً
+        over = math.ceil(prev_weighted + new_cur - limit)
+        give_back = min(want, max(0, over))
+        if give_back:
+            r.decrby(cur_key, give_back)
+            calls += 1
+        granted = want - give_back
+        return {"granted": granted, "key": cur_key, "slot": slot, "calls": calls,
+                "given_back": give_back, "estimate": prev_weighted + new_cur - give_back,
+                "wait": 0.0 if granted else self._seconds_until_free(prev, new_cur - give_back, frac, limit)}
+
+    def _redis_round(self, returns: list, wanted: dict, capacity: int, want_estimate: bool) -> dict:
+        """كل I/O الخاص بدورة تحديث واحدة — يعمل في thread ولا يلمس حالة الكائن."""
+        r = self._get_redis()
+        if r is None:
+            raise RuntimeError("Redis client is not configured")
+        out = {"leases": {}, "calls": 0, "estimate": None}
+        current_slot = self._keys()[0]
+        for key, slot, n in returns:
+            # مفتاح أقدم من النافذة انتهى في Redis — DECRBY كان سيُنشئه سالباً
+            if slot >= current_slot - 1:
+                r.decrby(key, n)
+                out["calls"] += 1
+        for threshold, size in sorted(wanted.items()):
+            res = self._lease(r, capacity * threshold, size)
+            out["calls"] += res["calls"]
+            out["leases"][threshold] = res
+            out["estimate"] = res["estimate"]
+        if out["estimate"] is None and want_estimate:
+            _, prev_key, cur_key, frac = self._keys()
+            _, prev_weighted, cur = self._window(r, prev_key, cur_key, frac)
+            out["calls"] += 1
+            out["estimate"] = prev_weighted + cur
+        return out
+
+    # ── Background refresher ────────────────────────────────────────────────
+
+    def _wake(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self._task is None or self._task.done():
+            # Event مربوط بالـ loop الذي أنشأه — جديد مع كل مهمة
+            self._event = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._event.set()
+        return True
+
+    def _collect_expired(self, now: float) -> list:
+        returns = []
+        for threshold, lease in list(self._leases.items()):
+            if lease.expires > now:
+                continue
+            del self._leases[threshold]
+            if lease.remaining > 0:
+                returns.append((lease.key, lease.slot, lease.remaining))
+                self._stats["returned_unused"] += lease.remaining
+                # الدفعة كانت أكبر من الحاجة
+                self._sizes[threshold] = max(1, self._sizes.get(threshold, 1) // 2)
+        return returns
+
+    def _next_deadline(self):
+        times = [l.expires for l in self._leases.values() if l.remaining > 0]
+        times += [self._recheck_at.get(t, 0.0) for t in self._wanted]
+        return min(times) if times else None
+
+    async def _run(self):
+        while True:
+            deadline = self._next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - self._clock())
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+
+            if not self.available():
+                self._wanted.clear()
+                self._estimate_wanted = False
+                continue
+
+            now = self._clock()
+            returns = self._collect_expired(now)
+            wanted = {t: self._sizes.get(t, 1) for t in self._wanted
+                      if self._recheck_at.get(t, 0.0) <= now}
+            want_estimate = self._estimate_wanted
+            self._estimate_wanted = False
+            if not (returns or wanted or want_estimate):
+                continue
+
+            try:
+                result = await asyncio.to_thread(self._redis_round, returns, wanted,
+                                                 self._capacity, want_estimate)
+            except Exception as e:
+                self._mark_down(e)
+                self._notify()
+                continue
+
+            now = self._clock()
+            self._stats["refreshes"]   += 1
+            self._stats["redis_calls"] += result["calls"]
+            if result["estimate"] is not None:
+                self._last_estimate = (result["estimate"], now)
+            for threshold, res in result["leases"].items():
+                self._stats["given_back"] += res["given_back"]
+                if res["granted"] > 0:
+                    self._stats["leased"] += res["granted"]
+                    self._leases[threshold] = _Lease(res["granted"], now + LEASE_TTL_SEC,
+                                                     res["key"], res["slot"])
+                    self._wanted.discard(threshold)
+                    self._recheck_at.pop(threshold, None)
+                else:
+                    self._recheck_at[threshold] = now + min(max(res["wait"], MIN_RECHECK_SEC), LEASE_TTL_SEC)
+            self._notify()
+
+    def _notify(self):
+        if self.on_capacity is not None:
+            self.on_capacity()
+
+    async def stop(self):
+        """يوقف المهمة الخلفية ويعيد بقية الدفعات المحلية إلى العداد المشترك."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        returns = [(l.key, l.slot, l.remaining) for l in self._leases.values() if l.remaining > 0]
+        self._leases.clear()
+        self._wanted.clear()
+        if returns and self.available():
+            try:
+                await asyncio.to_thread(self._redis_round, returns, {}, self._capacity, False)
+            except Exception as e:
+                logger.warning(f"Cluster capacity: could not return leases on shutdown ({e})")
+
+    # ── Admission hooks (تُستدعى من AdmissionController) ───────────────────
+
+    def available(self) -> bool:
+        return self._get_redis() is not None and self._clock() >= self._down_until
+
+    def _mark_down(self, err: Exception):
+        self._stats["redis_errors"] += 1
+        self._down_until = self._clock() + REDIS_RETRY_SEC
+        self._leases.clear()
+        self._wanted.clear()
+        self._recheck_at.clear()
+        logger.warning(f"Cluster capacity: Redis unavailable, per-process limits for {REDIS_RETRY_SEC:.0f}s ({err})")
+
+    def try_take(self, threshold: float, capacity: int) -> bool | None:
+        """
+        True/False = قرار السعة المشتركة (False = لا دفعة محلية الآن؛ طُلبت دفعة
+        والمنتظرون يُوقظون عبر on_capacity). None = Redis غير متاح → الحد المحلي.
+        """
+        if not self.available():
+            return None
+        self._capacity = capacity
+        now = self._clock()
+
+        # خانة محجوزة مسبقاً تحت نفس العتبة أو أضيق
+        for t, lease in self._leases.items():
+            if t <= threshold and lease.remaining > 0 and lease.expires > now:
+                lease.remaining -= 1
+                return True
+
+        lease = self._leases.get(threshold)
+        if lease is not None and lease.expires > now and threshold not in self._wanted:
+            # نفدت قبل انتهائها — الحمل أعلى من حجم الدفعة
+            self._sizes[threshold] = min(self.lease_size, self._sizes.get(threshold, 1) * 2)
+        self._wanted.add(threshold)
+        if not self._wake():
+            return None
+        return False
+
+    def load(self, capacity: int) -> float | None:
+        """آخر تقدير للحمل على مستوى العنقود (بدون Redis في هذا المسار)، أو None."""
+        if not self.available() or capacity <= 0:
+            return None
+        now = self._clock()
+        if self._last_estimate is None or now - self._last_estimate[1] > ESTIMATE_MAX_AGE_SEC:
+            # يُحدَّث في الخلفية — حتى ذلك نعيد آخر قيمة
+            self._estimate_wanted = True
+            self._wake()
+        if self._last_estimate is None:
+            return None
+        return self._last_estimate[0] / capacity
+
+    def stats(self) -> dict:
+        now = self._clock()
+        return {
+            "backend":          "redis" if self.available() else "local",
+            "lease_size_max":   self.lease_size,
+            "lease_sizes":      {str(t): s for t, s in self._sizes.items()},
+            "leases":           {str(t): l.remaining for t, l in self._leases.items() if l.expires > now},
+            "waiting_for_lease": sorted(self._wanted),
+            "cluster_estimate": round(self._last_estimate[0], 1) if self._last_estimate else None,
+            **self._stats,
+        }
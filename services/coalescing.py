@@ -0,0 +1,154 @@
+import os
+import time
+import asyncio
+
+from services.response_cache import cache_key
+
+# ============================================================================
+# IN-FLIGHT COALESCING — طلب upstream واحد لعدة طلبات متطابقة متزامنة
+# ============================================================================
+#  iframe المعاينة والـ widget يرسلان أحياناً نفس الطلب عدة مرات دفعة واحدة
+#  (إعادة تحميل، عدة تبويبات، حلقات retry). أول طلب يفتح "رحلة" (flight) تضخ
+#  البث من upstream في مخزن إعادة تشغيل؛ الطلبات المطابقة التي تصل أثناءها
+#  تشترك فيها: تستلم ما فات من المخزن ثم الـ chunks الجديدة فور وصولها.
+#
+#  - المفتاح: المسار + المستأجر + sha256 للـ payload القانوني (نفس مفتاح الكاش).
+#  - اختياري لكل مسار: COALESCE_ROUTES (افتراضياً preview,hub,widget).
+#  - الحصة: المتصل الأول يُحتسب داخل smart_chat_stream كالمعتاد؛ كل مشترك لاحق
+#    يُحتسب عبر account(chunks, ttft_ms) عند انتهائه — لا أحد يحصل على رد مجاني.
+#  - الرحلة تُلغى فقط عندما يغادر كل المشتركين؛ مغادرة الأول لا تقطع الباقين.
+#  - بعد COALESCE_MAX_REPLAY_BYTES أو COALESCE_MAX_SUBSCRIBERS لا تقبل الرحلة
+#    مشتركين جدداً (يفتحون رحلتهم الخاصة) — الذاكرة محدودة بحجم رد واحد.
+
+COALESCE_ROUTES           = set(filter(None, os.environ.get("COALESCE_ROUTES", "preview,hub,widget").split(",")))
+COALESCE_MAX_REPLAY_BYTES = int(os.environ.get("COALESCE_MAX_REPLAY_BYTES", str(512 * 1024)))
+COALESCE_MAX_SUBSCRIBERS  = 32
+
+
+def coalesce_key(route: str, tenant: str, payload: dict) -> str:
+    return f"{route}:{tenant}:{cache_key(payload)}"
+
+
+class _Flight:
+    __slots__ = ("key", "chunks", "size", "done", "changed", "subscribers",
+                 "joinable", "task", "started", "ttft_ms")
+
+    def __init__(self, key: str):
+        self.key         = key
+        self.chunks      = []            # مخزن إعادة التشغيل — كل ما وصل حتى الآن
+        self.size        = 0
+        self.done        = False
+        self.changed     = asyncio.Event()
+        self.subscribers = 0
+        self.joinable    = True
+        self.task        = None
+        self.started     = time.time()
+        self.ttft_ms     = 0
+
+    def _notify(self):
+        ev, self.changed = self.changed, asyncio.Event()
+        ev.set()
+
+
+class Coalescer:
+    def __init__(self, routes=None, max_replay_bytes: int = COALESCE_MAX_REPLAY_BYTES,
+                 max_subscribers: int = COALESCE_MAX_SUBSCRIBERS):
+        self.routes           = set(COALESCE_ROUTES if routes is None else routes)
+        self.max_replay_bytes = max_replay_bytes
+        self.max_subscribers  = max_subscribers
+        self._flights         = {}
+        self._stats           = {"flights": 0, "joined": 0, "replayed_chunks": 0,
+                                 "shared_bytes": 0, "cancelled": 0}
+
+    def enabled(self, route: str) -> bool:
+        return route in self.routes
+
+    # ── Upstream pump ───────────────────────────────────────────────────────
+
+    async def _pump(self, f: _Flight, factory):
+        try:
+            async for chunk in factory():
+                if not f.chunks:
+                    f.ttft_ms = int((time.time() - f.started) * 1000)
+                f.chunks.append(chunk)
+                f.size += len(chunk)
+                if f.joinable and f.size > self.max_replay_bytes:
+                    self._close_joining(f)
+                f._notify()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[Coalesce] upstream failed for {f.key[:40]}: {e}")
+        finally:
+            f.done = True
+            self._close_joining(f)
+            f._notify()
+
+    def _close_joining(self, f: _Flight):
+        f.joinable = False
+        if self._flights.get(f.key) is f:
+            del self._flights[f.key]
+
+    # ── Subscribe ───────────────────────────────────────────────────────────
+
+    async def stream(self, route: str, key: str, factory, account=None):
+        """
+        factory: دالة بدون معاملات تعيد async iterator للبث الأصلي (تُستدعى مرة لكل رحلة).
+        account: تُستدعى للمشترك اللاحق فقط بـ (عدد الـ chunks، ttft_ms) لاحتساب حصته.
+        """
+        if not self.enabled(route):
+            async for chunk in factory():
+                yield chunk
+            return
+
+        f = self._flights.get(key)
+        follower = f is not None and f.joinable
+        if follower:
+            self._stats["joined"] += 1
+            self._stats["replayed_chunks"] += len(f.chunks)
+        else:
+            f = _Flight(key)
+            self._flights[key] = f
+            self._stats["flights"] += 1
+            f.task = asyncio.create_task(self._pump(f, factory))
+        f.subscribers += 1
+        if f.subscribers >= self.max_subscribers:
+            self._close_joining(f)
+
+        sent, sent_bytes = 0, 0
+        try:
+            while True:
+                if sent < len(f.chunks):
+                    chunk = f.chunks[sent]
+                    sent += 1
+                    sent_bytes += len(chunk)
+                    yield chunk
+                    continue
+                if f.done:
+                    break
+                await f.changed.wait()
+        finally:
+            f.subscribers -= 1
+            if follower:
+                self._stats["shared_bytes"] += sent_bytes
+                if account is not None and sent:
+                    try:
+                        account(sent, f.ttft_ms)
+                    except Exception as e:
+                        print(f"[Coalesce] accounting failed: {e}")
+            if f.subscribers == 0 and not f.done and f.task is not None:
+                # لم يبق أحد يستمع — لا داعي لإكمال التوليد
+                self._stats["cancelled"] += 1
+                self._close_joining(f)
+                f.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "routes":           sorted(self.routes),
+            "in_flight":        len(self._flights),
+            "max_replay_bytes": self.max_replay_bytes,
+            **self._stats,
+        }
+
+
+coalescer = Coalescer()
@@ -0,0 +1,136 @@
+import time
+import uuid
+
+from services.providers import estimate_tokens
+from services.sse import SSEDecoder
+
+# ============================================================================
+# NON-STREAMING COMPLETIONS — تجميع بث SSE في رد OpenAI واحد
+# ============================================================================
+#  يُغذّى بالـ chunks كما تصل من smart_chat_stream ويحلل كل حدث مرة واحدة:
+#  لا يُحتفظ بالـ chunks ولا بالنص الخام — فقط أجزاء المحتوى نفسها، فالذاكرة
+#  تتناسب مع طول الرد لا مع عدد الـ chunks.
+
+class CompletionAggregator:
+    def __init__(self, model: str, prompt_tokens: int = 0):
+        self.model          = model
+        self.prompt_tokens  = prompt_tokens
+        self.id             = None
+        self.finish_reason  = None
+        self.usage          = None
+        self._content       = []
+        self._reasoning     = []
+        self._tool_calls    = {}      # index → {"id", "type", "function": {"name", "arguments"}}
+        self._decoder       = SSEDecoder()
+
+    # ── Feeding ─────────────────────────────────────────────────────────────
+
+    def feed(self, chunk: bytes):
+        for ev in self._decoder.feed(chunk):
+            self._sse(ev)
+
+    def close(self):
+        for ev in self._decoder.flush():
+            self._sse(ev)
+
+    def _sse(self, ev):
+        if ev.done:
+            return
+        for obj in ev.json_items():
+            self.event(obj)
+
+    def event(self, obj: dict):
+        """حدث SSE واحد بعد فك JSON."""
+        if not isinstance(obj, dict):
+            return
+        if self.id is None and obj.get("id"):
+            self.id = obj["id"]
+        if obj.get("model"):
+            self.model = obj["model"]
+        if obj.get("usage"):
+            self.usage = obj["usage"]
+
+        for choice in obj.get("choices") or ():
+            # بعض المزودين يعيدون رداً غير متدفق رغم stream=true
+            delta = choice.get("delta") or choice.get("message") or {}
+            content = delta.get("content")
+            if content:
+                self._content.append(content)
+            reasoning = delta.get("reasoning_content")
+            if reasoning:
+                self._reasoning.append(reasoning)
+            for call in delta.get("tool_calls") or ():
+                self._merge_tool_call(call)
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+
+    def _merge_tool_call(self, call: dict):
+        idx = call.get("index", len(self._tool_calls))
+        slot = self._tool_calls.get(idx)
+        if slot is None:
+            slot = self._tool_calls[idx] = {
+                "id": call.get("id"), "type": call.get("type", "function"),
+                "function": {"name": "", "arguments": []},
+            }
+        if call.get("id"):
+            slot["id"] = call["id"]
+        fn = call.get("function") or {}
+        if fn.get("name"):
+            slot["function"]["name"] += fn["name"]
+        if fn.get("arguments"):
+            slot["function"]["arguments"].append(fn["arguments"])
+
+    # ── Result ──────────────────────────────────────────────────────────────
+
+    @property
+    def failed(self) -> bool:
+        """smart_chat_stream لا يرفع أخطاء — الفشل = لا محتوى، أو finish_reason=error."""
+        if self.finish_reason == "error":
+            return True
+        return not (self._content or self._reasoning or self._tool_calls)
+
+    def result(self) -> dict:
+        content = "".join(self._content)
+        message = {"role": "assistant", "content": content}
+        if self._reasoning:
+            message["reasoning_content"] = "".join(self._reasoning)
+        if self._tool_calls:
+            message["tool_calls"] = [
+                {**call, "function": {"name": call["function"]["name"],
+                                      "arguments": "".join(call["function"]["arguments"])}}
+                for _, call in sorted(self._tool_calls.items())
+            ]
+
+        usage = self.usage
+        if not usage:
+            reasoning_tokens  = estimate_tokens(message.get("reasoning_content", ""))
+            completion_tokens = estimate_tokens(content) + reasoning_tokens
+            usage = {
+                "prompt_tokens":     self.prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens":      self.prompt_tokens + completion_tokens,
+            }
+            if reasoning_tokens:
+                usage["completion_tokens_details"] = {"reasoning_tokens": reasoning_tokens}
+
+        return {
+            "id":      self.id or f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object":  "chat.completion",
+            "created": int(time.time()),
+            "model":   self.model,
+            "choices": [{
+                "index":         0,
+                "message":       message,
+                "finish_reason": self.finish_reason or ("tool_calls" if self._tool_calls else "stop"),
+            }],
+            "usage": usage,
+        }
+
+
+async def collect_completion(stream, model: str, prompt_tokens: int = 0) -> CompletionAggregator:
+    """يستهلك البث كاملاً ويعيد المُجمِّع (تحقق من .failed قبل .result())."""
+    agg = CompletionAggregator(model, prompt_tokens)
+    async for chunk in stream:
+        agg.feed(chunk if isinstance(chunk, bytes) else str(chunk).encode("utf-8"))
+    agg.close()
+    return agg
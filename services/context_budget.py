@@ -0,0 +1,261 @@
+import os
+import re
+import json
+import time
+import asyncio
+
+import httpx
+
+from services.upstream import upstream_client
+
+# tiktoken يعطي عدّاً حقيقياً (cl100k_base قريب بما يكفي لكل النماذج هنا) — في requirements.txt
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# ============================================================================
+# CONTEXT BUDGET — قص سجل المحادثة قبل إرساله للنموذج
+# ============================================================================
+#  العملاء يرسلون سجلات أطول بكثير مما يلزم، وأحياناً أطول من نافذة النموذج:
+#  ندفع رفعها وزمن الـ prefill أو نفشل متأخرين بخطأ upstream. هنا يُعد كل طلب
+#  بالتوكنات ويُقص ليناسب الميزانية قبل الإرسال.
+#
+#  اختياري لكل طلب عبر حقول لا تُرسل لـ NVIDIA:
+#   "context_strategy": "auto" (افتراضي — يقص فقط ما يتجاوز نافذة النموذج)
+#                       | "trim" | "summarize" | "none"
+#   "max_input_tokens": ميزانية أصغر من النافذة (مع trim/summarize/auto)
+#  رسائل system الأولى وآخر دور (من آخر رسالة user حتى النهاية) تبقى دائماً؛
+#  الأدوار الأقدم تُحذف من الأقدم للأحدث. summarize يستبدل المحذوف بملخص قصير
+#  من نموذج صغير، ويعود للقص إذا فشل الملخص أو تجاوز المهلة. طلب الملخص يمر
+#  بـ provider_admission و key_scheduler مثل أي طلب NVIDIA آخر.
+#
+#  العد: tiktoken (يُحمَّل عند الإقلاع عبر load_tokenizer). إذا تعذر تحميله (الحزمة
+#  غير مثبتة أو ملف الترميز غير متاح بدون شبكة) يُطبع تحذير ونعود لتقدير حسب نوع
+#  الحروف (chars/4 وحده يقلل عدّ العربية إلى الربع تقريباً) — احتياط متعمد لا
+#  يُسقط الخدمة. هامش الأمان نسبة من نافذة النموذج — أكبر مع التقدير — لأن الفرق
+#  عن tokenizer النموذج الفعلي يكبر مع طول السجل.
+
+CONTEXT_OUTPUT_RESERVE   = 1024      # توكنات محجوزة للرد عندما لا يحدد الطلب max_tokens
+CONTEXT_SAFETY_MARGIN    = 256       # أدنى هامش لفرق الـ tokenizer عن tokenizer النموذج الفعلي
+CONTEXT_SAFETY_RATIO     = 0.03      # من النافذة مع tiktoken
+CONTEXT_ESTIMATE_RATIO   = 0.10      # من النافذة مع التقدير
+CONTEXT_TOKENIZER        = os.environ.get("CONTEXT_TOKENIZER_ENCODING", "cl100k_base")
+MESSAGE_OVERHEAD_TOKENS  = 4         # role + فواصل قالب المحادثة لكل رسالة
+SUMMARY_MODEL            = os.environ.get("CONTEXT_SUMMARY_MODEL", "meta/llama-3.2-3b-instruct")
+SUMMARY_MAX_TOKENS       = 300
+SUMMARY_TIMEOUT          = float(os.environ.get("CONTEXT_SUMMARY_TIMEOUT_SEC", "8"))
+SUMMARY_MAX_SOURCE_CHARS = 24000
+
+_STRATEGIES = ("auto", "trim", "summarize", "none")
+
+_ENCODING = None
+_tokenizer_checked = False
+
+
+def load_tokenizer() -> bool:
+    """يحمّل ترميز tiktoken مرة واحدة (قد ينزّل ملف BPE) — يُستدعى عند الإقلاع."""
+    global _ENCODING, _tokenizer_checked
+    if not _tokenizer_checked:
+        _tokenizer_checked = True
+        if tiktoken is not None:
+            try:
+                _ENCODING = tiktoken.get_encoding(CONTEXT_TOKENIZER)
+            except Exception as e:
+                print(f"[Context] tiktoken encoding {CONTEXT_TOKENIZER} failed to load: {e}")
+        if _ENCODING is None:
+            print(f"[Context] WARNING: no real tokenizer — counting with the script-aware estimate "
+                  f"and a {int(CONTEXT_ESTIMATE_RATIO * 100)}% safety margin")
+    return _ENCODING is not None
+
+
+def _safety_ratio() -> float:
+    return CONTEXT_SAFETY_RATIO if load_tokenizer() else CONTEXT_ESTIMATE_RATIO
+
+
+# تقريباً: ASCII ≈ 4 أحرف للتوكن، العربية وبقية الحروف ≈ 2، CJK ≈ 1 (تقدير متحفظ)
+_ARABIC_RE = re.compile(r"[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]")
+_CJK_RE    = re.compile(r"[\u3040-\u30FF\u3400-\u4DBF\u4E00-\u9FFF\uAC00-\uD7AF]")
+
+
+def _estimate_tokens(text: str) -> int:
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    arabic = len(text) - len(_ARABIC_RE.sub("", text))
+    cjk    = len(text) - len(_CJK_RE.sub("", text))
+    other  = len(text) - ascii_chars - arabic - cjk
+    return -(-(ascii_chars + 2 * arabic + 4 * cjk + 2 * other) // 4)
+
+
+def count_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if load_tokenizer():
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return _estimate_tokens(text)
+
+
+def _content_text(content) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):   # أجزاء متعددة الوسائط — النص فقط
+        return " ".join(p.get("text", "") for p in content if isinstance(p, dict))
+    return ""
+
+
+def count_message_tokens(message: dict) -> int:
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_text_tokens(_content_text(message.get("content")))
+    if message.get("tool_calls"):
+        tokens += count_text_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+    return tokens
+
+
+class ContextBudget:
+    def __init__(self, windows: dict, default_window: int = 32768):
+        self.windows        = dict(windows)
+        self.default_window = default_window
+        self._stats         = {"checked": 0, "trimmed": 0, "summarized": 0, "summary_failed": 0,
+                               "messages_dropped": 0, "tokens_removed": 0, "over_budget_kept": 0}
+
+    def budget_for(self, body: dict, max_input_tokens: int = None) -> int:
+        window  = self.windows.get(body.get("model"), self.default_window)
+        reserve = int(body.get("max_tokens") or CONTEXT_OUTPUT_RESERVE)
+        margin  = max(CONTEXT_SAFETY_MARGIN, int(window * _safety_ratio()))
+        budget  = window - reserve - margin
+        if max_input_tokens:
+            budget = min(budget, int(max_input_tokens))
+        return max(budget, 1)
+
+    @staticmethod
+    def _split(messages: list) -> tuple:
+        """(رسائل system الأولى، الوسط القابل للحذف، آخر دور)."""
+        head = 0
+        while head < len(messages) and messages[head].get("role") == "system":
+            head += 1
+        tail = len(messages) - 1
+        while tail > head and messages[tail].get("role") != "user":
+            tail -= 1
+        tail = max(tail, head)
+        return messages[:head], messages[head:tail], messages[tail:]
+
+    def _fit(self, system: list, middle: list, latest: list, budget: int) -> tuple:
+        """أحدث جزء من الوسط يناسب الميزانية؛ يعيد (المحتفظ به، المحذوف)."""
+        used = sum(count_message_tokens(m) for m in system + latest)
+        keep_from = len(middle)
+        for i in range(len(middle) - 1, -1, -1):
+            cost = count_message_tokens(middle[i])
+            if used + cost > budget:
+                break
+            used += cost
+            keep_from = i
+        kept = middle[keep_from:]
+        # ردود أدوات بلا رسالة assistant التي طلبتها ترفضها النماذج
+        while kept and kept[0].get("role") == "tool":
+            kept = kept[1:]
+        dropped = middle[:len(middle) - len(kept)]
+        return kept, dropped
+
+    async def apply(self, body: dict) -> dict:
+        """يزيل حقول الخيارات من body ويعيده كما هو، أو نسخة برسائل مقصوصة إن لزم."""
+        strategy   = body.pop("context_strategy", "auto")
+        max_input  = body.pop("max_input_tokens", None)
+        messages   = body.get("messages")
+        if strategy not in _STRATEGIES:
+            strategy = "auto"
+        if strategy == "none" or not isinstance(messages, list) or len(messages) < 2:
+            return body
+        try:
+            max_input = int(max_input) if max_input else None
+        except (TypeError, ValueError):
+            max_input = None
+
+        self._stats["checked"] += 1
+        budget = self.budget_for(body, max_input)
+        total  = sum(count_message_tokens(m) for m in messages)
+        if total <= budget:
+            return body
+
+        system, middle, latest = self._split(messages)
+        kept, dropped = self._fit(system, middle, latest, budget)
+        if not dropped:
+            # system + آخر دور وحدهما يتجاوزان الميزانية — لا نحذف ما يجب الاحتفاظ به
+            self._stats["over_budget_kept"] += 1
+            return body
+
+        summary = None
+        if strategy == "summarize":
+            summary = await self._summarize(dropped)
+            if summary:
+                note = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+                # مكان الملخص يأتي من نفس الميزانية
+                kept, more = self._fit(system + [note], kept, latest, budget)
+                dropped += more
+                system = system + [note]
+                self._stats["summarized"] += 1
+            else:
+                self._stats["summary_failed"] += 1
+
+        new_messages = system + kept + latest
+        self._stats["trimmed"]          += 1
+        self._stats["messages_dropped"] += len(dropped)
+        self._stats["tokens_removed"]   += total - sum(count_message_tokens(m) for m in new_messages)
+        trimmed = dict(body)
+        trimmed["messages"] = new_messages
+        return trimmed
+
+    async def _summarize(self, dropped: list) -> str:
+        from services.providers import NVIDIA_BASE_URL, key_scheduler, provider_admission
+        from services.key_scheduler import parse_retry_after
+
+        transcript = "\n".join(
+            f"{m.get('role', 'user')}: {_content_text(m.get('content'))}" for m in dropped
+        )[-SUMMARY_MAX_SOURCE_CHARS:]
+        deadline = time.monotonic() + SUMMARY_TIMEOUT
+        try:
+            # خانة من نفس السعة — الانتظار جزء من مهلة الملخص، وبعدها قص عادي
+            await asyncio.wait_for(
+                provider_admission.acquire(is_priority=False, user="context-summary", tier="context"),
+                timeout=SUMMARY_TIMEOUT,
+            )
+        except Exception as e:
+            print(f"[Context] no capacity for summary, falling back to trim: {e!r}")
+            return ""
+
+        api_key = key_scheduler.acquire() or "no-key"
+        t0 = time.time()
+        try:
+            async with upstream_client("nvidia", timeout=max(1.0, deadline - time.monotonic())) as client:
+                resp = await client.post(
+                    f"{NVIDIA_BASE_URL}/chat/completions",
+                    headers={"Authorization": f"Bearer {api_key}"},
+                    json={
+                        "model": SUMMARY_MODEL,
+                        "messages": [
+                            {"role": "system", "content": "Summarize this conversation in a few sentences. "
+                                                          "Keep names, numbers, decisions and open questions."},
+                            {"role": "user", "content": transcript},
+                        ],
+                        "max_tokens": SUMMARY_MAX_TOKENS,
+                        "temperature": 0.2,
+                        "stream": False,
+                    },
+                )
+            if resp.status_code == 429:
+                key_scheduler.record_failure(api_key, "rate_limit",
+                                             retry_after=parse_retry_after(resp.headers.get("Retry-After")))
+            elif resp.status_code >= 500:
+                key_scheduler.record_failure(api_key, "server_error")
+            resp.raise_for_status()
+            key_scheduler.record_success(api_key, ttft_ms=(time.time() - t0) * 1000)
+            return (resp.json()["choices"][0]["message"].get("content") or "").strip()
+        except Exception as e:
+            if not isinstance(e, httpx.HTTPStatusError):
+                key_scheduler.record_failure(api_key, "error")
+            print(f"[Context] summary failed, falling back to trim: {e}")
+            return ""
+        finally:
+            key_scheduler.release(api_key)
+
+    def stats(self) -> dict:
+        real = load_tokenizer()
+        return {"tokenizer": f"tiktoken/{CONTEXT_TOKENIZER}" if real else "estimate (script-aware)",
+                "safety_ratio": _safety_ratio(), "windows": self.windows, **self._stats}
@@ -0,0 +1,86 @@
+import asyncio
+
+# ============================================================================
+# CLIENT DISCONNECT — إلغاء التوليد فور إغلاق العميل لاتصال البث
+# ============================================================================
+#  StreamingResponse لا يكتشف الانقطاع إلا عند فشل الكتابة التالية (ASGI 2.4)،
+#  ولا يغلق المولّد صراحة — فيستمر سحب NVIDIA حتى نهاية الرد دون قارئ.
+#  cancel_on_disconnect يراقب http.disconnect بمهمة واحدة بالتوازي مع البث، وعند
+#  وصوله يلغي المهمة المستهلكة عند الانتظار الجاري داخل المولّد (CancelledError)
+#  فتُغلق اتصالات upstream في finally الخاص بها ويُحرَّر المفتاح، ويُسجَّل
+#  الاستخدام الجزئي. مع ASGI < 2.4 يفعل Starlette ذلك بنفسه فلا نراقب.
+
+
+class DisconnectStats:
+    def __init__(self):
+        self._routes = {}
+
+    def record(self, route: str, tokens_generated: int, tokens_saved: int):
+        """tokens_saved تقدير أعلى: max_tokens المطلوبة ناقص ما وُلِّد قبل الإلغاء."""
+        s = self._routes.get(route)
+        if s is None:
+            s = self._routes[route] = {"cancelled": 0, "tokens_generated": 0, "tokens_saved_est": 0}
+        s["cancelled"]        += 1
+        s["tokens_generated"] += tokens_generated
+        s["tokens_saved_est"] += max(0, tokens_saved)
+
+    def stats(self) -> dict:
+        total = {"cancelled": 0, "tokens_generated": 0, "tokens_saved_est": 0}
+        for s in self._routes.values():
+            for k in total:
+                total[k] += s[k]
+        return {"routes": self._routes, **total}
+
+
+disconnect_stats = DisconnectStats()
+
+
+def _server_listens(request) -> bool:
+    """
+    مع ASGI < 2.4 يستمع StreamingResponse نفسه لـ http.disconnect ويلغي البث —
+    مستمع ثانٍ على receive() سيتنافس معه على نفس الرسائل.
+    """
+    version = request.scope.get("asgi", {}).get("spec_version", "2.0")
+    try:
+        return tuple(map(int, version.split("."))) < (2, 4)
+    except ValueError:
+        return True
+
+
+async def _cancel_on(request, task: asyncio.Task, state: dict):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            state["disconnected"] = True
+            task.cancel()
+            return
+
+
+async def cancel_on_disconnect(request, stream):
+    """يمرر البث كما هو؛ إذا انقطع العميل يُلغى المولّد الأصلي فوراً."""
+    if request is None or _server_listens(request):
+        # بدون طلب، أو الخادم يلغي البث بنفسه عند الانقطاع
+        async for chunk in stream:
+            yield chunk
+        return
+
+    # ASGI 2.4: لا أحد يقرأ receive() أثناء البث — مراقب واحد يلغي المهمة المستهلكة
+    # (الانتظار الجاري داخل المولّد الأصلي) بدل مهمة لكل chunk
+    state = {"disconnected": False}
+    task = asyncio.current_task()
+    watcher = asyncio.ensure_future(_cancel_on(request, task, state))
+    try:
+        async for chunk in stream:
+            yield chunk
+    except asyncio.CancelledError:
+        if not state["disconnected"]:
+            raise
+        # الإلغاء منّا وليس من الخادم — انتهاء عادي للاستجابة بدل خطأ في السجل
+        task.uncancel()
+    finally:
+        watcher.cancel()
+        if hasattr(stream, "aclose"):
+            try:
+                await stream.aclose()
+            except (Exception, asyncio.CancelledError):
+                pass
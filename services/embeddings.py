@@ -0,0 +1,254 @@
+import os
+import time
+import base64
+import asyncio
+from datetime import datetime
+
+import numpy as np
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+from database import get_user_by_api_key, get_redis
+from services.upstream import upstream_client
+from services.admission import AdmissionRejected
+from services.providers import NVIDIA_BASE_URL, estimate_tokens, key_scheduler, provider_admission
+from services.key_scheduler import parse_retry_after
+from services.limits import ADMIN_EMAIL, has_active_paid_subscription
+from services.metrics_pipeline import track_request_metrics
+
+router = APIRouter()
+
+# ============================================================================
+# EMBEDDINGS — /v1/embeddings متوافق مع OpenAI + تجميع الطلبات المتزامنة
+# ============================================================================
+#  عملاء RAG يرسلون آلاف القطع، غالباً طلباً لكل قطعة وبالتوازي. بدل طلب NVIDIA
+#  لكل منها، كل النصوص التي تصل خلال EMBED_BATCH_WINDOW_MS (لنفس النموذج
+#  ونفس input_type/truncate) تُرسل في طلب upstream واحد حتى EMBED_MAX_BATCH نص؛
+#  النصوص المكررة داخل الدفعة تُضمَّن مرة واحدة.
+#  كل طلب upstream يمر بـ provider_admission (خانة من سعة NVIDIA المشتركة) ويأخذ
+#  مفتاحاً من key_scheduler (in-flight + 429/أخطاء المفتاح) مثل طلبات المحادثة.
+#
+#  الحصة: عدد النصوص يومياً لكل مفتاح (مجاني / مدفوع) عبر عداد Redis.
+#  encoding_format: "float" (افتراضي) أو "base64" (float32 little-endian كـ OpenAI).
+
+EMBED_DEFAULT_MODEL   = "nvidia/llama-3.2-nemoretriever-300m-embed-v2"
+EMBED_MODELS          = {EMBED_DEFAULT_MODEL}
+EMBED_BATCH_WINDOW_MS = float(os.environ.get("EMBED_BATCH_WINDOW_MS", "10"))
+EMBED_MAX_BATCH       = int(os.environ.get("EMBED_MAX_BATCH", "64"))
+EMBED_MAX_INPUTS      = 2048        # لكل طلب — نفس حد OpenAI
+EMBED_MAX_CHARS       = 32000       # لكل نص
+EMBED_DAILY_FREE      = int(os.environ.get("EMBED_DAILY_LIMIT_FREE", "1000"))
+EMBED_DAILY_PAID      = int(os.environ.get("EMBED_DAILY_LIMIT_PAID", "100000"))
+EMBED_TIMEOUT         = 30.0
+
+
+class EmbeddingBatcher:
+    def __init__(self, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_MAX_BATCH):
+        self.window    = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._pending  = {}        # (model, input_type, truncate) → [(text, future)]
+        self._timers   = {}
+        self._stats    = {"requests": 0, "inputs": 0, "upstream_calls": 0,
+                          "deduplicated": 0, "errors": 0, "rejected": 0}
+
+    async def embed(self, texts: list, model: str = EMBED_DEFAULT_MODEL,
+                    input_type: str = "query", truncate: str = "END") -> list:
+        """متجه كامل لكل نص بنفس الترتيب (قد تُرسل مع نصوص طلبات أخرى)."""
+        loop = asyncio.get_running_loop()
+        group = (model, input_type, truncate)
+        futures = []
+        for text in texts:
+            fut = loop.create_future()
+            self._pending.setdefault(group, []).append((text, fut))
+            futures.append(fut)
+            if len(self._pending[group]) >= self.max_batch:
+                self._flush_now(group)
+        if self._pending.get(group) and group not in self._timers:
+            self._timers[group] = loop.call_later(self.window, self._flush_now, group)
+        self._stats["requests"] += 1
+        self._stats["inputs"]   += len(texts)
+        return await asyncio.gather(*futures)
+
+    def _flush_now(self, group: tuple):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(group, [])
+        while batch:
+            part, batch = batch[:self.max_batch], batch[self.max_batch:]
+            asyncio.ensure_future(self._send(group, part))
+
+    async def _post(self, unique: list, model: str, input_type: str, truncate: str) -> dict:
+        """طلب upstream واحد: خانة قبول + مفتاح مجدول، ويُحرَّر المفتاح دائماً."""
+        await provider_admission.acquire(is_priority=False, user="embeddings", tier="embeddings")
+        api_key = key_scheduler.acquire() or "no-key"
+        t0 = time.time()
+        try:
+            try:
+                async with upstream_client("nvidia", timeout=EMBED_TIMEOUT) as client:
+                    resp = await client.post(
+                        f"{NVIDIA_BASE_URL}/embeddings",
+                        headers={"Authorization": f"Bearer {api_key}"},
+                        json={"input": unique, "model": model, "input_type": input_type,
+                              "encoding_format": "float", "truncate": truncate},
+                    )
+            except Exception:
+                key_scheduler.record_failure(api_key, "error")
+                raise
+            if resp.status_code == 429:
+                key_scheduler.record_failure(api_key, "rate_limit",
+                                             retry_after=parse_retry_after(resp.headers.get("Retry-After")))
+            elif resp.status_code >= 500:
+                key_scheduler.record_failure(api_key, "server_error")
+            elif resp.status_code == 200:
+                key_scheduler.record_success(api_key, ttft_ms=(time.time() - t0) * 1000)
+            resp.raise_for_status()
+            return resp.json()
+        finally:
+            key_scheduler.release(api_key)
+
+    async def _send(self, group: tuple, part: list):
+        model, input_type, truncate = group
+        unique = list(dict.fromkeys(text for text, _ in part))
+        self._stats["deduplicated"] += len(part) - len(unique)
+        self._stats["upstream_calls"] += 1
+        try:
+            data = await self._post(unique, model, input_type, truncate)
+            rows = sorted(data["data"], key=lambda d: d.get("index", 0))
+            vectors = {text: row["embedding"] for text, row in zip(unique, rows)}
+            if len(vectors) != len(unique):
+                raise ValueError(f"upstream returned {len(rows)} vectors for {len(unique)} inputs")
+        except Exception as e:
+            self._stats["rejected" if isinstance(e, AdmissionRejected) else "errors"] += 1
+            for _, fut in part:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for text, fut in part:
+            if not fut.done():
+                fut.set_result(vectors[text])
+
+    def stats(self) -> dict:
+        calls = self._stats["upstream_calls"]
+        return {"window_ms": self.window * 1000, "max_batch": self.max_batch,
+                "avg_inputs_per_call": round(self._stats["inputs"] / calls, 2) if calls else 0.0,
+                **self._stats}
+
+
+embedding_batcher = EmbeddingBatcher()
+
+# ============================================================================
+# QUOTA — نصوص يومياً لكل مفتاح
+# ============================================================================
+
+def _daily_limit(email: str) -> int:
+    if email == ADMIN_EMAIL:
+        return 0          # بلا حد
+    return EMBED_DAILY_PAID if has_active_paid_subscription(email) else EMBED_DAILY_FREE
+
+
+def _reserve_quota(email: str, count: int) -> tuple:
+    """(مسموح، المتبقي). بدون Redis يُسمح بالطلب — نفس سلوك بقية الحدود."""
+    limit = _daily_limit(email)
+    r = get_redis()
+    if not limit or r is None:
+        return True, None
+    key = f"embed_quota:{email}:{datetime.utcnow().date()}"
+    try:
+        used = int(r.incrby(key, count))
+        if used == count:
+            r.expire(key, 26 * 3600)
+        if used > limit:
+            r.decrby(key, count)
+            return False, max(0, limit - (used - count))
+        return True, limit - used
+    except Exception:
+        return True, None
+
+
+def _release_quota(email: str, count: int):
+    r = get_redis()
+    if r is None or not _daily_limit(email):
+        return
+    try:
+        r.decrby(f"embed_quota:{email}:{datetime.utcnow().date()}", count)
+    except Exception:
+        pass
+
+
+def _encode(vector: list, fmt: str):
+    if fmt == "base64":
+        return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+    return vector
+
+# ============================================================================
+# ENDPOINT
+# ============================================================================
+
+def _err(message: str, status: int, code: str = "invalid_request"):
+    return JSONResponse({"error": {"message": message, "code": code}}, status_code=status)
+
+
+@router.post("/v1/embeddings")
+async def create_embeddings(request: Request):
+    auth_header = request.headers.get("Authorization", "")
+    user = get_user_by_api_key(auth_header.split(" ", 1)[1]) if auth_header.startswith("Bearer ") else None
+    if not user:
+        return _err("Invalid Orgteh API Key", 401, "invalid_api_key")
+
+    try:
+        body = await request.json()
+    except Exception:
+        return _err("Invalid JSON", 400)
+
+    inputs = body.get("input")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs or not all(isinstance(x, str) and x for x in inputs):
+        return _err("input must be a non-empty string or array of non-empty strings", 400)
+    if len(inputs) > EMBED_MAX_INPUTS:
+        return _err(f"too many inputs (max {EMBED_MAX_INPUTS})", 400)
+    if any(len(x) > EMBED_MAX_CHARS for x in inputs):
+        return _err(f"input too long (max {EMBED_MAX_CHARS} characters)", 400)
+
+    model = body.get("model") or EMBED_DEFAULT_MODEL
+    if model not in EMBED_MODELS:
+        return _err(f"Model '{model}' is not an embedding model", 404, "model_not_found")
+    fmt = body.get("encoding_format", "float")
+    if fmt not in ("float", "base64"):
+        return _err("encoding_format must be 'float' or 'base64'", 400)
+    input_type = body.get("input_type", "query")
+    if input_type not in ("query", "passage"):
+        return _err("input_type must be 'query' or 'passage'", 400)
+    truncate = body.get("truncate", "END")
+    if truncate not in ("NONE", "START", "END"):
+        return _err("truncate must be NONE, START or END", 400)
+
+    email = user["email"]
+    allowed, remaining = _reserve_quota(email, len(inputs))
+    if not allowed:
+        return _err(f"Daily embedding quota exceeded ({remaining} inputs left today)", 429, "quota_exceeded")
+
+    t0 = time.time()
+    try:
+        vectors = await embedding_batcher.embed(inputs, model, input_type, truncate)
+    except AdmissionRejected:
+        _release_quota(email, len(inputs))
+        return _err("System is currently at maximum capacity. Please try again in a few seconds.",
+                    503, "capacity_exceeded")
+    except Exception as e:
+        _release_quota(email, len(inputs))
+        print(f"[Embeddings] upstream failed: {e}")
+        return _err("Embedding provider error", 502, "upstream_error")
+
+    tokens = sum(max(1, estimate_tokens(x)) for x in inputs)
+    track_request_metrics(email, int((time.time() - t0) * 1000), tokens, model_key="embed")
+
+    headers = {"X-Embed-Quota-Remaining": str(remaining)} if remaining is not None else None
+    return JSONResponse({
+        "object": "list",
+        "data":   [{"object": "embedding", "index": i, "embedding": _encode(v, fmt)}
+                   for i, v in enumerate(vectors)],
+        "model":  model,
+        "usage":  {"prompt_tokens": tokens, "total_tokens": tokens},
+    }, headers=headers)
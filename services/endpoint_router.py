@@ -0,0 +1,211 @@
+import os
+import json
+import time
+from collections import deque
+
+from services.upstream import register_upstream
+
+# ============================================================================
+# ENDPOINT ROUTER — عدة upstreams متوافقة مع OpenAI لكل نموذج منطقي
+# ============================================================================
+#  MODEL_MAPPING يربط كل نموذج عام بنموذج NVIDIA واحد — أي تباطؤ في NVIDIA يصيب
+#  كل الحركة. هنا يمكن لكل نموذج أن يملك endpoints إضافية (base_url ومفتاح
+#  ومعرّف نموذج خاص بكل منها)، و NVIDIA يبقى دائماً endpoint "nvidia" المدمج.
+#
+#  الاختيار لكل طلب: أقل score حيث
+#     score = EWMA(TTFT) × (1 + ERROR_PENALTY × معدل الأخطاء) ÷ السعة المتبقية
+#  - endpoint بلا عينات أو لم يُقَس منذ EXPLORE_SEC يأخذ الطلب التالي كقياس
+#    (طلب واحد فقط لكل فترة) — بدون عشوائية، قابل للاختبار بساعة محاكاة.
+#  - 429 أو أخطاء متتالية → تبريد قصير يُستبعد فيه.
+#  - السعة المتبقية: rpm المحدد لكل endpoint؛ لـ nvidia من طابور القبول.
+#
+#  الإعداد (JSON في MODEL_ENDPOINTS أو ملف في MODEL_ENDPOINTS_FILE):
+#   {"meta/llama-3.3-70b-instruct": [
+#       {"name": "together", "base_url": "https://api.together.xyz/v1",
+#        "api_key_env": "TOGETHER_API_KEY", "model": "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+#        "rpm": 600}]}
+
+BUILTIN_ENDPOINT   = "nvidia"
+EWMA_ALPHA         = 0.2
+DEFAULT_TTFT_SEC   = 1.0
+EXPLORE_SEC        = 30.0
+ERROR_PENALTY      = 4.0
+OUTCOME_WINDOW_SEC = 60.0
+FAILURE_STREAK     = 3
+COOLDOWN_SEC       = 10.0
+MIN_REMAINING      = 0.05
+
+
+class Endpoint:
+    def __init__(self, name: str, base_url: str = None, api_keys=(), model: str = None,
+                 rpm: int = None, builtin: bool = False):
+        self.name        = name
+        self.base_url    = (base_url or "").rstrip("/")
+        self.api_keys    = list(api_keys)
+        self.model       = model
+        self.rpm         = rpm
+        self.builtin     = builtin
+        self.pool        = f"ep:{name}"
+        self.ewma_ttft   = None
+        self.last_sample = None
+        self.outcomes    = deque()        # (ts, ok)
+        self.requests    = deque()        # ts
+        self.in_flight   = 0
+        self.streak      = 0
+        self.cooldown    = 0.0
+        self.total       = 0
+        self.errors      = 0
+        self._key_idx    = 0
+
+    def next_key(self) -> str:
+        if not self.api_keys:
+            return "no-key"
+        key = self.api_keys[self._key_idx % len(self.api_keys)]
+        self._key_idx += 1
+        return key
+
+    def upstream_model(self, logical_model: str) -> str:
+        return self.model or logical_model
+
+
+class EndpointRouter:
+    def __init__(self, config: dict, builtin_remaining=None, clock=time.monotonic):
+        """builtin_remaining: دالة تعيد السعة المتبقية (0..1) لـ nvidia."""
+        self._clock             = clock
+        self._builtin_remaining = builtin_remaining
+        self._models            = {}
+        for logical, entries in (config or {}).items():
+            endpoints = [Endpoint(BUILTIN_ENDPOINT, builtin=True)]
+            for e in entries:
+                keys = e.get("api_keys") or [e.get("api_key") or os.environ.get(e.get("api_key_env", ""), "")]
+                if isinstance(keys, str):
+                    keys = keys.split(",")
+                ep = Endpoint(e["name"], e["base_url"], [k.strip() for k in keys if k and k.strip()],
+                              e.get("model"), e.get("rpm"))
+                register_upstream(ep.pool)
+                endpoints.append(ep)
+            self._models[logical] = {ep.name: ep for ep in endpoints}
+
+    def has_endpoints(self, model: str) -> bool:
+        return model in self._models
+
+    # ── Scoring ─────────────────────────────────────────────────────────────
+
+    def _prune(self, ep: Endpoint, now: float):
+        cutoff = now - OUTCOME_WINDOW_SEC
+        while ep.outcomes and ep.outcomes[0][0] <= cutoff:
+            ep.outcomes.popleft()
+        while ep.requests and ep.requests[0] <= cutoff:
+            ep.requests.popleft()
+
+    def _error_rate(self, ep: Endpoint) -> float:
+        if not ep.outcomes:
+            return 0.0
+        return sum(1 for _, ok in ep.outcomes if not ok) / len(ep.outcomes)
+
+    def _remaining(self, ep: Endpoint) -> float:
+        if ep.builtin:
+            if self._builtin_remaining is None:
+                return 1.0
+            return max(0.0, min(1.0, self._builtin_remaining()))
+        if not ep.rpm:
+            return 1.0
+        return max(0.0, 1.0 - len(ep.requests) / ep.rpm)
+
+    def score(self, ep: Endpoint, now: float = None) -> float:
+        now = self._clock() if now is None else now
+        self._prune(ep, now)
+        ttft = DEFAULT_TTFT_SEC if ep.ewma_ttft is None else ep.ewma_ttft
+        return ttft * (1 + ERROR_PENALTY * self._error_rate(ep)) / max(self._remaining(ep), MIN_REMAINING)
+
+    def pick(self, model: str, exclude=()) -> Endpoint:
+        """أفضل endpoint متاح للنموذج، أو None إن لم تكن له endpoints إضافية."""
+        endpoints = self._models.get(model)
+        if not endpoints:
+            return None
+        now = self._clock()
+        candidates = [ep for ep in endpoints.values()
+                      if ep.name not in exclude and ep.cooldown <= now
+                      and (ep.builtin or self._remaining(ep) > 0)]
+        if not candidates:
+            candidates = [ep for ep in endpoints.values() if ep.name not in exclude]
+        if not candidates:
+            return None
+        stale = [ep for ep in candidates
+                 if ep.last_sample is None or now - ep.last_sample > EXPLORE_SEC]
+        if stale:
+            # قياس: يُحجز حتى لا يذهب كل الطلبات المتزامنة للـ endpoint غير المقاس
+            best = stale[0]
+            best.last_sample = now
+        else:
+            best = min(candidates, key=lambda ep: self.score(ep, now))
+        return best
+
+    def acquire(self, ep: Endpoint):
+        """
+        يُستدعى من المحاولة نفسها عند بدئها (لا في pick): محاولة أُلغيت قبل أن تبدأ
+        لا تصل إلى finally الذي يستدعي release، فيتسرب in_flight.
+        """
+        if ep is not None and not ep.builtin:
+            ep.requests.append(self._clock())
+            ep.in_flight += 1
+
+    # ── Outcomes ────────────────────────────────────────────────────────────
+
+    def record(self, model: str, name: str, ttft_sec: float = None, ok: bool = True,
+               rate_limited: bool = False):
+        ep = (self._models.get(model) or {}).get(name)
+        if ep is None:
+            return
+        now = self._clock()
+        ep.total += 1
+        ep.outcomes.append((now, ok))
+        if ok:
+            ep.streak = 0
+            if ttft_sec is not None:
+                ep.ewma_ttft = ttft_sec if ep.ewma_ttft is None else \
+                    EWMA_ALPHA * ttft_sec + (1 - EWMA_ALPHA) * ep.ewma_ttft
+                ep.last_sample = now
+            return
+        ep.errors += 1
+        ep.streak += 1
+        if rate_limited or ep.streak >= FAILURE_STREAK:
+            ep.cooldown = now + COOLDOWN_SEC
+
+    def release(self, ep: Endpoint):
+        if ep is not None and ep.in_flight > 0:
+            ep.in_flight -= 1
+
+    def stats(self) -> dict:
+        now = self._clock()
+        out = {}
+        for model, endpoints in self._models.items():
+            out[model] = {
+                name: {
+                    "base_url":       ep.base_url or None,
+                    "upstream_model": ep.upstream_model(model),
+                    "score":          round(self.score(ep, now), 4),
+                    "ewma_ttft_ms":   round(ep.ewma_ttft * 1000, 1) if ep.ewma_ttft is not None else None,
+                    "error_rate_1m":  round(self._error_rate(ep), 3),
+                    "remaining":      round(self._remaining(ep), 3),
+                    "in_flight":      ep.in_flight,
+                    "cooldown_sec":   round(max(0.0, ep.cooldown - now), 1),
+                    "total":          ep.total,
+                    "errors":         ep.errors,
+                }
+                for name, ep in endpoints.items()
+            }
+        return out
+
+
+def load_endpoint_config() -> dict:
+    raw = os.environ.get("MODEL_ENDPOINTS", "")
+    path = os.environ.get("MODEL_ENDPOINTS_FILE", "")
+    try:
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return json.loads(raw) if raw else {}
+    except Exception as e:
+        print(f"[Endpoints] invalid MODEL_ENDPOINTS config: {e}")
+        return {}
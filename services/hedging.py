@@ -0,0 +1,82 @@
+import os
+import time
+from collections import deque
+
+# ============================================================================
+# HEDGED REQUESTS — طلب احتياطي موازٍ إذا تأخر أول chunk
+# ============================================================================
+#  بعد HEDGE_DELAY_SEC (لكل نموذج) بدون أول chunk يُطلق طلب ثانٍ (مفتاح آخر أو
+#  نموذج الطوارئ) ويُبث أيهما يصل أولاً ويُلغى الآخر.
+#  HedgeBudget يضمن ألا تتجاوز الطلبات الاحتياطية HEDGE_MAX_PCT% من الطلبات
+#  الأصلية خلال آخر دقيقة — فلا يتحول التحوّط نفسه إلى عاصفة 429.
+
+HEDGE_MAX_PCT       = float(os.environ.get("HEDGE_MAX_PCT", "10"))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DELAY_SEC", "1.2"))
+# "fallback": الاحتياطي على نموذج الطوارئ (البطء غالباً من النموذج نفسه)
+# "key":      نفس النموذج بمفتاح آخر (عند وجود أكثر من مفتاح)
+HEDGE_TARGET        = os.environ.get("HEDGE_TARGET", "fallback")
+
+# نماذج التفكير تبدأ أبطأ بطبيعتها — تأخير أطول قبل التحوّط
+HEDGE_DELAY_SEC = {
+    "moonshotai/kimi-k2-thinking":                  2.0,
+    "deepseek-ai/deepseek-v3.2":                    1.8,
+    "mistralai/mistral-large-3-675b-instruct-2512": 1.5,
+    "meta/llama-3.2-3b-instruct":                   0.8,
+}
+
+
+def hedge_delay(model_id: str) -> float:
+    return HEDGE_DELAY_SEC.get(model_id, HEDGE_DEFAULT_DELAY)
+
+
+class HedgeBudget:
+    def __init__(self, max_pct: float = HEDGE_MAX_PCT, window_sec: float = 60.0,
+                 clock=time.monotonic):
+        self.max_ratio = max(0.0, max_pct) / 100
+        self.window    = window_sec
+        self._clock    = clock
+        self._primary  = deque()
+        self._hedges   = deque()
+        self._stats    = {"primary": 0, "hedged": 0, "denied": 0, "no_capacity": 0, "hedge_wins": 0}
+
+    def _prune(self, now: float):
+        cutoff = now - self.window
+        for q in (self._primary, self._hedges):
+            while q and q[0] <= cutoff:
+                q.popleft()
+
+    def record_primary(self):
+        self._primary.append(self._clock())
+        self._stats["primary"] += 1
+
+    def try_spend(self, admit=None) -> bool:
+        """
+        admit: قبول السعة (provider_admission.try_acquire) — يُستدعى فقط إذا سمحت
+        الميزانية، ولا تُخصم الميزانية إلا إذا قُبل؛ وإلا يضيع رصيد تحوّط لم يُرسل.
+        """
+        now = self._clock()
+        self._prune(now)
+        if len(self._hedges) + 1 > self.max_ratio * len(self._primary):
+            self._stats["denied"] += 1
+            return False
+        if admit is not None and not admit():
+            self._stats["no_capacity"] += 1
+            return False
+        self._hedges.append(now)
+        self._stats["hedged"] += 1
+        return True
+
+    def record_win(self):
+        self._stats["hedge_wins"] += 1
+
+    def stats(self) -> dict:
+        self._prune(self._clock())
+        return {
+            "max_pct":          self.max_ratio * 100,
+            "window_primary":   len(self._primary),
+            "window_hedges":    len(self._hedges),
+            "target":           HEDGE_TARGET,
+            "default_delay_sec": HEDGE_DEFAULT_DELAY,
+            "delays_sec":       dict(HEDGE_DELAY_SEC),
+            **self._stats,
+        }
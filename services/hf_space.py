@@ -0,0 +1,162 @@
+import os
+import time
+import asyncio
+from collections import deque
+
+from services.upstream import upstream_client
+from services.sse import aiter_sse
+
+# ============================================================================
+# HUGGINGFACE SPACE (qwen-mini) — عميل مجمّع + إبقاء الـ Space مستيقظاً
+# ============================================================================
+#  الـ Space خادم صغير واحد ينام بعد فترة خمول؛ الإيقاظ يستغرق عشرات الثواني
+#  والطلب معلق بلا أي إشارة للعميل. هنا:
+#   - كل الطلبات على مجمّع اتصالات "hf_space" (services/upstream.py) وعلى
+#     HF_BASE_URL بدل رابط ثابت في الكود.
+#   - pinger في الخلفية يطلب الـ Space كل HF_KEEPWARM_SEC إذا لم يمر طلب حقيقي
+#     خلالها — يبقى مستيقظاً ويُعرف إن كان نائماً.
+#   - أثناء انتظار أول chunk يُعيد stream() قيمة None كل HF_WAKE_NOTICE_SEC؛
+#     المستدعي يحولها لتعليق SSE (": waking up") فيبقى الاتصال حياً ويعرف العميل السبب.
+#   - TTFT خاص بالـ Space (منفصل عن TTFTTracker الخاص بـ NVIDIA) مع عدد
+#     الإيقاظات البطيئة. حد التزامن في model_bulkheads (مفتاح qwen-mini).
+
+HF_SPACE_CONCURRENCY = int(os.environ.get("HF_SPACE_CONCURRENCY", "4"))
+HF_KEEPWARM_SEC      = float(os.environ.get("HF_KEEPWARM_SEC", "240"))
+HF_WAKE_NOTICE_SEC   = 3.0
+HF_STREAM_TIMEOUT    = 90.0
+HF_PING_TIMEOUT      = 30.0
+_TTFT_SAMPLES        = 512
+
+
+class HFSpace:
+    def __init__(self, base_url: str, api_key: str = None, keepwarm_sec: float = HF_KEEPWARM_SEC,
+                 wake_notice_sec: float = HF_WAKE_NOTICE_SEC):
+        self.base_url      = base_url.rstrip("/")
+        self.api_key       = api_key if api_key and api_key != "no-key-needed" else None
+        self.keepwarm_sec  = keepwarm_sec
+        self.wake_notice   = wake_notice_sec
+        self._task         = None
+        self._last_active  = 0.0
+        self._ttft_ms      = deque(maxlen=_TTFT_SAMPLES)
+        self._stats        = {"requests": 0, "errors": 0, "slow_wakes": 0, "in_flight": 0,
+                              "pings": 0, "ping_failures": 0, "last_ping_ms": None, "warm": None}
+
+    def _headers(self) -> dict:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    # ── Streaming ───────────────────────────────────────────────────────────
+
+    async def _texts(self, payload: dict):
+        async with upstream_client("hf_space", timeout=HF_STREAM_TIMEOUT) as client:
+            async with client.stream("POST", f"{self.base_url}/chat/stream",
+                                     headers=self._headers(), json=payload) as response:
+                if response.status_code != 200:
+                    raise Exception(f"HF Space Status {response.status_code}")
+                async for ev in aiter_sse(response.aiter_bytes()):
+                    if ev.done:
+                        return
+                    data = ev.json()
+                    text = data.get("text", "") if isinstance(data, dict) else ""
+                    if text:
+                        yield text
+
+    async def stream(self, payload: dict):
+        """
+        نصوص الرد كما تصل. قبل أول نص: None كل wake_notice ثانية ما دام الـ Space
+        لم يرد بعد (غالباً يستيقظ).
+        """
+        self._stats["requests"]  += 1
+        self._stats["in_flight"] += 1
+        self._last_active = time.monotonic()
+        started = time.monotonic()
+        it = self._texts(payload).__aiter__()
+        pending = None
+        first = True
+        try:
+            while True:
+                pending = asyncio.ensure_future(it.__anext__())
+                while first and not pending.done():
+                    done, _ = await asyncio.wait((pending,), timeout=self.wake_notice)
+                    if not done:
+                        yield None
+                try:
+                    text = await pending
+                except StopAsyncIteration:
+                    pending = None
+                    return
+                pending = None
+                if first:
+                    first = False
+                    ttft = time.monotonic() - started
+                    self._ttft_ms.append(ttft * 1000)
+                    if ttft > self.wake_notice:
+                        self._stats["slow_wakes"] += 1
+                    self._stats["warm"] = True
+                yield text
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self._stats["in_flight"] -= 1
+            self._last_active = time.monotonic()
+            if pending is not None and not pending.done():
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+            try:
+                await it.aclose()
+            except (Exception, asyncio.CancelledError):
+                pass
+
+    # ── Keep-warm ───────────────────────────────────────────────────────────
+
+    async def ping(self) -> bool:
+        root = self.base_url[:-3] if self.base_url.endswith("/v1") else self.base_url
+        t0 = time.monotonic()
+        self._stats["pings"] += 1
+        try:
+            async with upstream_client("hf_space", timeout=HF_PING_TIMEOUT) as client:
+                resp = await client.get(root + "/", headers=self._headers())
+            ok = resp.status_code < 500
+        except Exception as e:
+            print(f"[HFSpace] ping failed: {e}")
+            ok = False
+        self._stats["last_ping_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        self._stats["warm"] = ok
+        if not ok:
+            self._stats["ping_failures"] += 1
+        return ok
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.keepwarm_sec / 4)
+            if self._stats["in_flight"] or time.monotonic() - self._last_active < self.keepwarm_sec:
+                continue
+            await self.ping()
+            self._last_active = time.monotonic()
+
+    def start(self):
+        if self._task is None and self.keepwarm_sec > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        samples = sorted(self._ttft_ms)
+
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 1) if samples else None
+
+        return {"base_url": self.base_url, "keepwarm_sec": self.keepwarm_sec,
+                "pinger_running": self._task is not None,
+                "ttft_ms_p50": pct(0.5), "ttft_ms_p95": pct(0.95), "ttft_samples": len(samples),
+                **self._stats}
@@ -0,0 +1,188 @@
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+# ============================================================================
+# API KEY SCHEDULER — اختيار المفتاح الأقل حملاً والأكثر صحة
+# ============================================================================
+#  لكل مفتاح: طلبات جارية (in-flight)، نتائج آخر دقيقة، فترة تبريد بعد 429
+#  (تحترم Retry-After)، ومتوسط متحرك (EWMA) لزمن أول chunk.
+#  acquire() يختار المفتاح غير المُبرَّد صاحب أقل score؛ إذا كانت كل المفاتيح
+#  مُبرَّدة يُعاد الأقرب لانتهاء التبريد بدل الفشل.
+
+_OUTCOME_WINDOW_SEC   = 60.0
+_DEFAULT_COOLDOWN_429 = 10.0
+_MAX_COOLDOWN_SEC     = 120.0
+_FAILURE_STREAK_LIMIT = 3       # أخطاء متتالية (5xx/timeout) قبل تبريد قصير
+_FAILURE_COOLDOWN_SEC = 5.0
+_LATENCY_EWMA_ALPHA   = 0.2
+
+
+def parse_retry_after(value) -> float | None:
+    """Retry-After بالثواني أو كتاريخ HTTP → عدد الثواني، أو None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def _mask_key(key: str) -> str:
+    return f"{key[:8]}…{key[-4:]}" if len(key) > 14 else "***"
+
+
+class _KeyState:
+    __slots__ = ("key", "in_flight", "outcomes", "requests", "cooldown_until",
+                 "failure_streak", "rate_limit_streak", "latency_ewma_ms",
+                 "last_error", "last_error_at", "total", "total_errors")
+
+    def __init__(self, key: str):
+        self.key               = key
+        self.in_flight         = 0
+        self.outcomes          = deque()     # (ts, ok)
+        self.requests          = deque()     # أوقات الطلبات في آخر دقيقة
+        self.cooldown_until    = 0.0
+        self.failure_streak    = 0
+        self.rate_limit_streak = 0
+        self.latency_ewma_ms   = None
+        self.last_error        = None
+        self.last_error_at     = None
+        self.total             = 0
+        self.total_errors      = 0
+
+
+class KeyScheduler:
+    def __init__(self, keys: list, rate_limit_per_key: int = 40, clock=time.monotonic):
+        self.rate_limit_per_key = rate_limit_per_key
+        self._clock  = clock
+        self._states = {k: _KeyState(k) for k in keys}
+        self._order  = list(self._states)
+        self._rr     = 0
+
+    def __bool__(self):
+        return bool(self._states)
+
+    # ── Scoring ─────────────────────────────────────────────────────────────
+
+    def _prune(self, st: _KeyState, now: float):
+        cutoff = now - _OUTCOME_WINDOW_SEC
+        while st.outcomes and st.outcomes[0][0] <= cutoff:
+            st.outcomes.popleft()
+        while st.requests and st.requests[0] <= cutoff:
+            st.requests.popleft()
+
+    def _error_rate(self, st: _KeyState) -> float:
+        if len(st.outcomes) < 3:
+            return 0.0
+        return sum(1 for _, ok in st.outcomes if not ok) / len(st.outcomes)
+
+    def _score(self, st: _KeyState) -> float:
+        budget_used = len(st.requests) / self.rate_limit_per_key if self.rate_limit_per_key else 0.0
+        latency_sec = (st.latency_ewma_ms or 0.0) / 1000
+        return st.in_flight + 2.0 * budget_used + 4.0 * self._error_rate(st) + latency_sec
+
+    def pick(self) -> str | None:
+        """أفضل مفتاح الآن — بدون تسجيل طلب جارٍ."""
+        if not self._states:
+            return None
+        now = self._clock()
+        n = len(self._order)
+        best, best_score = None, None
+        fallback, fallback_until = None, None
+        # البدء من مؤشر دوّار يكسر التعادل بالتناوب كما كان cycle سابقاً
+        for i in range(n):
+            st = self._states[self._order[(self._rr + i) % n]]
+            self._prune(st, now)
+            if st.cooldown_until > now:
+                if fallback_until is None or st.cooldown_until < fallback_until:
+                    fallback, fallback_until = st, st.cooldown_until
+                continue
+            score = self._score(st)
+            if best_score is None or score < best_score:
+                best, best_score = st, score
+        self._rr = (self._rr + 1) % n
+        return (best or fallback).key
+
+    def acquire(self) -> str | None:
+        key = self.pick()
+        if key is None:
+            return None
+        st = self._states[key]
+        st.in_flight += 1
+        st.requests.append(self._clock())
+        st.total += 1
+        return key
+
+    def release(self, key: str):
+        st = self._states.get(key)
+        if st and st.in_flight > 0:
+            st.in_flight -= 1
+
+    # ── Outcomes ────────────────────────────────────────────────────────────
+
+    def record_success(self, key: str, ttft_ms: float = None):
+        st = self._states.get(key)
+        if not st:
+            return
+        st.outcomes.append((self._clock(), True))
+        st.failure_streak    = 0
+        st.rate_limit_streak = 0
+        if ttft_ms is not None:
+            if st.latency_ewma_ms is None:
+                st.latency_ewma_ms = float(ttft_ms)
+            else:
+                st.latency_ewma_ms += _LATENCY_EWMA_ALPHA * (ttft_ms - st.latency_ewma_ms)
+
+    def record_failure(self, key: str, kind: str, retry_after: float = None):
+        """kind: rate_limit | server_error | timeout | error"""
+        st = self._states.get(key)
+        if not st:
+            return
+        now = self._clock()
+        st.outcomes.append((now, False))
+        st.total_errors += 1
+        st.last_error    = kind
+        st.last_error_at = time.time()
+
+        if kind == "rate_limit":
+            st.rate_limit_streak += 1
+            cooldown = retry_after if retry_after is not None else \
+                _DEFAULT_COOLDOWN_429 * (2 ** (st.rate_limit_streak - 1))
+            st.cooldown_until = max(st.cooldown_until, now + min(cooldown, _MAX_COOLDOWN_SEC))
+            return
+
+        st.failure_streak += 1
+        if kind == "timeout" and st.latency_ewma_ms is not None:
+            # أول chunk لم يصل — اعتبره بطيئاً في المتوسط
+            st.latency_ewma_ms *= 1.5
+        if st.failure_streak >= _FAILURE_STREAK_LIMIT:
+            st.cooldown_until = max(st.cooldown_until, now + _FAILURE_COOLDOWN_SEC)
+
+    # ── Admin ───────────────────────────────────────────────────────────────
+
+    def snapshot(self) -> list:
+        now = self._clock()
+        rows = []
+        for st in self._states.values():
+            self._prune(st, now)
+            rows.append({
+                "key":             _mask_key(st.key),
+                "healthy":         st.cooldown_until <= now,
+                "cooldown_sec":    round(max(0.0, st.cooldown_until - now), 1),
+                "in_flight":       st.in_flight,
+                "rpm":             len(st.requests),
+                "rpm_limit":       self.rate_limit_per_key,
+                "error_rate_1m":   round(self._error_rate(st), 3),
+                "ttft_ewma_ms":    round(st.latency_ewma_ms, 1) if st.latency_ewma_ms is not None else None,
+                "score":           round(self._score(st), 3),
+                "last_error":      st.last_error,
+                "last_error_at":   st.last_error_at,
+                "total":           st.total,
+                "total_errors":    st.total_errors,
+            })
+        return rows
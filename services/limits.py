@@ -1,8 +1,9 @@
 import json
+import time
 from datetime import datetime
 from fastapi import Request
 from fastapi.responses import JSONResponse
-from database import get_user_by_email, update_user_usage_struct
+from database import get_user_by_email, update_user_usage_struct, get_redis
 from services.providers import MODEL_MAPPING
 
 # ─── Admin Configuration ──────────────────────────────────────────────────────
@@ -112,6 +113,20 @@ PLAN_NAME_MAP = {
     # "Qwen Mini" is free — no paid plan
 }
 
+# ─── Admission queue weights ─────────────────────────────────────────────────
+# وزن الخطة في طابور القبول العادل (services/admission.py) مشتق من حجمها اليومي
+# في PLAN_CONFIGS نسبةً لـ free_tier، بجذر تربيعي حتى لا تُحجب الخطط الصغيرة:
+# nexus_global ≈ 6.7، llama ≈ 5.2، free_tier = 1. qwen-mini مستثنى (مجاني بلا حد).
+def _plan_daily_volume(plan_key: str) -> int:
+    limits = PLAN_CONFIGS[plan_key]["daily_limits"]
+    return sum(v for k, v in limits.items() if k != "qwen-mini")
+
+
+PLAN_QUEUE_WEIGHTS = {
+    k: round(max(1.0, (_plan_daily_volume(k) / max(1, _plan_daily_volume("free_tier"))) ** 0.5), 2)
+    for k in PLAN_CONFIGS
+}
+
 # قائمة جميع مفاتيح النماذج للتهيئة الموحدة
 ALL_MODEL_KEYS = [
     "deepseek", "kimi", "mistral", "llama", "gemma",
@@ -257,6 +272,129 @@ async def check_trial_allowance(email, model_id):
     return False
 
 
+# ─── Premium entitlement cache ────────────────────────────────────────────────
+# نتيجة فحص الاشتراك تُخزَّن محلياً لكل مستخدم حتى لا يُقرأ المستخدم من Redis
+# مع كل طلب أداة. الإدخال ينتهي عند أقرب انتهاء خطة أو بعد TTL (أيهما أقرب)،
+# ويُمسح عبر invalidate_premium_access() عند أي تغيير في الخطط — في هذا العامل
+# فوراً، وفي باقي العمال خلال ENTITLEMENT_VERSION_CHECK_SEC: الإبطال يزيد رقم
+# إصدار في Redis، وكل عامل يقرأه مرة كل فترة (GET صغير واحد، لا مع كل طلب)
+# ويمسح كاشه المحلي إذا تغير. Upstash REST لا يدعم pub/sub — لذا رقم إصدار.
+PREMIUM_ACCESS_CACHE_TTL = 60.0
+_PREMIUM_ACCESS_CACHE_MAX = 10000
+ENTITLEMENT_VERSION_KEY       = "entitlements:version"
+ENTITLEMENT_VERSION_CHECK_SEC = 2.0
+
+_premium_access_cache: dict = {}   # email -> (allowed, valid_until_monotonic)
+_entitlement_version = {"value": None, "checked": 0.0}
+
+
+def _clear_entitlement_caches(email: str = None):
+    if email is None:
+        _premium_access_cache.clear()
+        _queue_tier_cache.clear()
+    else:
+        _premium_access_cache.pop(email, None)
+        _queue_tier_cache.pop(email, None)
+
+
+def _sync_entitlement_version():
+    """يمسح الكاش المحلي إذا أبطل عامل آخر أي اشتراك منذ آخر فحص."""
+    now = time.monotonic()
+    if now - _entitlement_version["checked"] < ENTITLEMENT_VERSION_CHECK_SEC:
+        return
+    _entitlement_version["checked"] = now
+    r = get_redis()
+    if not r:
+        return
+    try:
+        version = r.get(ENTITLEMENT_VERSION_KEY)
+    except Exception:
+        return
+    version = str(version) if version is not None else None
+    if version != _entitlement_version["value"]:
+        _clear_entitlement_caches()
+        _entitlement_version["value"] = version
+
+
+def _resolve_premium_entitlement(email: str) -> tuple[bool, float]:
+    """يُعيد (allowed, seconds_valid) — seconds_valid لا يتجاوز أقرب انتهاء خطة."""
+    user = get_user_by_email(email)
+    if not user:
+        return False, PREMIUM_ACCESS_CACHE_TTL
+
+    allowed = False
+    valid_for = PREMIUM_ACCESS_CACHE_TTL
+    now = datetime.utcnow()
+    for p in user.get("active_plans", []):
+        try:
+            exp_date = datetime.fromisoformat(p["expires"])
+        except:
+            continue
+        if exp_date <= now:
+            continue
+        plan_key = p.get("plan_key", "")
+        if plan_key and plan_key != "free_tier":
+            allowed = True
+            valid_for = min(valid_for, (exp_date - now).total_seconds())
+    return allowed, valid_for
+
+
+def invalidate_premium_access(email: str = None):
+    """
+    تُستدعى عند تغيير خطط المستخدم (ترقية، إلغاء، إصلاح حدود).
+    بدون email → يمسح الكاش بالكامل. باقي العمال يمسحون كاشهم بالكامل عند رؤية
+    الإصدار الجديد (الإبطال نادر — لا داعي لتتبع كل email).
+    """
+    _clear_entitlement_caches(email)
+    r = get_redis()
+    if not r:
+        return
+    try:
+        # لا نعتمد الإصدار الجديد محلياً: لو أبطل عامل آخر قبلنا (N→N+1 ثم N+2 منا)
+        # لفاتنا إبطاله. نترك القيمة القديمة فيرى الفحص التالي التغيير ويمسح الكاش
+        # بالكامل — ونجعل ذلك الفحص فورياً.
+        r.incr(ENTITLEMENT_VERSION_KEY)
+        _entitlement_version["checked"] = 0.0
+    except Exception as e:
+        print(f"[Limits] entitlement version bump failed: {e}")
+
+
+_queue_tier_cache: dict = {}   # email -> (tier, weight, valid_until_monotonic)
+
+
+def get_queue_tier(email: str) -> tuple[str, float]:
+    """
+    (اسم الفئة، الوزن) للمستخدم في طابور القبول — أعلى خطة نشطة لديه.
+    مخزنة محلياً بنفس TTL كاش الاشتراك.
+    """
+    if email == ADMIN_EMAIL:
+        return "admin", max(PLAN_QUEUE_WEIGHTS.values())
+
+    _sync_entitlement_version()
+    now = time.monotonic()
+    cached = _queue_tier_cache.get(email)
+    if cached and cached[2] > now:
+        return cached[0], cached[1]
+
+    tier, weight = "free_tier", PLAN_QUEUE_WEIGHTS["free_tier"]
+    user = get_user_by_email(email) or {}
+    utc_now = datetime.utcnow()
+    for p in user.get("active_plans", []):
+        try:
+            if datetime.fromisoformat(p["expires"]) <= utc_now:
+                continue
+        except:
+            continue
+        plan_key = p.get("plan_key", "")
+        if PLAN_QUEUE_WEIGHTS.get(plan_key, 0) > weight:
+            tier, weight = plan_key, PLAN_QUEUE_WEIGHTS[plan_key]
+
+    if len(_queue_tier_cache) >= _PREMIUM_ACCESS_CACHE_MAX:
+        _queue_tier_cache.clear()
+    _queue_tier_cache[email] = (tier, weight, now + PREMIUM_ACCESS_CACHE_TTL)
+    return tier, weight
+
+
 def has_active_paid_subscription(email: str) -> bool:
     """
     Returns True if the user has at least one active non-free subscription.
@@ -265,22 +403,17 @@ def has_active_paid_subscription(email: str) -> bool:
     if email == ADMIN_EMAIL:
         return True
 
-    user = get_user_by_email(email)
-    if not user:
-        return False
+    _sync_entitlement_version()
+    now = time.monotonic()
+    cached = _premium_access_cache.get(email)
+    if cached and cached[1] > now:
+        return cached[0]
 
-    active_plans = user.get("active_plans", [])
-    now = datetime.utcnow()
-    for p in active_plans:
-        try:
-            exp_date = datetime.fromisoformat(p["expires"])
-            if exp_date > now:
-                plan_key = p.get("plan_key", "")
-                if plan_key and plan_key != "free_tier":
-                    return True
-        except:
-            pass
-    return False
+    allowed, valid_for = _resolve_premium_entitlement(email)
+    if len(_premium_access_cache) >= _PREMIUM_ACCESS_CACHE_MAX:
+        _premium_access_cache.clear()
+    _premium_access_cache[email] = (allowed, now + max(valid_for, 0.0))
+    return allowed
 
 
 def get_limits_for_new_subscription(plan_key, period="monthly"):
@@ -300,27 +433,54 @@ def get_limits_for_new_subscription(plan_key, period="monthly"):
 # PREMIUM TOOLS ACCESS GUARD — يُستخدم كـ middleware في main.py
 # ============================================================================
 
-async def check_premium_tool_access(request: Request):
+class _PathPrefixTrie:
     """
-    تتحقق من صلاحية الوصول للأدوات المميزة.
-    تُعيد None إذا كان الوصول مسموحاً، أو JSONResponse جاهز في حالة الرفض.
+    Trie مبني على مقاطع المسار (segments) — يُبنى مرة واحدة عند الاستيراد.
+    match() يمشي على المقاطع حتى أول فرع مفقود، لذا المسارات العادية
+    (صفحات، static) تُرفض من أول مقطع بدون أي I/O.
     """
-    path = request.url.path
-    if "/tools/execute/" not in path:
-        return None
 
-    parts = path.split("/tools/execute/")
-    if len(parts) != 2:
+    _LEAF = "\0"
+
+    def __init__(self):
+        self._root: dict = {}
+
+    def add(self, prefix: str, value: str):
+        node = self._root
+        for seg in prefix.strip("/").split("/"):
+            node = node.setdefault(seg, {})
+        node[self._LEAF] = value
+
+    def match(self, path: str) -> str | None:
+        node = self._root
+        for seg in path.strip("/").split("/"):
+            node = node.get(seg)
+            if node is None:
+                return None
+            if self._LEAF in node:
+                return node[self._LEAF]
         return None
 
-    tool_id = parts[1].strip("/").split("/")[0]
-    if tool_id not in PREMIUM_TOOL_IDS:
-        return None
 
-    # local import لتجنب الاستيراد الدائري
-    from services.auth import get_current_user_email
+# أداة الـ tools router مركّبة تحت /api و /v1 (انظر main.py)
+_TOOL_EXECUTE_PREFIXES = ("/api/tools/execute", "/v1/tools/execute")
+
+_premium_tools_trie = _PathPrefixTrie()
+for _prefix in _TOOL_EXECUTE_PREFIXES:
+    for _tool_id in PREMIUM_TOOL_IDS:
+        _premium_tools_trie.add(f"{_prefix}/{_tool_id}", _tool_id)
 
-    email = get_current_user_email(request)
+
+def match_premium_tool_path(path: str) -> str | None:
+    """يُعيد tool_id إذا كان المسار تنفيذاً لأداة مميزة، وإلا None."""
+    return _premium_tools_trie.match(path)
+
+
+def premium_tool_rejection(email: str | None):
+    """
+    تُعيد None إذا كان الوصول مسموحاً، أو JSONResponse جاهز في حالة الرفض.
+    تُستدعى فقط بعد أن يطابق match_premium_tool_path المسار.
+    """
     if not email:
         return JSONResponse(
             {"error": "يجب تسجيل الدخول لاستخدام هذه الأداة. / Login required to use this tool."},
@@ -337,3 +497,17 @@ async def check_premium_tool_access(request: Request):
         )
 
     return None  # الوصول مسموح
+
+
+async def check_premium_tool_access(request: Request):
+    """
+    تتحقق من صلاحية الوصول للأدوات المميزة.
+    تُعيد None إذا كان الوصول مسموحاً، أو JSONResponse جاهز في حالة الرفض.
+    """
+    if match_premium_tool_path(request.url.path) is None:
+        return None
+
+    # local import لتجنب الاستيراد الدائري
+    from services.auth import get_current_user_email
+
+    return premium_tool_rejection(get_current_user_email(request))
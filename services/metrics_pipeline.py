@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from datetime import datetime
+
+import database
+
+# ============================================================================
+# ASYNC METRICS PIPELINE — تسجيل الاستخدام خارج مولّد البث
+# ============================================================================
+#  track_request_metrics / update_global_stats في database.py تقرأ وتكتب JSON
+#  كاملاً في Redis (عدة round trips متزامنة) — استدعاؤها في نهاية smart_chat_stream
+#  يؤخر [DONE] ويوقف حلقة الأحداث لكل البثوث الأخرى.
+#
+#  هنا نفس الدالتين بنفس التوقيع لكنهما تضعان حدثاً في طابور محدود فقط؛ مُجمِّع
+#  في الخلفية يدمج الأحداث كل METRICS_FLUSH_SEC: دلتا واحدة لكل مستخدم ولكل يوم،
+#  ثم pipeline واحد للكتابة — في thread منفصل.
+#  عدادات المستخدم في hash مستقل user_metrics:{email}:{day} عبر HINCRBY — لا
+#  تُقرأ ولا تُكتب وثيقة user:{email} أبداً، فلا تتسابق مع عدادات الحصة
+#  (check_request_allowance) ولا active_plans (الاشتراكات والدفع). العرض (الأدمن،
+#  ملف تلجرام) والمزامنة إلى TiDB (sync_all_usage_to_db) تدمجها في usage عبر user_usage().
+#  امتلاء الطابور → الحدث يُسقط ويُعد في dropped (لا ضغط عكسي على البث).
+#  قبل start() (سكربتات، اختبارات) تُستدعى دوال database مباشرة كما كانت.
+
+METRICS_QUEUE_MAX = int(os.environ.get("METRICS_QUEUE_MAX", "10000"))
+METRICS_FLUSH_SEC = float(os.environ.get("METRICS_FLUSH_SEC", "0.3"))
+METRICS_BATCH_MAX = 2000
+USER_METRICS_TTL  = 8 * 24 * 3600
+USER_METRICS_FIELDS = ("total_requests", "total_tokens", "latency_sum", "errors", "internal_ops")
+
+
+def user_metrics_key(email: str, day: str) -> str:
+    return f"user_metrics:{email}:{day}"
+
+
+def _empty_global() -> dict:
+    return {"total_requests": 0, "total_tokens": 0, "latency_sum": 0, "errors": 0,
+            "blocked": 0, "internal_ops": 0, "models": {}}
+
+
+class _Delta:
+    """مجموع أحداث مفتاح واحد خلال دفعة — نفس حقول database."""
+    __slots__ = ("requests", "tokens", "latency_sum", "errors", "blocked", "internal_ops", "models")
+
+    def __init__(self):
+        self.requests = self.tokens = self.latency_sum = 0
+        self.errors = self.blocked = self.internal_ops = 0
+        self.models = {}
+
+    def add(self, latency_ms, tokens, model_key, is_error, is_internal, is_blocked):
+        self.requests += 1
+        if is_blocked:
+            self.blocked += 1
+            return
+        self.tokens      += tokens
+        self.latency_sum += latency_ms
+        if is_error:
+            self.errors += 1
+        if is_internal:
+            self.internal_ops += 1
+        if model_key:
+            m = self.models.setdefault(model_key, [0, 0])
+            m[0] += 1
+            m[1] += latency_ms
+
+
+class MetricsPipeline:
+    def __init__(self, redis_getter=database.get_redis,
+                 queue_max: int = METRICS_QUEUE_MAX, flush_sec: float = METRICS_FLUSH_SEC):
+        self._get_redis  = redis_getter
+        self.queue_max   = queue_max
+        self.flush_sec   = flush_sec
+        self._queue      = deque()
+        self._task       = None
+        self._stats      = {"enqueued": 0, "dropped": 0, "flushed": 0, "batches": 0,
+                            "flush_errors": 0, "last_flush_ms": 0.0, "max_batch": 0}
+
+    # ── Producers (نفس توقيع database) ──────────────────────────────────────
+
+    def _emit(self, email, latency_ms, tokens, model_key, is_error, is_internal, is_blocked) -> bool:
+        if len(self._queue) >= self.queue_max:
+            self._stats["dropped"] += 1
+            return False
+        self._queue.append((str(datetime.utcnow().date()), email, latency_ms, tokens,
+                            model_key, is_error, is_internal, is_blocked))
+        self._stats["enqueued"] += 1
+        return True
+
+    def track_request_metrics(self, email, latency_ms, tokens, model_key=None,
+                              is_error=False, is_internal=False, is_blocked=False):
+        if self._task is None:
+            return database.track_request_metrics(email, latency_ms, tokens, model_key,
+                                                  is_error, is_internal, is_blocked)
+        return self._emit(email, latency_ms, tokens, model_key, is_error, is_internal, is_blocked)
+
+    def update_global_stats(self, latency_ms, tokens, model_key=None,
+                            is_error=False, is_internal=False, is_blocked=False):
+        if self._task is None:
+            return database.update_global_stats(latency_ms, tokens, model_key,
+                                                is_error, is_internal, is_blocked)
+        self._emit(None, latency_ms, tokens, model_key, is_error, is_internal, is_blocked)
+
+    # ── Aggregation ─────────────────────────────────────────────────────────
+
+    def _drain(self) -> list:
+        batch = []
+        while self._queue and len(batch) < METRICS_BATCH_MAX:
+            batch.append(self._queue.popleft())
+        return batch
+
+    @staticmethod
+    def _aggregate(batch: list) -> tuple:
+        globals_, users = {}, {}
+        for day, email, latency_ms, tokens, model_key, is_error, is_internal, is_blocked in batch:
+            args = (latency_ms, tokens, model_key, is_error, is_internal, is_blocked)
+            # track_request_metrics يحدّث الإحصاءات العامة أيضاً
+            globals_.setdefault(day, _Delta()).add(*args)
+            if email:
+                users.setdefault((day, email), _Delta()).add(*args)
+        return globals_, users
+
+    @staticmethod
+    def _apply_global(stats: dict, d: _Delta) -> dict:
+        stats.setdefault("blocked", 0)
+        stats["total_requests"] = stats.get("total_requests", 0) + d.requests
+        stats["blocked"]        = stats.get("blocked", 0) + d.blocked
+        stats["total_tokens"]   = stats.get("total_tokens", 0) + d.tokens
+        stats["latency_sum"]    = stats.get("latency_sum", 0) + d.latency_sum
+        stats["errors"]         = stats.get("errors", 0) + d.errors
+        stats["internal_ops"]   = stats.get("internal_ops", 0) + d.internal_ops
+        models = stats.setdefault("models", {})
+        for key, (reqs, lat) in d.models.items():
+            m = models.get(key, {"reqs": 0, "lat_sum": 0})
+            m["reqs"]    += reqs
+            m["lat_sum"] += lat
+            models[key] = m
+        return stats
+
+    def _write(self, batch: list):
+        """يعمل في thread — MGET واحد للإحصاءات العامة + pipeline واحد لكل الدفعة."""
+        r = self._get_redis()
+        if r is None:
+            return
+        globals_, users = self._aggregate(batch)
+        g_keys = [f"global_stats:{day}" for day in globals_]
+        raw = r.mget(*g_keys) if g_keys else []
+
+        pipe = r.pipeline()
+        for (day, d), key, val in zip(globals_.items(), g_keys, raw):
+            stats = (json.loads(val) if isinstance(val, str) else val) if val else _empty_global()
+            pipe.set(key, json.dumps(self._apply_global(stats, d)))
+        for (day, email), d in users.items():
+            key = user_metrics_key(email, day)
+            pipe.hincrby(key, "total_requests", d.requests)
+            if d.tokens:
+                pipe.hincrby(key, "total_tokens", d.tokens)
+            if d.latency_sum:
+                pipe.hincrbyfloat(key, "latency_sum", d.latency_sum)
+            if d.errors:
+                pipe.hincrby(key, "errors", d.errors)
+            if d.internal_ops:
+                pipe.hincrby(key, "internal_ops", d.internal_ops)
+            pipe.expire(key, USER_METRICS_TTL)
+        (getattr(pipe, "execute", None) or pipe.exec)()
+
+    def user_usage(self, user: dict) -> dict:
+        """usage المستخدم مع عدادات يومه من user_metrics (للعرض وللحفظ في TiDB — لا يُكتب في Redis)."""
+        usage = dict(user.get("usage") or {})
+        r = self._get_redis()
+        if r is None or not user.get("email"):
+            return usage
+        day = usage.get("date") or str(datetime.utcnow().date())
+        try:
+            counters = r.hgetall(user_metrics_key(user["email"], day))
+        except Exception:
+            return usage
+        for field in USER_METRICS_FIELDS:
+            if counters and field in counters:
+                value = float(counters[field])
+                usage[field] = int(value) if value.is_integer() else round(value, 1)
+        return usage
+
+    async def flush(self):
+        while self._queue:
+            batch = self._drain()
+            t0 = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                self._stats["flush_errors"] += 1
+                print(f"[Metrics] flush failed ({len(batch)} events): {e}")
+                # إعادة الدفعة مرة واحدة إن بقي مكان — وإلا تُحتسب مُسقطة
+                room = self.queue_max - len(self._queue)
+                self._stats["dropped"] += max(0, len(batch) - room)
+                self._queue.extendleft(reversed(batch[:max(0, room)]))
+                return
+            self._stats["flushed"]      += len(batch)
+            self._stats["batches"]      += 1
+            self._stats["max_batch"]     = max(self._stats["max_batch"], len(batch))
+            self._stats["last_flush_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_sec)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[Metrics] aggregator error: {e}")
+
+    # ── Lifecycle ───────────────────────────────────────────────────────────
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"running": self._task is not None, "queue_depth": len(self._queue),
+                "queue_max": self.queue_max, "flush_sec": self.flush_sec, **self._stats}
+
+
+metrics_pipeline = MetricsPipeline()
+
+track_request_metrics = metrics_pipeline.track_request_metrics
+update_global_stats   = metrics_pipeline.update_global_stats
@@ -2,12 +2,26 @@ import os
 import time
 import asyncio
 import json
-import httpx
-from itertools import cycle
+from contextlib import AsyncExitStack
 from datetime import datetime
 
 # استيراد تتبع المقاييس
-from database import track_request_metrics, update_global_stats
+from database import get_redis
+from services.metrics_pipeline import track_request_metrics, update_global_stats
+from services.upstream import upstream_client
+from services.admission import AdmissionController, AdmissionRejected
+from services.cluster_capacity import ClusterCapacity
+from services.key_scheduler import KeyScheduler, parse_retry_after
+from services.hedging import HedgeBudget, hedge_delay, HEDGE_TARGET
+from services.ttft_stats import TTFTTracker
+from services.circuit_breaker import CircuitBreakers
+from services.sse import aiter_sse
+from services.disconnect import disconnect_stats
+from services.bulkheads import ModelBulkheads, BulkheadFull, parse_limits
+from services.context_budget import ContextBudget, count_text_tokens
+from services.hf_space import HFSpace, HF_SPACE_CONCURRENCY
+from services.endpoint_router import EndpointRouter, BUILTIN_ENDPOINT, load_endpoint_config
+from services.reasoning import ReasoningFilter, resolve_reasoning_mode
 
 # --- 1. CONFIGURATION & KEY MANAGEMENT ---
 
@@ -20,8 +34,6 @@ NVIDIA_API_KEY = API_KEYS[0] if API_KEYS else None
 if not API_KEYS:
     print("CRITICAL WARNING: No NVIDIA API Keys found in environment variables!")
 
-_keys_cycle = cycle(API_KEYS) if API_KEYS else cycle(["no-key"])
-
 # HuggingFace Space API (for qwen-mini)
 HF_BASE_URL = os.environ.get("HF_SPACE_BASE_URL", "https://riy777-qw.hf.space/v1")
 HF_API_KEY  = os.environ.get("HF_TOKEN", "no-key-needed")
@@ -31,34 +43,46 @@ NVIDIA_BASE_URL = "https://integrate.api.nvidia.com/v1"
 RATE_LIMIT_PER_KEY = 40  
 TOTAL_CAPACITY_RPM = len(API_KEYS) * RATE_LIMIT_PER_KEY 
 
-# --- 2. GLOBAL RATE TRACKER (System Load) ---
+# جدولة المفاتيح حسب الحمل والصحة (بدل itertools.cycle) — services/key_scheduler.py
+key_scheduler = KeyScheduler(API_KEYS, rate_limit_per_key=RATE_LIMIT_PER_KEY)
 
-_request_timestamps = []
-_tracker_lock = asyncio.Lock()
+# --- 2. GLOBAL RATE TRACKER (System Load) ---
+# نموذج السعة وطابور القبول في services/admission.py
+# (ring buffer + إيقاظ المنتظرين بدل polling كل ثانية)
+# السعة مشتركة بين كل العمال عبر Redis (services/cluster_capacity.py)؛
+# إذا تعطل Redis يأخذ كل عامل 1/WEB_CONCURRENCY من السعة فقط.
+
+ADMISSION_MAX_QUEUE = int(os.environ.get("PROVIDER_ADMISSION_MAX_QUEUE", "200"))
+ADMISSION_MAX_WAIT  = float(os.environ.get("PROVIDER_ADMISSION_MAX_WAIT_SEC", "30"))
+WORKER_COUNT        = int(os.environ.get("WEB_CONCURRENCY", "1") or 1)
+
+provider_admission = AdmissionController(
+    TOTAL_CAPACITY_RPM,
+    max_queue=ADMISSION_MAX_QUEUE,
+    shared=ClusterCapacity(get_redis),
+    local_share=WORKER_COUNT,
+    max_wait_sec=ADMISSION_MAX_WAIT,
+)
 
 async def get_system_load():
-    global _request_timestamps
-    if TOTAL_CAPACITY_RPM == 0: return 1.0 
-    now = time.time()
-    async with _tracker_lock:
-        _request_timestamps = [t for t in _request_timestamps if now - t < 60]
-        current_rpm = len(_request_timestamps)
-    return current_rpm / TOTAL_CAPACITY_RPM
-
-async def acquire_provider_slot(is_priority: bool):
-    global _request_timestamps
-    while True:
-        load = await get_system_load()
-        threshold = 0.95 if is_priority else 0.80
-        if load < threshold:
-            async with _tracker_lock:
-                _request_timestamps.append(time.time())
-            return 
-        await asyncio.sleep(1.0)
+    return provider_admission.load()
+
+async def acquire_provider_slot(is_priority: bool, email: str = None):
+    """
+    ينتظر حتى تتوفر سعة: 0.95 للأولوية، 0.80 للباقي.
+    مع email يدخل المستخدم طابوره الفرعي بوزن خطته (طابور عادل بين المستخدمين).
+    يرفع AdmissionRejected إذا كان الطابور ممتلئاً أو تجاوز الانتظار الحد.
+    """
+    tier, weight = None, 1.0
+    if email:
+        from services.limits import get_queue_tier
+        tier, weight = get_queue_tier(email)
+    await provider_admission.acquire(is_priority, user=email, tier=tier, weight=weight)
 
 def get_next_api_key():
+    """أفضل مفتاح حالياً بدون تسجيل طلب جارٍ — للاستخدامات خارج smart_chat_stream."""
     if not API_KEYS: return None
-    return next(_keys_cycle)
+    return key_scheduler.pick()
 
 # --- 3. METADATA & MODELS ---
 
@@ -69,6 +93,7 @@ MODELS_METADATA = [
     {
         "id": "deepseek-ai/deepseek-v3.2",
         "short_key": "deepseek",
+        "context_window": 131072,
         "name": "DeepSeek V3.2",
         "provider": "DeepSeek",
         "modalities": ["text", "code"],
@@ -77,6 +102,7 @@ MODELS_METADATA = [
     {
         "id": "mistralai/mistral-large-3-675b-instruct-2512",
         "short_key": "mistral",
+        "context_window": 262144,
         "name": "Mistral Large 3",
         "provider": "Mistral AI",
         "modalities": ["text", "images", "code", "reasoning"],
@@ -90,6 +116,7 @@ MODELS_METADATA = [
     {
         "id": "moonshotai/kimi-k2-thinking",
         "short_key": "kimi",
+        "context_window": 262144,
         "name": "Kimi K2 Thinking",
         "provider": "Moonshot",
         "modalities": ["text", "reasoning"],
@@ -98,6 +125,7 @@ MODELS_METADATA = [
     {
         "id": "meta/llama-3.2-3b-instruct",
         "short_key": "llama",
+        "context_window": 131072,
         "name": "Llama 3.2",
         "provider": "Meta",
         "modalities": ["text"],
@@ -106,6 +134,7 @@ MODELS_METADATA = [
     {
         "id": "google/gemma-3n-e4b-it",
         "short_key": "gemma",
+        "context_window": 32768,
         "name": "Gemma 3",
         "provider": "Google",
         "modalities": ["text", "images", "audio", "video"],
@@ -122,6 +151,7 @@ MODELS_METADATA = [
     {
         "id": "meta/llama-3.3-70b-instruct",
         "short_key": "llama-large",
+        "context_window": 131072,
         "name": "Llama 3.3 70B",
         "provider": "Meta",
         "modalities": ["text", "code", "reasoning"],
@@ -130,6 +160,7 @@ MODELS_METADATA = [
     {
         "id": "meta/llama-4-scout-17b-16e-instruct",
         "short_key": "llama-scout",
+        "context_window": 131072,
         "name": "Llama 4 Scout",
         "provider": "Meta",
         "modalities": ["text", "images"],
@@ -143,6 +174,7 @@ MODELS_METADATA = [
     {
         "id": "qwen/qwen2.5-coder-32b-instruct",
         "short_key": "qwen-coder",
+        "context_window": 32768,
         "name": "Qwen 2.5 Coder",
         "provider": "Qwen",
         "modalities": ["text", "code"],
@@ -151,6 +183,7 @@ MODELS_METADATA = [
     {
         "id": "Qwen/Qwen2.5-0.5B-Instruct",
         "short_key": "qwen-mini",
+        "context_window": 32768,
         "name": "Qwen 2.5 Mini",
         "provider": "Qwen",
         "modalities": ["text"],
@@ -166,6 +199,9 @@ MODEL_MAPPING[EMERGENCY_MODEL_ID] = "deepseek"
 # خريطة المعرفات لمعرفة ما إذا كان النموذج يستخدم HF Space
 HF_MODEL_IDS = {m["id"] for m in MODELS_METADATA if m.get("use_hf")}
 
+# قص سجل المحادثة ليناسب نافذة النموذج (services/context_budget.py)
+context_budget = ContextBudget({m["id"]: m["context_window"] for m in MODELS_METADATA})
+
 HIDDEN_MODELS = []
 
 def estimate_tokens(text):
@@ -182,6 +218,27 @@ def get_provider_config(model_id: str) -> tuple[str, str]:
     return NVIDIA_BASE_URL, get_next_api_key() or "no-key"
 
 
+# qwen-mini على HF Space — مجمّع اتصالات + pinger يبقيه مستيقظاً (services/hf_space.py)
+hf_space = HFSpace(HF_BASE_URL, HF_API_KEY)
+
+
+def _hf_prompt(messages: list) -> str:
+    """الـ Space يقبل prompt نصياً فقط — بناؤه من messages."""
+    prompt_parts = []
+    for msg in messages:
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(p.get("text", "") for p in content if isinstance(p, dict))
+        if role == "system":
+            prompt_parts.append(f"[System]: {content}")
+        elif role == "user":
+            prompt_parts.append(f"[User]: {content}")
+        elif role == "assistant":
+            prompt_parts.append(f"[Assistant]: {content}")
+    return "\n".join(prompt_parts)
+
+
 def _sse_error(message: str) -> bytes:
     """
     ✅ يُرسل رسالة خطأ بصيغة SSE صحيحة حتى يظهر الخطأ داخل فقاعة الشات
@@ -195,11 +252,372 @@ def _sse_error(message: str) -> bytes:
 
 # --- 4. STREAMING LOGIC (With TTFT) ---
 
-async def smart_chat_stream(original_body, user_email, is_trial=False):
+# مهلة أول chunk الافتراضية — تُستبدل بقيمة متعلَّمة لكل نموذج/مفتاح
+# (services/ttft_stats.py) بمجرد توفر عينات كافية
+FIRST_CHUNK_TIMEOUT = 3.0
+
+hedge_budget = HedgeBudget()
+
+# endpoints إضافية متوافقة مع OpenAI لكل نموذج (services/endpoint_router.py)؛
+# بدون MODEL_ENDPOINTS يبقى كل شيء على NVIDIA كما كان
+# provider_admission.load() لا يلمس Redis: مع السعة المشتركة يعيد آخر تقدير
+# حدّثته مهمة ClusterCapacity الخلفية
+endpoint_router = EndpointRouter(
+    load_endpoint_config(),
+    builtin_remaining=lambda: 1.0 - provider_admission.load(),
+)
+
+# حدود التزامن لكل نموذج (services/bulkheads.py) — نماذج التفكير تبقي البث مفتوحاً
+# دقائق فلا تستعير من الحوض المشترك؛ القيم لكل عامل وقابلة للتعديل عبر البيئة.
+MODEL_CONCURRENCY_DEFAULTS = {"kimi": 6, "deepseek": 8, "mistral": 8, "llama-large": 10,
+                              "qwen-mini": HF_SPACE_CONCURRENCY}
+model_bulkheads = ModelBulkheads(
+    {**MODEL_CONCURRENCY_DEFAULTS, **parse_limits(os.environ.get("MODEL_CONCURRENCY_LIMITS", ""))},
+    default_limit=int(os.environ.get("MODEL_CONCURRENCY_DEFAULT", "16")),
+    spill_slots=int(os.environ.get("BULKHEAD_SPILL_SLOTS", "8")),
+    no_spill=set(filter(None, os.environ.get("MODEL_NO_SPILL", "kimi,deepseek,qwen-mini").split(","))),
+    spill_max_sec=float(os.environ.get("BULKHEAD_SPILL_MAX_SEC", "20")),
+    max_wait_sec=float(os.environ.get("BULKHEAD_MAX_WAIT_SEC", "10")),
+)
+ttft_tracker = TTFTTracker(FIRST_CHUNK_TIMEOUT, redis_getter=get_redis)
+circuit_breakers = CircuitBreakers(redis_getter=get_redis)
+
+
+def _fallback_body(body: dict, target_model_id: str) -> dict:
+    """نسخة من الطلب موجهة لنموذج الطوارئ مع إزالة المعاملات غير المدعومة."""
+    fallback = EMERGENCY_MODEL_ID if target_model_id == "deepseek-ai/deepseek-v3.2" else EMERGENCY_MODEL_VISION
+    fb = dict(body)
+    fb["model"] = fallback
+    fb.pop("chat_template_kwargs", None)
+    fb.pop("frequency_penalty", None)
+    fb.pop("presence_penalty", None)
+    # deepseek الطوارئ يحتاج thinking
+    if fallback == EMERGENCY_MODEL_ID:
+        fb["chat_template_kwargs"] = {"thinking": True}
+    return fb
+
+
+class _UpstreamAttempt:
+    """بث NVIDIA مفتوح وصل أول chunk منه — يُغلق مرة واحدة ويحرر المفتاح."""
+
+    def __init__(self, label: str, model: str, api_key: str, stack: AsyncExitStack,
+                 first_chunk: bytes, chunks, release=None):
+        self.label       = label
+        self.model       = model
+        self.api_key     = api_key
+        self.first_chunk = first_chunk
+        self.chunks      = chunks
+        self._stack      = stack
+        self._release    = release or (lambda: key_scheduler.release(api_key))
+        self._closed     = False
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._stack.aclose()
+        finally:
+            self._release()
+
+
+async def _open_nvidia_stream(body: dict, label: str) -> _UpstreamAttempt:
+    """
+    يفتح البث وينتظر أول chunk خلال المهلة المتعلَّمة، ويسجل النتيجة للمفتاح.
+    المحاولة الموازية تحصل تلقائياً على مفتاح آخر لأن المفتاح المشغول in_flight أعلى.
+    """
+    api_key = key_scheduler.acquire() or "no-key"
+    model = body.get("model")
+    first_chunk_timeout = ttft_tracker.timeout_for(model, api_key)
+    attempt_start = time.time()
+    stack = AsyncExitStack()
+
+    async def _open():
+        client = await stack.enter_async_context(upstream_client("nvidia", timeout=60.0))
+        response = await stack.enter_async_context(client.stream(
+            "POST",
+            f"{NVIDIA_BASE_URL}/chat/completions",
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream"
+            },
+            json=body
+        ))
+
+        if response.status_code == 429:
+            print(f"[Provider] Key Rate Limited (429). Rotating key...")
+            key_scheduler.record_failure(
+                api_key, "rate_limit",
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+            )
+            raise _RecordedFailure("Upstream Rate Limit (429)")
+
+        if response.status_code != 200:
+            error_body = await response.aread()
+            error_text = error_body.decode("utf-8", errors="ignore")[:300]
+            print(f"[Provider] NVIDIA Error {response.status_code}: {error_text}")
+            key_scheduler.record_failure(
+                api_key, "server_error" if response.status_code >= 500 else "error"
+            )
+            if response.status_code >= 500:
+                circuit_breakers.record_failure(model)
+            raise _RecordedFailure(f"Status {response.status_code}")
+
+        byte_iter = response.aiter_bytes().__aiter__()
+        return byte_iter, await byte_iter.__anext__()
+
+    try:
+        byte_iter, first_chunk = await asyncio.wait_for(_open(), timeout=first_chunk_timeout)
+    except asyncio.TimeoutError:
+        print(f"[Provider] ⏱ First chunk timeout (>{first_chunk_timeout:.1f}s) [{label}] {model}")
+        key_scheduler.record_failure(api_key, "timeout")
+        ttft_tracker.record_timeout(model, api_key, first_chunk_timeout)
+        circuit_breakers.record_failure(model)
+        endpoint_router.record(model, BUILTIN_ENDPOINT, ok=False)
+        await _close_quietly(stack, api_key)
+        raise Exception("First chunk timeout")
+    except asyncio.CancelledError:
+        # خسر السباق — ليس خطأً في المفتاح، لكن زمنه عينة مقطوعة من ذيل TTFT
+        ttft_tracker.record_cancelled(model, api_key, time.time() - attempt_start)
+        await _close_quietly(stack, api_key)
+        raise
+    except _RecordedFailure:
+        endpoint_router.record(model, BUILTIN_ENDPOINT, ok=False)
+        await _close_quietly(stack, api_key)
+        raise
+    except Exception:
+        key_scheduler.record_failure(api_key, "error")
+        circuit_breakers.record_failure(model)
+        endpoint_router.record(model, BUILTIN_ENDPOINT, ok=False)
+        await _close_quietly(stack, api_key)
+        raise
+
+    ttft_sec = time.time() - attempt_start
+    key_scheduler.record_success(api_key, ttft_ms=ttft_sec * 1000)
+    ttft_tracker.record(model, api_key, ttft_sec)
+    circuit_breakers.record_success(model)
+    endpoint_router.record(model, BUILTIN_ENDPOINT, ttft_sec)
+    return _UpstreamAttempt(label, model, api_key, stack, first_chunk, byte_iter)
+
+
+async def _open_endpoint_stream(body: dict, endpoint, label: str) -> _UpstreamAttempt:
+    """
+    نفس _open_nvidia_stream لكن على endpoint خارجي متوافق مع OpenAI: مفتاحه ومعرّف
+    نموذجه الخاص، وعميل مشترك خاص به. النتيجة تُسجل في endpoint_router فقط
+    (لا تمس قاطع NVIDIA ولا مُجدول مفاتيحه).
+    """
+    endpoint_router.acquire(endpoint)
+    logical_model = body.get("model")
+    api_key = endpoint.next_key()
+    tracker_key = f"{endpoint.pool}:{api_key}"
+    # عينات منفصلة عن NVIDIA — وإلا تغيّر endpoints الخارجية مهلة NVIDIA للنموذج
+    tracker_model = f"{endpoint.name}/{logical_model}"
+    first_chunk_timeout = ttft_tracker.timeout_for(tracker_model, tracker_key)
+    attempt_start = time.time()
+    stack = AsyncExitStack()
+    req_body = dict(body)
+    req_body["model"] = endpoint.upstream_model(logical_model)
+
+    async def _open():
+        client = await stack.enter_async_context(upstream_client(endpoint.pool, timeout=60.0))
+        response = await stack.enter_async_context(client.stream(
+            "POST",
+            f"{endpoint.base_url}/chat/completions",
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream"
+            },
+            json=req_body
+        ))
+        if response.status_code == 429:
+            endpoint_router.record(logical_model, endpoint.name, ok=False, rate_limited=True)
+            raise _RecordedFailure(f"Endpoint {endpoint.name} rate limited (429)")
+        if response.status_code != 200:
+            error_body = await response.aread()
+            print(f"[Provider] Endpoint {endpoint.name} error {response.status_code}: "
+                  f"{error_body.decode('utf-8', errors='ignore')[:300]}")
+            endpoint_router.record(logical_model, endpoint.name, ok=False)
+            raise _RecordedFailure(f"Endpoint {endpoint.name} status {response.status_code}")
+        byte_iter = response.aiter_bytes().__aiter__()
+        return byte_iter, await byte_iter.__anext__()
+
+    async def _close():
+        try:
+            await stack.aclose()
+        except BaseException:
+            pass
+        finally:
+            endpoint_router.release(endpoint)
+
+    try:
+        byte_iter, first_chunk = await asyncio.wait_for(_open(), timeout=first_chunk_timeout)
+    except asyncio.TimeoutError:
+        print(f"[Provider] ⏱ First chunk timeout (>{first_chunk_timeout:.1f}s) [{label}] {endpoint.name}")
+        ttft_tracker.record_timeout(tracker_model, tracker_key, first_chunk_timeout)
+        endpoint_router.record(logical_model, endpoint.name, ok=False)
+        await _close()
+        raise Exception("First chunk timeout")
+    except asyncio.CancelledError:
+        ttft_tracker.record_cancelled(tracker_model, tracker_key, time.time() - attempt_start)
+        await _close()
+        raise
+    except _RecordedFailure:
+        await _close()
+        raise
+    except Exception:
+        endpoint_router.record(logical_model, endpoint.name, ok=False)
+        await _close()
+        raise
+
+    ttft_sec = time.time() - attempt_start
+    ttft_tracker.record(tracker_model, tracker_key, ttft_sec)
+    endpoint_router.record(logical_model, endpoint.name, ttft_sec)
+    return _UpstreamAttempt(label, logical_model, api_key, stack, first_chunk, byte_iter,
+                            release=lambda: endpoint_router.release(endpoint))
+
+
+class _RecordedFailure(Exception):
+    """فشل سُجّل مسبقاً على المفتاح (429 / status)."""
+
+
+async def _close_quietly(stack: AsyncExitStack, api_key: str):
+    try:
+        await stack.aclose()
+    except BaseException:
+        pass
+    finally:
+        key_scheduler.release(api_key)
+
+
+async def _discard_attempt(task: asyncio.Task):
+    """يلغي محاولة خاسرة؛ وإن كانت قد نجحت في نفس اللحظة يغلق بثها."""
+    task.cancel()
+    try:
+        attempt = await task
+    except BaseException:
+        return
+    await attempt.aclose()
+
+
+async def _race_first_chunk(body: dict, target_model_id: str) -> _UpstreamAttempt:
+    """
+    يُعيد أول محاولة وصل منها chunk ويلغي البقية.
+    المحاولات: primary → hedge (بعد hedge_delay، ضمن الميزانية) → fallback (عند أي فشل
+    أو إذا لم يبقَ شيء قيد الانتظار). إذا كان قاطع النموذج مفتوحاً يبدأ بـ fallback مباشرة.
+    يرفع آخر خطأ إذا فشلت كلها.
+    """
+    hedge_budget.record_primary()
+    loop = asyncio.get_running_loop()
+    tasks = {}                      # task → label
+    hedge_at = loop.time() + hedge_delay(target_model_id)
+    hedged = fallback_started = False
+    last_error = None
+
+    def _launch(label: str, req_body: dict, endpoint=None):
+        if endpoint is not None:
+            task = asyncio.ensure_future(_open_endpoint_stream(req_body, endpoint, label))
+        else:
+            task = asyncio.ensure_future(_open_nvidia_stream(req_body, label))
+        tasks[task] = label
+
+    def _launch_fallback(label: str = "fallback"):
+        nonlocal fallback_started
+        fallback_started = True
+        fb = _fallback_body(body, target_model_id)
+        print(f"[Provider] Switching to emergency ({label}): {fb['model']}")
+        _launch(label, fb)
+
+    # endpoints متعددة للنموذج: الأسرع حالياً حسب endpoint_router (nvidia أحدها)؛
+    # إذا كان قاطع NVIDIA مفتوحاً تُستبعد nvidia من الاختيار
+    nvidia_ok = circuit_breakers.allow(target_model_id)
+    endpoint = endpoint_router.pick(target_model_id, exclude=() if nvidia_ok else (BUILTIN_ENDPOINT,))
+    primary_external = endpoint is not None and not endpoint.builtin
+    nvidia_launched = False
+    if primary_external:
+        _launch("primary", body, endpoint)
+    elif nvidia_ok:
+        _launch("primary", body)
+    else:
+        # القاطع مفتوح — مباشرة لنموذج الطوارئ بدون دفع المهلة على نموذج متعطل
+        _launch_fallback()
+    try:
+        while tasks:
+            timeout = None
+            if not hedged and not fallback_started:
+                timeout = max(0.0, hedge_at - loop.time())
+
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # لا chunk بعد hedge_delay — طلب احتياطي إن سمحت الميزانية والسعة
+                hedged = True
+                if hedge_budget.try_spend(lambda: provider_admission.try_acquire(is_priority=False)):
+                    if primary_external and nvidia_ok and not nvidia_launched:
+                        # الأصلي على endpoint خارجي بطيء — التحوّط على NVIDIA لنفس النموذج
+                        nvidia_launched = True
+                        _launch("hedge", body)
+                    elif HEDGE_TARGET == "key" and len(API_KEYS) > 1:
+                        _launch("hedge", body)
+                    else:
+                        _launch_fallback("hedge")
+                continue
+
+            winner = None
+            for task in done:
+                label = tasks.pop(task)
+                if task.exception() is None:
+                    if winner is None:
+                        winner = task.result()
+                        if label == "hedge":
+                            hedge_budget.record_win()
+                    else:
+                        await task.result().aclose()
+                else:
+                    last_error = task.exception()
+                    print(f"[Provider] Attempt [{label}] failed: {last_error}")
+
+            if winner is not None:
+                return winner
+
+            if primary_external and nvidia_ok and not nvidia_launched:
+                # فشل الـ endpoint الخارجي — نفس النموذج على NVIDIA قبل نموذج الطوارئ
+                nvidia_launched = True
+                _launch("retry", body)
+            elif not fallback_started:
+                _launch_fallback()
+
+        raise last_error or Exception("No upstream attempt succeeded")
+    finally:
+        for task in list(tasks):
+            await _discard_attempt(task)
+
+
+DISCONNECT_DEFAULT_MAX_TOKENS = 1024    # لتقدير التوكنات الموفّرة عندما لا يحدد الطلب max_tokens
+
+
+def _record_disconnect(user_email, is_trial, start_time, ttft_latency, tokens_est,
+                       response_tokens, internal_key, max_tokens):
+    """العميل انقطع وأُلغي upstream — يُحتسب ما وُلِّد فعلاً فقط."""
+    saved = int(max_tokens or DISCONNECT_DEFAULT_MAX_TOKENS) - response_tokens
+    disconnect_stats.record("chat", response_tokens, saved)
+    print(f"[Provider] Client disconnected after {response_tokens} chunks — upstream cancelled")
+    if response_tokens > 0 and user_email:
+        latency = ttft_latency or int((time.time() - start_time) * 1000)
+        if is_trial:
+            update_global_stats(latency, tokens_est + response_tokens, model_key=internal_key)
+        else:
+            track_request_metrics(user_email, latency, tokens_est + response_tokens, model_key=internal_key)
+
+
+async def smart_chat_stream(original_body, user_email, is_trial=False, on_served=None):
     """
     إضافة معامل is_trial:
     - إذا كان True: لا يتم خصم من رصيد المستخدم ولا يُحتسب في لوحة التحكم الخاصة به
     - إذا كان False: يتم التتبع العادي
+    on_served(model): يُستدعى قبل أول chunk بالنموذج المنطقي الذي يخدم الطلب فعلاً
+    (النموذج المطلوب عبر أي endpoint، أو نموذج الطوارئ).
     """
     print(f"[DEBUG] smart_chat_stream called with is_trial={is_trial}, user={user_email}")
 
@@ -210,82 +628,70 @@ async def smart_chat_stream(original_body, user_email, is_trial=False):
     start_time = time.time()
     ttft_latency = 0
 
+    # الأدوار الأقدم تُقص (أو تُلخص) إذا تجاوز السجل نافذة النموذج أو max_input_tokens
+    current_body = await context_budget.apply(current_body)
+    reasoning_mode = resolve_reasoning_mode(current_body.pop("reasoning_mode", None))
+
     tokens_est = 0
     for m in current_body.get("messages", []): 
         tokens_est += estimate_tokens(m.get("content", ""))
 
     response_tokens = 0
 
+    # حوض النموذج — البث يحجز خانة in-flight حتى إغلاقه (حدود منفصلة لكل نموذج،
+    # ولـ qwen-mini حد يطابق سعة الـ Space)
+    try:
+        lease = await model_bulkheads.acquire(internal_key)
+    except BulkheadFull as e:
+        print(f"[Provider] {e}")
+        yield _sse_error("This model is busy right now. Please retry in a moment.")
+        if user_email:
+            final_latency = int((time.time() - start_time) * 1000)
+            if is_trial:
+                update_global_stats(final_latency, tokens_est, model_key=internal_key, is_error=True)
+            else:
+                track_request_metrics(user_email, final_latency, tokens_est, model_key=internal_key, is_error=True)
+        return
+
     # نموذج HuggingFace Space — API مخصص (ليس OpenAI-compatible)
-    # الـ Space يستخدم: POST /v1/chat/stream مع {"prompt": "...", "max_tokens": N}
-    # والرد SSE بصيغة: data: {"text": "..."}
+    # الـ Space يستخدم: POST {HF_BASE_URL}/chat/stream مع {"prompt": "...", "max_tokens": N}
+    # والرد SSE بصيغة: data: {"text": "..."} — العميل والـ pinger في services/hf_space.py
     if target_model_id in HF_MODEL_IDS:
-        base_url, api_key = get_provider_config(target_model_id)
-
-        # بناء prompt نصي من messages array
-        messages = current_body.get("messages", [])
-        prompt_parts = []
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role == "system":
-                prompt_parts.append(f"[System]: {content}")
-            elif role == "user":
-                prompt_parts.append(f"[User]: {content}")
-            elif role == "assistant":
-                prompt_parts.append(f"[Assistant]: {content}")
-        prompt_text = "\n".join(prompt_parts)
-
+        if on_served is not None:
+            on_served(target_model_id)
         hf_payload = {
-            "prompt": prompt_text,
+            "prompt": _hf_prompt(current_body.get("messages", [])),
             "temperature": current_body.get("temperature", 0.7),
             "max_tokens": current_body.get("max_tokens", 512)
         }
 
         try:
-            async with httpx.AsyncClient(timeout=90.0) as client:
-                async with client.stream(
-                    "POST",
-                    f"https://riy777-qw.hf.space/v1/chat/stream",
-                    headers={"Content-Type": "application/json"},
-                    json=hf_payload
-                ) as response:
-                    if response.status_code != 200:
-                        raise Exception(f"HF Space Status {response.status_code}")
-
-                    first_chunk = True
-                    async for line in response.aiter_lines():
-                        if not line:
-                            continue
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            if data_str.strip() == "[DONE]":
-                                # إرسال [DONE] بصيغة OpenAI
-                                yield b"data: [DONE]\n\n"
-                                break
-                            try:
-                                hf_data = json.loads(data_str)
-                                text_chunk = hf_data.get("text", "")
-                                if not text_chunk:
-                                    continue
-                                if first_chunk:
-                                    ttft_latency = int((time.time() - start_time) * 1000)
-                                    first_chunk = False
-                                # تحويل إلى صيغة OpenAI SSE
-                                openai_chunk = {
-                                    "id": "chatcmpl-hf",
-                                    "object": "chat.completion.chunk",
-                                    "choices": [{
-                                        "index": 0,
-                                        "delta": {"content": text_chunk},
-                                        "finish_reason": None
-                                    }]
-                                }
-                                response_tokens += 1
-                                yield f"data: {json.dumps(openai_chunk, ensure_ascii=False)}\n\n".encode()
-                            except json.JSONDecodeError:
-                                pass
+            async for text_chunk in hf_space.stream(hf_payload):
+                if text_chunk is None:
+                    # الـ Space لم يرد بعد (غالباً يستيقظ) — تعليق SSE يبقي الاتصال حياً
+                    yield b": waking up model\n\n"
+                    continue
+                if not ttft_latency:
+                    ttft_latency = int((time.time() - start_time) * 1000)
+                # تحويل إلى صيغة OpenAI SSE
+                openai_chunk = {
+                    "id": "chatcmpl-hf",
+                    "object": "chat.completion.chunk",
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": text_chunk},
+                        "finish_reason": None
+                    }]
+                }
+                # الـ chunk قد يحمل عدة توكنات — يُعد بالنص لا بعدد الـ chunks
+                response_tokens += max(1, count_text_tokens(text_chunk))
+                yield f"data: {json.dumps(openai_chunk, ensure_ascii=False)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
 
+        except (asyncio.CancelledError, GeneratorExit):
+            _record_disconnect(user_email, is_trial, start_time, ttft_latency, tokens_est,
+                               response_tokens, internal_key, current_body.get("max_tokens"))
+            raise
         except Exception as e:
             # ✅ FIX: إرسال الخطأ بصيغة SSE ليظهر في الشات
             yield _sse_error(f"Provider Error: {str(e)}")
@@ -296,6 +702,8 @@ async def smart_chat_stream(original_body, user_email, is_trial=False):
                 else:
                     track_request_metrics(user_email, final_latency, tokens_est, model_key=internal_key, is_error=True)
             return
+        finally:
+            model_bulkheads.release(lease)
 
         final_metric_latency = ttft_latency if ttft_latency > 0 else int((time.time() - start_time) * 1000)
         if response_tokens > 0 and user_email:
@@ -305,87 +713,71 @@ async def smart_chat_stream(original_body, user_email, is_trial=False):
                 track_request_metrics(user_email, final_metric_latency, tokens_est + response_tokens, model_key=internal_key)
         return
 
-    # نماذج NVIDIA — محاولتان: الأصلي ثم الطوارئ العالمي
-    # 3 ثوانٍ timeout لجميع النماذج — أي تأخر يُحوّل فوراً للطوارئ بصمت تام
-    max_attempts = 2
-    FIRST_CHUNK_TIMEOUT = 3.0
-
-    for attempt in range(max_attempts):
-        current_api_key = get_next_api_key()
-
-        try:
-            if attempt == 1:
-                # المحاولة الثانية: تبديل لنموذج الطوارئ العالمي بصمت تام
-                fallback = EMERGENCY_MODEL_ID if target_model_id == "deepseek-ai/deepseek-v3.2" else EMERGENCY_MODEL_VISION
-                print(f"[Provider] Attempt 1 failed → switching to emergency: {fallback}")
-                current_body["model"] = fallback
-                # إزالة أي معاملات غير مدعومة في نموذج الطوارئ
-                current_body.pop("chat_template_kwargs", None)
-                current_body.pop("frequency_penalty", None)
-                current_body.pop("presence_penalty", None)
-                # deepseek الطوارئ يحتاج thinking
-                if fallback == EMERGENCY_MODEL_ID:
-                    current_body["chat_template_kwargs"] = {"thinking": True}
-
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                async with client.stream(
-                    "POST",
-                    f"{NVIDIA_BASE_URL}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {current_api_key}",
-                        "Content-Type": "application/json",
-                        "Accept": "text/event-stream"
-                    },
-                    json=current_body
-                ) as response:
-
-                    if response.status_code == 429:
-                        print(f"[Provider] Key Rate Limited (429). Rotating key...")
-                        raise Exception("Upstream Rate Limit (429)")
-
-                    if response.status_code != 200:
-                        error_body = await response.aread()
-                        error_text = error_body.decode("utf-8", errors="ignore")[:300]
-                        print(f"[Provider] NVIDIA Error {response.status_code}: {error_text}")
-                        raise Exception(f"Status {response.status_code}")
-
-                    # 3 ثوانٍ للحصول على أول حرف — وإلا تبديل فوري للطوارئ
-                    byte_iter = response.aiter_bytes().__aiter__()
-                    try:
-                        first_byte = await asyncio.wait_for(
-                            byte_iter.__anext__(),
-                            timeout=FIRST_CHUNK_TIMEOUT
-                        )
-                    except asyncio.TimeoutError:
-                        print(f"[Provider] ⏱ First chunk timeout (>{FIRST_CHUNK_TIMEOUT}s) → emergency fallback")
-                        raise Exception("First chunk timeout")
-
-                    ttft_latency = int((time.time() - start_time) * 1000)
-                    response_tokens += 1
-                    yield first_byte
-
-                    async for chunk in byte_iter:
-                        response_tokens += 1
-                        yield chunk
-
-                    break
-
-        except Exception as e:
-            if attempt < max_attempts - 1:
-                print(f"[Provider] Attempt {attempt + 1} failed: {e}. Switching to emergency...")
-                continue
-
-            # كلتا المحاولتين فشلتا — صمت تام بدون رسالة خطأ للمستخدم
-            print(f"[Provider] Both attempts failed for {target_model_id}: {e}")
-            yield b"data: [DONE]\n\n"
+    # نماذج NVIDIA — سباق على أول chunk:
+    #   الأصلي فوراً → بعد hedge_delay طلب احتياطي (مفتاح آخر أو الطوارئ) ضمن ميزانية
+    #   التحوّط → أي فشل يُطلق نموذج الطوارئ فوراً بدل انتظار المهلة كاملة.
+    try:
+        attempt = await _race_first_chunk(current_body, target_model_id)
+    except asyncio.CancelledError:
+        # انقطع العميل قبل أول chunk — _race_first_chunk أغلق كل المحاولات
+        model_bulkheads.release(lease)
+        _record_disconnect(user_email, is_trial, start_time, 0, tokens_est, 0,
+                           internal_key, current_body.get("max_tokens"))
+        raise
+    except Exception as e:
+        # كل المحاولات فشلت — صمت تام بدون رسالة خطأ للمستخدم
+        model_bulkheads.release(lease)
+        print(f"[Provider] All attempts failed for {target_model_id}: {e}")
+        yield b"data: [DONE]\n\n"
+
+        final_latency = int((time.time() - start_time) * 1000)
+        if user_email:
+            if is_trial:
+                update_global_stats(final_latency, tokens_est, model_key=internal_key, is_error=True, is_internal=False, is_blocked=False)
+            else:
+                track_request_metrics(user_email, final_latency, tokens_est, model_key=internal_key, is_error=True)
+        return
 
-            final_latency = int((time.time() - start_time) * 1000)
-            if user_email:
-                if is_trial:
-                    update_global_stats(final_latency, tokens_est, model_key=internal_key, is_error=True, is_internal=False, is_blocked=False)
-                else:
-                    track_request_metrics(user_email, final_latency, tokens_est, model_key=internal_key, is_error=True)
-            return
+    ttft_latency = int((time.time() - start_time) * 1000)
+    if on_served is not None:
+        on_served(attempt.model)
+    # drop/summarize: التفكير يُحذف هنا؛ الفوترة تبقى على chunks الـ upstream الأصلية
+    rfilter = ReasoningFilter(reasoning_mode, target_model_id, tokens_est) if reasoning_mode != "keep" else None
+    try:
+        response_tokens += 1
+        if rfilter is None:
+            yield attempt.first_chunk
+            async for chunk in attempt.chunks:
+                response_tokens += 1
+                yield chunk
+        else:
+            out = rfilter.feed(attempt.first_chunk)
+            if out:
+                yield out
+            async for chunk in attempt.chunks:
+                response_tokens += 1
+                out = rfilter.feed(chunk)
+                if out:
+                    yield out
+            out = rfilter.flush()
+            if out:
+                yield out
+    except (asyncio.CancelledError, GeneratorExit):
+        # العميل أغلق الاتصال — finally يغلق upstream ويحرر المفتاح فوراً
+        _record_disconnect(user_email, is_trial, start_time, ttft_latency, tokens_est,
+                           response_tokens, internal_key, current_body.get("max_tokens"))
+        raise
+    except Exception as e:
+        # انقطاع بعد بدء البث — لا يمكن التبديل دون تكرار المحتوى
+        print(f"[Provider] Stream interrupted ({attempt.label}, {attempt.model}): {e}")
+        if rfilter is not None:
+            out = rfilter.flush()
+            if out:
+                yield out
+        yield b"data: [DONE]\n\n"
+    finally:
+        model_bulkheads.release(lease)
+        await attempt.aclose()
 
     final_metric_latency = ttft_latency if ttft_latency > 0 else int((time.time() - start_time) * 1000)
 
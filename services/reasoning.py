@@ -0,0 +1,311 @@
+import os
+import json
+import time
+
+from services.sse import SSEDecoder
+from services.context_budget import count_text_tokens
+
+# ============================================================================
+# REASONING FILTER — حذف أو تلخيص تفكير النماذج داخل البوابة
+# ============================================================================
+#  kimi-k2-thinking و deepseek يرسلون مئات أو آلاف دلتا reasoning_content (أو
+#  نصاً داخل <think>...</think> في content) قبل الرد الفعلي، وأغلب العملاء
+#  يتجاهلونها — ندفع نقلها وتحليلها عند العميل بلا فائدة.
+#
+#  اختياري لكل طلب: "reasoning_mode" في الـ body (لا يُرسل للنموذج) أو ترويسة
+#  X-Orgteh-Reasoning على /v1:
+#   "keep"      (افتراضي) — البث كما هو، بدون أي تحليل
+#   "drop"      — يُحذف reasoning_content ونص <think> من الدلتا؛ الأحداث التي
+#                 تفرغ تماماً لا تُرسل
+#   "summarize" — مثل drop، لكن قبل أول محتوى يُرسل reasoning_content واحد
+#                 مختصر (بداية التفكير ونهايته، REASONING_SUMMARY_CHARS حرفاً)
+#  في drop/summarize يُضاف usage.completion_tokens_details.reasoning_tokens:
+#  إلى usage الـ upstream إن وُجد، وإلا في chunk أخير (choices فارغة) قبل [DONE].
+#  الفوترة لا تتغير — تُحسب في providers على البث الأصلي.
+
+REASONING_MODES        = ("keep", "drop", "summarize")
+REASONING_MODE_DEFAULT = os.environ.get("REASONING_MODE_DEFAULT", "keep")
+REASONING_SUMMARY_CHARS = int(os.environ.get("REASONING_SUMMARY_CHARS", "600"))
+
+THINK_OPEN  = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def resolve_reasoning_mode(value) -> str:
+    value = (value or "").strip().lower() if isinstance(value, str) else ""
+    if value in REASONING_MODES:
+        return value
+    return REASONING_MODE_DEFAULT if REASONING_MODE_DEFAULT in REASONING_MODES else "keep"
+
+
+class ThinkTagSplitter:
+    """
+    يفصل <think>...</think> داخل نص متدفق إلى أجزاء (is_reasoning, text).
+    الوسم قد ينقسم بين دلتاين ("<thi" ثم "nk>") — الجزء المحتمل يُحتجز حتى الدلتا التالية.
+    """
+
+    def __init__(self):
+        self.in_think = False
+        self._pending = ""
+
+    @staticmethod
+    def _partial_suffix(text: str, tag: str) -> int:
+        """طول أطول نهاية لـ text تكون بداية لـ tag (بدون الوسم كاملاً)."""
+        for k in range(min(len(text), len(tag) - 1), 0, -1):
+            if text.endswith(tag[:k]):
+                return k
+        return 0
+
+    def feed(self, text: str) -> list:
+        if self._pending:
+            text = self._pending + text
+            self._pending = ""
+        parts = []
+        while text:
+            tag = THINK_CLOSE if self.in_think else THINK_OPEN
+            i = text.find(tag)
+            if i >= 0:
+                if i:
+                    parts.append((self.in_think, text[:i]))
+                text = text[i + len(tag):]
+                self.in_think = not self.in_think
+                continue
+            keep = self._partial_suffix(text, tag) if "<" in text[-len(tag):] else 0
+            if keep:
+                self._pending = text[-keep:]
+                text = text[:-keep]
+            if text:
+                parts.append((self.in_think, text))
+            break
+        return parts
+
+    def flush(self) -> list:
+        """نهاية البث: ما احتُجز لم يكن وسماً — يعود لحالته الحالية."""
+        text, self._pending = self._pending, ""
+        return [(self.in_think, text)] if text else []
+
+
+class _ReasoningExtract:
+    """بداية التفكير ونهايته فقط — الذاكرة ثابتة مهما طال التفكير."""
+
+    def __init__(self, limit: int):
+        self.half = max(1, limit // 2)
+        self.head = ""
+        self.tail = ""
+        self.size = 0
+
+    def add(self, text: str):
+        self.size += len(text)
+        if len(self.head) < self.half:
+            room = self.half - len(self.head)
+            self.head += text[:room]
+            text = text[room:]
+        if text:
+            self.tail = (self.tail + text)[-self.half:]
+
+    def summary(self) -> str:
+        if not self.tail:
+            return self.head.strip()
+        head = self.head
+        cut = max(head.rfind(". "), head.rfind("\n"))
+        if cut > len(head) // 2:
+            head = head[:cut + 1]
+        tail = self.tail
+        if self.size > len(self.head) + len(self.tail):
+            start = max(tail.find(". "), tail.find("\n"))
+            if 0 <= start < len(tail) // 2:
+                tail = tail[start + 1:]
+            return f"{head.strip()} … {tail.strip()}"
+        return (head + tail).strip()
+
+
+class ReasoningFilter:
+    """
+    يُغذّى ببايتات SSE من upstream ويعيد البايتات المعدلة (قد تكون فارغة).
+    الأحداث التي لم تتغير تُمرر بنصها الأصلي بدون إعادة ترميز JSON.
+    """
+
+    def __init__(self, mode: str, model: str = None, prompt_tokens: int = 0):
+        self.mode              = mode
+        self.model             = model
+        self.prompt_tokens     = prompt_tokens
+        self.reasoning_tokens  = 0
+        self.content_tokens    = 0
+        self.bytes_in          = 0
+        self.bytes_out         = 0
+        self.events_dropped    = 0
+        self._id               = None
+        self._decoder          = SSEDecoder()
+        self._splitter         = ThinkTagSplitter()
+        self._extract          = _ReasoningExtract(REASONING_SUMMARY_CHARS) if mode == "summarize" else None
+        self._summary_sent     = False
+        self._usage_seen       = False
+        self._finished         = False
+        self._recorded         = False
+        self._passthrough      = False
+
+    # ── Feeding ─────────────────────────────────────────────────────────────
+
+    def feed(self, chunk: bytes) -> bytes:
+        if not self.bytes_in and chunk.lstrip()[:1] == b"{":
+            # رد JSON غير متدفق رغم stream=true — يُمرر كما هو
+            self._passthrough = True
+        self.bytes_in += len(chunk)
+        if self._passthrough:
+            return chunk
+        return self._emit(b"".join(self._event(ev) for ev in self._decoder.feed(chunk)))
+
+    def flush(self) -> bytes:
+        """نهاية البث بدون [DONE] (انقطاع أو upstream لم يرسله)."""
+        if self._passthrough:
+            return b""
+        out = b"".join(self._event(ev) for ev in self._decoder.flush())
+        if not self._finished:
+            out += self._tail()
+        return self._emit(out)
+
+    def _emit(self, out: bytes) -> bytes:
+        self.bytes_out += len(out)
+        if self._finished and not self._recorded:
+            self._recorded = True
+            reasoning_stats.record(self)
+        return out
+
+    def _reasoning(self, text: str):
+        # الدلتا توكن واحد على الأقل حتى مع تقدير chars/4
+        self.reasoning_tokens += max(1, count_text_tokens(text))
+        if self._extract is not None:
+            self._extract.add(text)
+
+    def _take_summary(self):
+        if self._extract is None or self._summary_sent or not self._extract.size:
+            return None
+        self._summary_sent = True
+        return self._extract.summary()
+
+    def _event(self, ev) -> bytes:
+        if ev.done:
+            return (b"" if self._finished else self._tail()) + b"data: [DONE]\n\n"
+        obj = ev.json()
+        if not isinstance(obj, dict):
+            return b"data: " + ev.data + b"\n\n"
+        if self._id is None:
+            self._id = obj.get("id")
+        if obj.get("model"):
+            self.model = obj["model"]
+
+        changed = False
+        empty = True
+        for choice in obj.get("choices") or ():
+            delta = choice.get("delta")
+            if not isinstance(delta, dict):
+                empty = False
+                continue
+            for key in ("reasoning_content", "reasoning"):
+                if key in delta:
+                    value = delta.pop(key)
+                    changed = True
+                    if isinstance(value, str) and value:
+                        self._reasoning(value)
+
+            content = delta.get("content")
+            if content:
+                kept = []
+                for is_reasoning, text in self._splitter.feed(content):
+                    if is_reasoning:
+                        self._reasoning(text)
+                    else:
+                        kept.append(text)
+                kept = "".join(kept)
+                if kept != content:
+                    delta["content"] = kept
+                    changed = True
+                if kept:
+                    self.content_tokens += max(1, count_text_tokens(kept))
+                    summary = self._take_summary()
+                    if summary:
+                        delta["reasoning_content"] = summary
+                        changed = True
+
+            if choice.get("finish_reason"):
+                summary = self._take_summary()
+                if summary:
+                    delta["reasoning_content"] = summary
+                    changed = True
+            if any(delta.values()) or choice.get("finish_reason"):
+                empty = False
+
+        if obj.get("usage"):
+            self._usage_seen = True
+            usage = obj["usage"]
+            details = dict(usage.get("completion_tokens_details") or {})
+            details["reasoning_tokens"] = max(details.get("reasoning_tokens") or 0, self.reasoning_tokens)
+            usage["completion_tokens_details"] = details
+            changed = True
+            empty = False
+
+        if changed and empty and obj.get("choices"):
+            self.events_dropped += 1
+            return b""
+        if not changed:
+            return b"data: " + ev.data + b"\n\n"
+        return b"data: " + json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+    # ── End of stream ───────────────────────────────────────────────────────
+
+    def _chunk(self, choices: list, usage: dict = None) -> bytes:
+        obj = {"id": self._id or "chatcmpl-gateway", "object": "chat.completion.chunk",
+               "created": int(time.time()), "model": self.model, "choices": choices}
+        if usage is not None:
+            obj["usage"] = usage
+        return b"data: " + json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+    def _tail(self) -> bytes:
+        self._finished = True
+        out = b""
+        for is_reasoning, text in self._splitter.flush():
+            if is_reasoning:
+                self._reasoning(text)
+            else:
+                self.content_tokens += max(1, count_text_tokens(text))
+                out += self._chunk([{"index": 0, "delta": {"content": text}, "finish_reason": None}])
+        summary = self._take_summary()
+        if summary:
+            out += self._chunk([{"index": 0, "delta": {"reasoning_content": summary}, "finish_reason": None}])
+        if not self._usage_seen:
+            completion = self.content_tokens + self.reasoning_tokens
+            out += self._chunk([], usage={
+                "prompt_tokens":     self.prompt_tokens,
+                "completion_tokens": completion,
+                "total_tokens":      self.prompt_tokens + completion,
+                "completion_tokens_details": {"reasoning_tokens": self.reasoning_tokens},
+            })
+        return out
+
+
+class ReasoningStats:
+    def __init__(self):
+        self._modes = {}
+
+    def record(self, f: ReasoningFilter):
+        s = self._modes.get(f.mode)
+        if s is None:
+            s = self._modes[f.mode] = {"streams": 0, "reasoning_tokens": 0, "bytes_in": 0,
+                                       "bytes_out": 0, "events_dropped": 0}
+        s["streams"]          += 1
+        s["reasoning_tokens"] += f.reasoning_tokens
+        s["bytes_in"]         += f.bytes_in
+        s["bytes_out"]        += f.bytes_out
+        s["events_dropped"]   += f.events_dropped
+
+    def stats(self) -> dict:
+        modes = {}
+        for mode, s in self._modes.items():
+            saved = s["bytes_in"] - s["bytes_out"]
+            modes[mode] = {**s, "bytes_saved": saved,
+                           "bytes_saved_pct": round(100 * saved / s["bytes_in"], 1) if s["bytes_in"] else 0.0}
+        return {"default_mode": resolve_reasoning_mode(None), "summary_chars": REASONING_SUMMARY_CHARS,
+                "modes": modes}
+
+
+reasoning_stats = ReasoningStats()
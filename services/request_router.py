@@ -6,24 +6,81 @@ from services.limits import check_request_allowance, check_trial_allowance
 from services.providers import (
     smart_chat_stream,
     acquire_provider_slot,
+    AdmissionRejected,
     HIDDEN_MODELS,
+    MODEL_MAPPING,
+    estimate_tokens,
 )
-from database import get_user_by_api_key, get_redis
+from services.response_cache import (
+    ResponseCache,
+    wants_cache,
+    is_deterministic,
+    cache_key,
+    RESPONSE_CACHE_HIT_POLICY,
+)
+from services.completion import CompletionAggregator, collect_completion
+from services.sse import aiter_sse
+from services.disconnect import cancel_on_disconnect
+from database import get_user_by_api_key, get_redis, get_user_by_email
+from services.metrics_pipeline import track_request_metrics, update_global_stats
 
 router = APIRouter()
 
+_CAPACITY_ERROR = "System is currently at maximum capacity. Please try again in a few seconds."
+_UPSTREAM_ERROR = {"error": {"message": "The model did not return a completion. Please retry.",
+                             "type": "upstream_error", "code": "upstream_failed"}}
+
+response_cache = ResponseCache(redis_getter=get_redis)
+
+
+def _prompt_tokens(payload: dict) -> int:
+    return sum(estimate_tokens(m.get("content", "")) for m in payload.get("messages", []))
+
+
+def _cache_hit_response(email: str, payload: dict, entry: dict, non_streaming: bool = False):
+    """يعيد الرد المحفوظ كـ SSE (أو JSON) ويحتسبه حسب RESPONSE_CACHE_HIT_POLICY."""
+    model_key = MODEL_MAPPING.get(payload.get("model"), "unknown")
+    tokens    = entry.get("tokens", 0) if RESPONSE_CACHE_HIT_POLICY == "full" else 0
+
+    def _on_done():
+        if RESPONSE_CACHE_HIT_POLICY == "free":
+            update_global_stats(0, 0, model_key=model_key)
+        else:
+            track_request_metrics(email, 0, tokens, model_key=model_key)
+
+    if non_streaming:
+        agg = CompletionAggregator(payload.get("model"), _prompt_tokens(payload))
+        for chunk in entry["chunks"]:
+            agg.feed(chunk.encode("utf-8"))
+        agg.close()
+        _on_done()
+        return JSONResponse(agg.result(), headers={"X-Cache": "HIT"})
+
+    return StreamingResponse(
+        ResponseCache.replay(entry, on_done=_on_done),
+        media_type="text/event-stream",
+        headers={"X-Cache": "HIT"},
+    )
+
 # ============================================================================
 # CORE ROUTING FUNCTION — تُستخدم داخلياً وبواسطة endpoints أخرى
 # ============================================================================
 
-async def handle_chat_request(email: str, payload: dict):
+async def handle_chat_request(email: str, payload: dict, allow_json: bool = False, request: Request = None):
     """
     نقطة التحكم المركزية:
     1. تتحقق من توفر الموديل.
     2. تفحص رصيد المستخدم عبر limits.py.
     3. توجه الطلب للطابور المناسب عبر providers.py.
+    عند طلب الكاش ("cache": true) تُعاد الإصابة مباشرة بدون NVIDIA.
+    allow_json: مع "stream": false صريح يُجمَّع البث في رد chat.completion واحد
+    (واجهة /v1 فقط — واجهة الموقع ترسل stream=false وتتوقع SSE).
+    request: إن مُرِّر يُلغى upstream فور انقطاع العميل.
     """
     model_id = payload.get("model")
+    non_streaming = allow_json and payload.get("stream") is False
+    if non_streaming:
+        payload["stream"] = True   # المزود دائماً متدفق؛ التجميع هنا
 
     # 1. فحص الموديل
     if model_id in HIDDEN_MODELS:
@@ -32,7 +89,32 @@ async def handle_chat_request(email: str, payload: dict):
             status_code=404,
         )
 
-    # 2. فحص الحدود والأولوية
+    # 2. كاش الردود (اختياري، temperature=0 فقط)
+    key, cache_header = None, None
+    if wants_cache(payload):
+        if is_deterministic(payload):
+            key = cache_key(payload)
+            entry = response_cache.get(key)
+            if entry is not None:
+                response_cache.count("hits")
+                if RESPONSE_CACHE_HIT_POLICY == "free":
+                    if not get_user_by_email(email):
+                        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+                    return _cache_hit_response(email, payload, entry, non_streaming)
+                allowed, _ = await check_request_allowance(email, model_id)
+                if not allowed:
+                    return JSONResponse(
+                        {"error": "Quota limit reached. Please upgrade your plan or wait until renewal."},
+                        status_code=429,
+                    )
+                return _cache_hit_response(email, payload, entry, non_streaming)
+            response_cache.count("misses")
+            cache_header = "MISS"
+        else:
+            response_cache.count("bypass")
+            cache_header = "BYPASS"
+
+    # 3. فحص الحدود والأولوية
     allowed, is_priority = await check_request_allowance(email, model_id)
 
     if not allowed:
@@ -41,18 +123,25 @@ async def handle_chat_request(email: str, payload: dict):
             status_code=429,
         )
 
-    # 3. التنفيذ الذكي
+    # 4. التنفيذ الذكي
     try:
-        await acquire_provider_slot(is_priority=is_priority)
-        return StreamingResponse(
-            smart_chat_stream(payload, email),
-            media_type="text/event-stream",
-        )
+        await acquire_provider_slot(is_priority=is_priority, email=email)
     except Exception as e:
-        return JSONResponse(
-            {"error": "System is currently at maximum capacity. Please try again in a few seconds."},
-            status_code=503,
-        )
+        return JSONResponse({"error": _CAPACITY_ERROR}, status_code=503)
+
+    headers = {"X-Cache": cache_header} if cache_header else None
+    served  = {}
+    stream  = smart_chat_stream(payload, email, on_served=lambda m: served.update(model=m))
+    if key is not None:
+        stream = response_cache.record(key, model_id, _prompt_tokens(payload), stream, served)
+
+    if non_streaming:
+        agg = await collect_completion(stream, model_id, _prompt_tokens(payload))
+        if agg.failed:
+            return JSONResponse(_UPSTREAM_ERROR, status_code=502, headers=headers)
+        return JSONResponse(agg.result(), headers=headers)
+
+    return StreamingResponse(cancel_on_disconnect(request, stream), media_type="text/event-stream", headers=headers)
 
 # ============================================================================
 # CHAT ENDPOINTS
@@ -95,12 +184,14 @@ async def trial_chat_endpoint(request: Request):
         if "deepseek" in payload["model"] and "chat_template_kwargs" not in payload:
             payload["chat_template_kwargs"] = {"thinking": True}
 
-        await acquire_provider_slot(is_priority=False)
+        await acquire_provider_slot(is_priority=False, email=email)
         return StreamingResponse(
-            smart_chat_stream(payload, email, is_trial=True),
+            cancel_on_disconnect(request, smart_chat_stream(payload, email, is_trial=True)),
             media_type="text/event-stream",
         )
 
+    except AdmissionRejected:
+        return JSONResponse({"error": _CAPACITY_ERROR}, status_code=503)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
@@ -129,9 +220,9 @@ async def internal_chat_ui(request: Request):
             }
             if "deepseek" in payload["model"]:
                 payload["chat_template_kwargs"] = {"thinking": True}
-            await acquire_provider_slot(is_priority=False)
+            await acquire_provider_slot(is_priority=False, email=email)
             return StreamingResponse(
-                smart_chat_stream(payload, email, is_trial=True),
+                cancel_on_disconnect(request, smart_chat_stream(payload, email, is_trial=True)),
                 media_type="text/event-stream",
             )
 
@@ -144,8 +235,10 @@ async def internal_chat_ui(request: Request):
         if "deepseek" in payload["model"]:
             payload["chat_template_kwargs"] = {"thinking": True}
 
-        return await handle_chat_request(email, payload)
+        return await handle_chat_request(email, payload, request=request)
 
+    except AdmissionRejected:
+        return JSONResponse({"error": _CAPACITY_ERROR}, status_code=503)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
@@ -168,7 +261,12 @@ async def openai_compatible_proxy(request: Request):
     except Exception:
         return JSONResponse({"error": "Invalid JSON"}, 400)
 
-    return await handle_chat_request(user["email"], body)
+    if wants_cache(body, request.headers.get("X-Orgteh-Cache")):
+        body["cache"] = True
+    if request.headers.get("X-Orgteh-Reasoning") and "reasoning_mode" not in body:
+        body["reasoning_mode"] = request.headers["X-Orgteh-Reasoning"]
+
+    return await handle_chat_request(user["email"], body, allow_json=True, request=request)
 
 
 # ============================================================================
@@ -215,17 +313,13 @@ async def support_chat(request: Request):
 
         async def generate():
             try:
-                async for chunk in smart_chat_stream(payload, "support@orgteh.com", is_trial=True):
-                    text = chunk.decode("utf-8", errors="ignore") if isinstance(chunk, bytes) else str(chunk)
-                    if text.startswith("data: "):
-                        text = text[6:]
-                    if text.strip() and text.strip() != "[DONE]":
-                        try:
-                            content = json.loads(text).get("choices", [{}])[0].get("delta", {}).get("content", "")
-                            if content:
-                                yield content.encode("utf-8")
-                        except Exception:
-                            pass
+                async for ev in aiter_sse(smart_chat_stream(payload, "support@orgteh.com", is_trial=True)):
+                    if ev.done:
+                        continue
+                    for obj in ev.json_items():
+                        content = (obj.get("choices") or [{}])[0].get("delta", {}).get("content", "")
+                        if content:
+                            yield content.encode("utf-8")
             except Exception:
                 yield ("عذراً، حدث خطأ." if lang == "ar" else "Sorry, an error occurred.").encode("utf-8")
 
@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+from services.reasoning import resolve_reasoning_mode
+
+# ============================================================================
+# EXACT-MATCH RESPONSE CACHE — إعادة رد محفوظ لطلبات temperature=0 المتطابقة
+# ============================================================================
+#  اختياري لكل طلب: "cache": true في الـ body أو ترويسة X-Orgteh-Cache: 1.
+#  المفتاح = sha256 لتمثيل JSON قانوني (model + messages + معاملات التوليد
+#  + reasoning_mode بعد حله — drop/summarize يغيّران البث المحفوظ).
+#  التخزين: Redis (مشترك بين العمال) مع نسخة محلية LRU صغيرة أمامه.
+#  يُحفظ الرد فقط إذا اكتمل بـ finish_reason (stop/length) وخدمه النموذج المطلوب
+#  منطقياً (smart_chat_stream → on_served؛ أي endpoint لنفس النموذج مقبول رغم
+#  اختلاف اسم "model" في الرد) — لا تُخزّن ردود نموذج الطوارئ ولا البث المنقطع.
+#
+#  سياسة احتساب الإصابة (RESPONSE_CACHE_HIT_POLICY):
+#    full    : تُحتسب كطلب كامل (الحصة + التوكنات)
+#    request : تُحتسب من حصة الطلبات اليومية فقط بدون توكنات (الافتراضي)
+#    free    : لا تُحتسب على المستخدم
+
+RESPONSE_CACHE_TTL        = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_BYTES  = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024)))
+RESPONSE_CACHE_HIT_POLICY = os.environ.get("RESPONSE_CACHE_HIT_POLICY", "request")
+RESPONSE_CACHE_LOCAL_MAX  = 512
+RESPONSE_CACHE_PREFIX     = "rcache:"
+
+# معاملات تغيّر الناتج — أي شيء آخر في الـ body (stream، user، ...) لا يدخل المفتاح
+_SAMPLING_FIELDS = (
+    "temperature", "top_p", "max_tokens", "frequency_penalty", "presence_penalty",
+    "stop", "seed", "chat_template_kwargs", "response_format", "tools", "tool_choice",
+)
+_FINISH_RE = re.compile(rb'"finish_reason"\s*:\s*"(stop|length)"')
+
+_OPT_IN_VALUES = ("1", "true", "yes", "on")
+
+
+def wants_cache(payload: dict, header_value: str = None) -> bool:
+    """يقرأ ويُزيل حقل cache من الـ payload (لا يُرسل لـ NVIDIA)."""
+    flag = payload.pop("cache", None)
+    if header_value is not None and str(header_value).lower() in _OPT_IN_VALUES:
+        return True
+    return flag is True or str(flag).lower() in _OPT_IN_VALUES
+
+
+def is_deterministic(payload: dict) -> bool:
+    try:
+        return float(payload.get("temperature", 1.0)) == 0.0
+    except (TypeError, ValueError):
+        return False
+
+
+def cache_key(payload: dict) -> str:
+    canonical = {"model": payload.get("model"), "messages": payload.get("messages", []),
+                 "reasoning_mode": resolve_reasoning_mode(payload.get("reasoning_mode"))}
+    for field in _SAMPLING_FIELDS:
+        if field in payload:
+            canonical[field] = payload[field]
+    raw = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, redis_getter=None, ttl: int = RESPONSE_CACHE_TTL,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, local_max: int = RESPONSE_CACHE_LOCAL_MAX,
+                 clock=time.time):
+        self._get_redis = redis_getter
+        self.ttl        = ttl
+        self.max_bytes  = max_bytes
+        self.local_max  = local_max
+        self._clock     = clock
+        self._local     = OrderedDict()     # key → (expires_at, entry)
+        self._stats     = {"hits": 0, "misses": 0, "bypass": 0, "stored": 0,
+                           "skipped_too_large": 0, "skipped_incomplete": 0}
+
+    def _redis(self):
+        return self._get_redis() if self._get_redis else None
+
+    # ── Lookup / store ──────────────────────────────────────────────────────
+
+    def get(self, key: str) -> dict | None:
+        now = self._clock()
+        hit = self._local.get(key)
+        if hit is not None:
+            if hit[0] > now:
+                self._local.move_to_end(key)
+                return hit[1]
+            del self._local[key]
+
+        r = self._redis()
+        if r is None:
+            return None
+        try:
+            raw = r.get(RESPONSE_CACHE_PREFIX + key)
+        except Exception:
+            return None
+        if not raw:
+            return None
+        entry = json.loads(raw)
+        self._remember(key, entry, now + self.ttl)
+        return entry
+
+    def _remember(self, key: str, entry: dict, expires_at: float):
+        self._local[key] = (expires_at, entry)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_max:
+            self._local.popitem(last=False)
+
+    def put(self, key: str, chunks: list, tokens: int):
+        # حدود الـ chunks من الشبكة عشوائية (قد تقطع حرفاً UTF-8) — نخزن أحداث SSE كاملة
+        body   = b"".join(chunks).decode("utf-8", errors="replace")
+        events = [e + "\n\n" for e in body.split("\n\n") if e.strip()]
+        entry = {
+            "chunks":    events,
+            "tokens":    tokens,
+            "stored_at": int(self._clock()),
+        }
+        self._remember(key, entry, self._clock() + self.ttl)
+        self._stats["stored"] += 1
+        r = self._redis()
+        if r is None:
+            return
+        try:
+            r.setex(RESPONSE_CACHE_PREFIX + key, self.ttl, json.dumps(entry, ensure_ascii=False))
+        except Exception as e:
+            print(f"[ResponseCache] store failed: {e}")
+
+    # ── Streaming wrappers ──────────────────────────────────────────────────
+
+    async def record(self, key: str, model_id: str, prompt_tokens: int, stream, served: dict):
+        """
+        يمرر البث كما هو ويحفظه في النهاية إذا كان مكتملاً وضمن الحجم.
+        served: {"model": ...} يملؤه on_served في smart_chat_stream.
+        """
+        chunks, size, complete = [], 0, False
+        tail = b""      # نهاية الـ chunk السابق — الحقل قد ينقسم بين chunkين
+        async for chunk in stream:
+            if size <= self.max_bytes:
+                chunks.append(chunk)
+                size += len(chunk)
+            if not complete and _FINISH_RE.search(tail + chunk):
+                complete = True
+            tail = chunk[-128:]
+            yield chunk
+
+        if size > self.max_bytes:
+            self._stats["skipped_too_large"] += 1
+        elif not complete or served.get("model") != model_id:
+            self._stats["skipped_incomplete"] += 1
+        else:
+            self.put(key, chunks, prompt_tokens + len(chunks))  # نفس تقدير smart_chat_stream
+
+    @staticmethod
+    async def replay(entry: dict, on_done=None):
+        for chunk in entry["chunks"]:
+            yield chunk.encode("utf-8")
+        if on_done is not None:
+            on_done()
+
+    # ── Metrics ─────────────────────────────────────────────────────────────
+
+    def count(self, outcome: str):
+        self._stats[outcome] += 1
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "ttl_sec":       self.ttl,
+            "max_bytes":     self.max_bytes,
+            "hit_policy":    RESPONSE_CACHE_HIT_POLICY,
+            "local_entries": len(self._local),
+            "hit_rate":      round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            **self._stats,
+        }
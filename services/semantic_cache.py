@@ -0,0 +1,317 @@
+import os
+import re
+import time
+import asyncio
+import zlib
+import hashlib
+
+import numpy as np
+
+# ============================================================================
+# SEMANTIC RESPONSE CACHE — ردود محفوظة للأسئلة المتشابهة في المعنى
+# ============================================================================
+#  يُضمَّن آخر سؤال للمستخدم (embedding) ويُبحث عنه في فهرس متجهات محلي
+#  (مصفوفة numpy مُطبَّعة → cosine = dot product). إذا تجاوز التشابه عتبة
+#  المسار يُعاد الرد المحفوظ بدون NVIDIA.
+#
+#  العزل: لكل (مسار، مستأجر، بصمة system prompt) فهرس مستقل — ردود widget
+#  لا تظهر أبداً لـ widget آخر، وتعديل إعدادات الـ widget يبدأ فهرساً جديداً.
+#  الإخلاء: TTL لكل مدخل + LRU عند امتلاء الفهرس (SEMANTIC_CACHE_MAX_ENTRIES).
+#  المُضمِّن: "nvidia" (افتراضي — nemoretriever عبر embedding_batcher، أي نفس
+#  تجميع /v1/embeddings وقبوله) أو "hashing" (محلي بدون شبكة — للاختبار والتشغيل
+#  بدون مفاتيح فقط: سؤالان يختلفان بكلمة مفتاحية واحدة يتجاوزان العتبة بسهولة).
+#  حارس الكيانات: التشابه وحده لا يكفي للإصابة — يجب أن تتطابق الكيانات في
+#  السؤالين (أسماء النماذج والمنتجات من الكتالوج، الأرقام، SEMANTIC_CACHE_ENTITY_TERMS)
+#  فـ "سعر deepseek" لا يعيد رد "سعر kimi" مهما كان المتجهان متقاربين. بقية
+#  الكلمات يحكم عليها التشابه: "how much does deepseek cost" و"price of deepseek" إصابة.
+#  التضمين محدود بـ SEMANTIC_CACHE_EMBED_TIMEOUT — تجاوزه miss، لا انتظار للقبول.
+
+SEMANTIC_CACHE_EMBEDDER    = os.environ.get("SEMANTIC_CACHE_EMBEDDER", "nvidia")
+SEMANTIC_CACHE_TTL         = int(os.environ.get("SEMANTIC_CACHE_TTL", str(6 * 3600)))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+SEMANTIC_CACHE_MAX_TENANTS = 500
+SEMANTIC_CACHE_MAX_ANSWER  = 16 * 1024    # أحرف — الردود الأطول لا تُخزّن
+SEMANTIC_CACHE_EMBED_TIMEOUT = float(os.environ.get("SEMANTIC_CACHE_EMBED_TIMEOUT", "1.0"))
+# أسماء منتجات إضافية تُعامل ككيانات (مفصولة بفواصل)
+SEMANTIC_CACHE_ENTITY_TERMS = os.environ.get("SEMANTIC_CACHE_ENTITY_TERMS", "orgteh,nexus")
+
+# عتبة التشابه لكل مسار (cosine)
+SEMANTIC_CACHE_THRESHOLDS = {
+    "support": float(os.environ.get("SEMANTIC_CACHE_THRESHOLD_SUPPORT", "0.92")),
+    "widget":  float(os.environ.get("SEMANTIC_CACHE_THRESHOLD_WIDGET", "0.90")),
+}
+_DEFAULT_THRESHOLD = 0.95
+
+# ============================================================================
+# EMBEDDERS
+# ============================================================================
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_STOPWORDS = frozenset("""
+a an the and or but if of to in on at by for with from about as into over is are was were be been
+being am do does did done have has had can could will would shall should may might must not no
+yes it its this that these those there here i me my we our you your he she they them their what
+which who whom whose when where why how please thanks thank hi hello hey any some all just also
+so than then too very get got tell know want need like
+في من إلى الى على عن مع هل ما ماذا لماذا كيف كم متى أين اين هو هي هم هذا هذه ذلك تلك التي الذي
+الذين أن ان إن أو او ثم لا لم لن قد كان كانت يكون عند عندي لدي لديكم أنا انا نحن أنت انت أريد
+اريد ممكن يمكن لو بعد قبل كل بعض أي اي مرحبا شكرا السلام عليكم من فضلك لو سمحت
+""".split())
+
+
+# أجزاء أسماء النماذج العامة التي لا تميّز نموذجاً عن آخر
+_GENERIC_MODEL_WORDS = frozenset(("ai", "instruct", "chat", "model", "embed"))
+_entity_vocab = None
+
+
+def content_words(text: str) -> frozenset:
+    """الكلمات المميزة للسؤال (بعد حذف stopwords وأداة التعريف)."""
+    words = set()
+    for word in _WORD_RE.findall(text.lower()):
+        if word in _STOPWORDS or (len(word) == 1 and not word.isdigit()):
+            continue
+        if word.startswith("ال") and len(word) > 4 and word[2:] not in _STOPWORDS:
+            word = word[2:]      # "السعر" و"سعر" نفس الكلمة
+        words.add(word)
+    return frozenset(words)
+
+
+def _entity_terms() -> frozenset:
+    """كلمات أسماء النماذج ومزوديها من الكتالوج + SEMANTIC_CACHE_ENTITY_TERMS (تُبنى مرة)."""
+    global _entity_vocab
+    if _entity_vocab is None:
+        from services.providers import MODELS_METADATA
+
+        terms = {t.strip().lower() for t in SEMANTIC_CACHE_ENTITY_TERMS.split(",") if t.strip()}
+        for m in MODELS_METADATA:
+            for field in ("id", "short_key", "name", "provider"):
+                terms.update(_WORD_RE.findall(str(m.get(field, "")).lower()))
+        _entity_vocab = frozenset(t for t in terms
+                                  if len(t) > 1 and t not in _GENERIC_MODEL_WORDS and t not in _STOPWORDS)
+    return _entity_vocab
+
+
+def entity_words(text: str) -> frozenset:
+    """الكيانات التي يجب أن تتطابق لقبول إصابة: أسماء من الكتالوج وأي كلمة فيها رقم."""
+    vocab = _entity_terms()
+    return frozenset(w for w in content_words(text)
+                     if w in vocab or any(c.isdigit() for c in w))
+
+
+class HashingEmbedder:
+    """
+    Feature hashing للكلمات وثلاثيات الأحرف — بدون نموذج ولا شبكة.
+    يلتقط إعادة الصياغة البسيطة (ترتيب الكلمات، علامات الترقيم، أخطاء إملائية).
+    """
+    name = "hashing"
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str):
+        for word in _WORD_RE.findall(text.lower()):
+            yield word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    async def embed(self, text: str) -> np.ndarray:
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in self._features(text):
+            h = zlib.crc32(feature.encode("utf-8"))
+            vec[h % self.dim] += weight if (h >> 31) & 1 else -weight
+        return vec
+
+
+class NvidiaEmbedder:
+    """nemoretriever عبر embedding_batcher — أدق لإعادة الصياغة، ويُجمَّع مع طلبات /v1/embeddings."""
+    name = "nvidia"
+
+    async def embed(self, text: str) -> np.ndarray:
+        from services.embeddings import embedding_batcher, EMBED_DEFAULT_MODEL
+
+        vectors = await embedding_batcher.embed([text], EMBED_DEFAULT_MODEL, "query", "END")
+        return np.asarray(vectors[0], dtype=np.float32)
+
+
+def build_embedder(name: str = SEMANTIC_CACHE_EMBEDDER):
+    return HashingEmbedder() if name == "hashing" else NvidiaEmbedder()
+
+# ============================================================================
+# VECTOR INDEX — فهرس واحد لكل مستأجر
+# ============================================================================
+
+class _VectorIndex:
+    _INITIAL_ROWS = 32
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.vectors     = None           # (rows, dim) float32 — يتضاعف حتى max_entries
+        self.answers     = []
+        self.entities    = []
+        self.expires     = np.zeros(0, dtype=np.float64)
+        self.last_used   = np.zeros(0, dtype=np.float64)
+        self.size        = 0
+
+    def _reset(self, dim: int):
+        rows = min(self._INITIAL_ROWS, self.max_entries)
+        self.vectors   = np.zeros((rows, dim), dtype=np.float32)
+        self.answers   = [None] * rows
+        self.entities  = [None] * rows
+        self.expires   = np.zeros(rows, dtype=np.float64)
+        self.last_used = np.zeros(rows, dtype=np.float64)
+        self.size      = 0
+
+    def _grow(self):
+        rows = min(self.max_entries, len(self.answers) * 2)
+        extra = rows - len(self.answers)
+        self.vectors   = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.answers  += [None] * extra
+        self.entities += [None] * extra
+        self.expires   = np.concatenate([self.expires, np.zeros(extra)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(extra)])
+
+    def search(self, q: np.ndarray, entities: frozenset, threshold: float, now: float) -> tuple:
+        """
+        (أفضل تشابه، الموضع) بين المدخلات غير المنتهية التي تتجاوز العتبة وتطابق
+        كياناتها؛ الموضع -1 إذا لم يوجد. أفضل تشابه يُعاد للإحصاء حتى عند الرفض.
+        """
+        if self.size == 0 or self.vectors is None or self.vectors.shape[1] != q.shape[0]:
+            return 0.0, -1
+        scores = self.vectors[:self.size] @ q
+        scores[self.expires[:self.size] <= now] = -1.0
+        candidates = np.flatnonzero(scores >= threshold)
+        best = float(scores.max())
+        for idx in candidates[np.argsort(-scores[candidates])]:
+            if self.entities[idx] == entities:
+                return float(scores[idx]), int(idx)
+        return best, -1
+
+    def add(self, q: np.ndarray, entities: frozenset, answer: str, expires_at: float, now: float) -> bool:
+        """يُعيد True إذا أُخلي مدخل قديم لإفساح المكان."""
+        if self.vectors is None or self.vectors.shape[1] != q.shape[0]:
+            self._reset(q.shape[0])
+        if self.size == len(self.answers) and self.size < self.max_entries:
+            self._grow()
+        evicted = False
+        if self.size < len(self.answers):
+            slot = self.size
+            self.size += 1
+        else:
+            # منتهي الصلاحية أولاً، وإلا الأقل استخداماً
+            expired = np.where(self.expires[:self.size] <= now)[0]
+            slot = int(expired[0]) if len(expired) else int(np.argmin(self.last_used[:self.size]))
+            evicted = True
+        self.vectors[slot]   = q
+        self.answers[slot]   = answer
+        self.entities[slot]  = entities
+        self.expires[slot]   = expires_at
+        self.last_used[slot] = now
+        return evicted
+
+# ============================================================================
+# SEMANTIC CACHE
+# ============================================================================
+
+def _normalize(vec: np.ndarray) -> np.ndarray | None:
+    norm = float(np.linalg.norm(vec))
+    if norm == 0.0:
+        return None
+    return (vec / norm).astype(np.float32, copy=False)
+
+
+def tenant_namespace(route: str, tenant: str, system_prompt: str = "") -> str:
+    fingerprint = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()[:8] if system_prompt else "-"
+    return f"{route}:{tenant}:{fingerprint}"
+
+
+class SemanticCache:
+    def __init__(self, embedder=None, ttl: int = SEMANTIC_CACHE_TTL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+                 thresholds: dict = None, clock=time.time):
+        self.embedder    = embedder or build_embedder()
+        self.ttl         = ttl
+        self.max_entries = max_entries
+        self.thresholds  = thresholds if thresholds is not None else dict(SEMANTIC_CACHE_THRESHOLDS)
+        self._clock      = clock
+        self._indexes    = {}     # namespace → _VectorIndex (ترتيب الإدراج = LRU للمستأجرين)
+        self._stats      = {}     # route → counters
+
+    def _route_stats(self, route: str) -> dict:
+        stats = self._stats.get(route)
+        if stats is None:
+            stats = self._stats[route] = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0,
+                                          "entity_mismatch": 0, "embed_errors": 0,
+                                          "embed_timeouts": 0}
+        return stats
+
+    async def lookup(self, route: str, namespace: str, text: str) -> tuple:
+        """
+        (الرد المحفوظ أو None، مفتاح لإعادة استخدامه في store).
+        أي خطأ أو بطء في التضمين يُعامل كـ miss — الكاش لا يكسر المحادثة ولا يؤخرها.
+        """
+        stats = self._route_stats(route)
+        try:
+            q = _normalize(await asyncio.wait_for(self.embedder.embed(text), SEMANTIC_CACHE_EMBED_TIMEOUT))
+        except asyncio.TimeoutError:
+            stats["embed_timeouts"] += 1
+            stats["misses"] += 1
+            return None, None
+        except Exception as e:
+            stats["embed_errors"] += 1
+            print(f"[SemanticCache] embed failed: {e}")
+            return None, None
+        if q is None:
+            stats["misses"] += 1
+            return None, None
+
+        entities = entity_words(text)
+        index = self._indexes.get(namespace)
+        if index is not None:
+            now = self._clock()
+            threshold = self.thresholds.get(route, _DEFAULT_THRESHOLD)
+            score, idx = index.search(q, entities, threshold, now)
+            if idx >= 0:
+                index.last_used[idx] = now
+                self._indexes[namespace] = self._indexes.pop(namespace)
+                stats["hits"] += 1
+                return index.answers[idx], (q, entities)
+            if score >= threshold:
+                stats["entity_mismatch"] += 1
+        stats["misses"] += 1
+        return None, (q, entities)
+
+    def store(self, route: str, namespace: str, query, answer: str):
+        if query is None or not answer or len(answer) > SEMANTIC_CACHE_MAX_ANSWER:
+            return
+        vector, entities = query
+        index = self._indexes.pop(namespace, None)
+        if index is None:
+            index = _VectorIndex(self.max_entries)
+            while len(self._indexes) >= SEMANTIC_CACHE_MAX_TENANTS:
+                self._indexes.pop(next(iter(self._indexes)))
+        self._indexes[namespace] = index
+        now = self._clock()
+        stats = self._route_stats(route)
+        if index.add(vector, entities, answer, now + self.ttl, now):
+            stats["evicted"] += 1
+        stats["stored"] += 1
+
+    def stats(self) -> dict:
+        routes = {}
+        for route, s in self._stats.items():
+            lookups = s["hits"] + s["misses"]
+            routes[route] = {**s, "hit_rate": round(s["hits"] / lookups, 4) if lookups else 0.0,
+                             "threshold": self.thresholds.get(route, _DEFAULT_THRESHOLD)}
+        return {
+            "embedder":    getattr(self.embedder, "name", type(self.embedder).__name__),
+            "ttl_sec":     self.ttl,
+            "max_entries": self.max_entries,
+            "tenants":     len(self._indexes),
+            "entries":     sum(i.size for i in self._indexes.values()),
+            "routes":      routes,
+        }
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,163 @@
+import json
+
+# orjson أسرع بـ 3-5x في فك الـ chunks الصغيرة — اختياري
+try:
+    import orjson
+    _fast_loads = orjson.loads
+    FAST_JSON = True
+except ImportError:
+    _fast_loads = json.loads
+    FAST_JSON = False
+
+# ============================================================================
+# INCREMENTAL SSE DECODER — محلل SSE واحد لكل المسارات
+# ============================================================================
+#  يعمل على البايتات مباشرة ويحتفظ فقط بالسطر غير المكتمل بين chunkين:
+#   - حدود الـ chunks عشوائية (قد تقطع سطراً أو حرف UTF-8) → لا مشكلة.
+#   - \n و \r\n و \r كلها نهايات أسطر صحيحة.
+#   - حدث متعدد الأسطر (عدة data:) يُجمع بـ "\n" حسب المواصفة.
+#   - data: [DONE] → event.done = True.
+#   - التعليقات (":") و retry تُتجاهل.
+
+DONE = b"[DONE]"
+
+
+class SSEEvent:
+    __slots__ = ("event", "data", "id", "_json")
+
+    _UNSET = object()
+
+    def __init__(self, data: bytes, event: str = None, id: str = None):
+        self.data  = data
+        self.event = event
+        self.id    = id
+        self._json = SSEEvent._UNSET
+
+    @property
+    def done(self) -> bool:
+        return self.data == DONE
+
+    @property
+    def text(self) -> str:
+        return self.data.decode("utf-8", errors="replace")
+
+    def json(self):
+        """JSON المفكوك أو None إذا لم يكن JSON صالحاً (يُحسب مرة واحدة)."""
+        if self._json is SSEEvent._UNSET:
+            try:
+                self._json = _fast_loads(self.data)
+            except ValueError:
+                self._json = None
+        return self._json
+
+    def json_items(self) -> list:
+        """
+        كل كائنات JSON في الحدث. بعض المزودين يرسلون عدة "data:" بدون سطر فارغ
+        بينها — حسب المواصفة هذا حدث واحد، لكن كل سطر منها JSON مستقل.
+        """
+        obj = self.json()
+        if obj is not None:
+            return [obj]
+        items = []
+        for line in self.data.split(b"\n"):
+            if not line or line == DONE:
+                continue
+            try:
+                items.append(_fast_loads(line))
+            except ValueError:
+                pass
+        return items
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data[:60]!r})"
+
+
+class SSEDecoder:
+    def __init__(self):
+        self._buf   = b""
+        self._data  = []
+        self._event = None
+        self._id    = None
+        self._last_cr = False     # آخر chunk انتهى بـ \r — قد يتبعه \n في الـ chunk التالي
+
+    def feed(self, chunk: bytes) -> list:
+        """يُعيد الأحداث المكتملة في هذا الـ chunk (قد تكون صفراً)."""
+        if not chunk:
+            return []
+        if self._last_cr and chunk[:1] == b"\n":
+            chunk = chunk[1:]
+        self._last_cr = chunk[-1:] == b"\r"
+
+        data = self._buf + chunk if self._buf else chunk
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        events = []
+        start = 0
+        find = data.find
+        while True:
+            end = find(b"\n", start)
+            if end < 0:
+                break
+            ev = self._line(data[start:end])
+            if ev is not None:
+                events.append(ev)
+            start = end + 1
+        self._buf = data[start:]
+        return events
+
+    def flush(self) -> list:
+        """نهاية البث: سطر أخير بدون \\n وحدث بدون سطر فارغ يُعتبران مكتملين."""
+        events = []
+        if self._buf:
+            ev = self._line(self._buf)
+            self._buf = b""
+            if ev is not None:
+                events.append(ev)
+        ev = self._dispatch()
+        if ev is not None:
+            events.append(ev)
+        return events
+
+    def _line(self, line: bytes):
+        if not line:
+            return self._dispatch()
+        if line[:1] == b":":
+            return None
+        colon = line.find(b":")
+        if colon < 0:
+            field, value = line, b""
+        else:
+            field, value = line[:colon], line[colon + 1:]
+            if value[:1] == b" ":
+                value = value[1:]
+
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8", errors="replace")
+        elif field == b"id":
+            self._id = value.decode("utf-8", errors="replace")
+        return None
+
+    def _dispatch(self):
+        if not self._data:
+            self._event = None
+            return None
+        data = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+        ev = SSEEvent(data, self._event, self._id)
+        self._data  = []
+        self._event = None
+        return ev
+
+
+async def aiter_sse(byte_stream):
+    """يحول أي async iterator من البايتات (أو النصوص) إلى أحداث SSE."""
+    decoder = SSEDecoder()
+    async for chunk in byte_stream:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        for ev in decoder.feed(chunk):
+            yield ev
+    for ev in decoder.flush():
+        yield ev
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import deque
+
+# ============================================================================
+# ADAPTIVE FIRST-CHUNK TIMEOUTS — مهلة أول chunk تُتعلّم من TTFT الفعلي
+# ============================================================================
+#  لكل نموذج ولكل (نموذج، مفتاح) نافذة متحركة من أزمنة أول chunk الناجحة.
+#  المهلة = النسبة المئوية TTFT_PERCENTILE من النافذة، محصورة بين FLOOR و CEILING.
+#  قبل تجمع TTFT_MIN_SAMPLES عينة نستخدم نافذة النموذج، ثم القيمة الافتراضية.
+#  المهلة المنتهية تُسجَّل كعينة "مقطوعة" أكبر من المهلة نفسها حتى تستطيع المهلة
+#  أن ترتفع لنماذج التفكير بدل أن تبقى عالقة عند قيمتها الحالية.
+#  المحاولة الملغاة قبل أول chunk (خسرت سباق hedge، أو انقطع العميل) عينة مقطوعة
+#  أيضاً (TTFT ≥ الزمن المنقضي) — بدونها تسقط أبطأ المحاولات من النافذة فتنخفض
+#  النسبة، فيبدأ التحوّط أبكر، فتسقط عينات أبطأ... حلقة تغذية راجعة.
+#  العينات تُحفظ في Redis كل TTFT_PERSIST_SEC من مهمة خلفية (الكتابة في thread،
+#  لا شيء في مسار أول chunk) وتُحمَّل عند بدء التشغيل.
+
+TTFT_PERCENTILE      = float(os.environ.get("TTFT_PERCENTILE", "95"))
+TTFT_TIMEOUT_FLOOR   = float(os.environ.get("TTFT_TIMEOUT_FLOOR", "1.5"))
+TTFT_TIMEOUT_CEILING = float(os.environ.get("TTFT_TIMEOUT_CEILING", "15"))
+TTFT_MIN_SAMPLES     = 20
+TTFT_WINDOW          = 256
+TTFT_CENSORED_FACTOR = 1.5
+TTFT_PERSIST_SEC     = 60.0
+TTFT_REDIS_KEY       = "provider:ttft_samples"
+
+
+def _key_id(api_key: str) -> str:
+    """معرّف ثابت للمفتاح لا يكشف قيمته (للتخزين ولوحة الأدمن)."""
+    return hashlib.sha1(api_key.encode()).hexdigest()[:10]
+
+
+class _Series:
+    __slots__ = ("samples", "_sorted")
+
+    def __init__(self, samples=()):
+        self.samples = deque(samples, maxlen=TTFT_WINDOW)
+        self._sorted = None
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, pct: float) -> float:
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        values = self._sorted
+        idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+        return values[idx]
+
+
+class TTFTTracker:
+    def __init__(self, default_timeout: float, percentile: float = TTFT_PERCENTILE,
+                 floor: float = TTFT_TIMEOUT_FLOOR, ceiling: float = TTFT_TIMEOUT_CEILING,
+                 redis_getter=None, clock=time.monotonic):
+        self.default    = default_timeout
+        self.percentile = percentile
+        self.floor      = floor
+        self.ceiling    = ceiling
+        self._get_redis = redis_getter
+        self._clock     = clock
+        self._models    = {}      # model → _Series
+        self._pairs     = {}      # (model, key_id) → _Series
+        self._dirty     = False
+        self._task      = None
+
+    # ── Recording ───────────────────────────────────────────────────────────
+
+    def _series(self, table: dict, key) -> _Series:
+        series = table.get(key)
+        if series is None:
+            series = table[key] = _Series()
+        return series
+
+    def _add(self, model: str, api_key: str, seconds: float):
+        self._series(self._models, model).add(seconds)
+        self._series(self._pairs, (model, _key_id(api_key))).add(seconds)
+        self._dirty = True
+
+    def record(self, model: str, api_key: str, ttft_sec: float):
+        self._add(model, api_key, ttft_sec)
+
+    def record_timeout(self, model: str, api_key: str, timeout_sec: float):
+        self._add(model, api_key, min(self.ceiling, timeout_sec * TTFT_CENSORED_FACTOR))
+
+    def record_cancelled(self, model: str, api_key: str, elapsed_sec: float):
+        """
+        TTFT ≥ elapsed_sec. يُسجَّل فقط إذا بلغ النسبة الحالية للنموذج: حد أدنى أصغر
+        منها لا يقول شيئاً عن الذيل، وتسجيله كعينة يسحب النسبة للأسفل.
+        """
+        series = self._models.get(model)
+        if series and len(series.samples) >= TTFT_MIN_SAMPLES:
+            threshold = series.percentile(self.percentile)
+        else:
+            threshold = self.floor
+        if elapsed_sec >= threshold:
+            self._add(model, api_key, min(self.ceiling, elapsed_sec))
+
+    # ── Timeout ─────────────────────────────────────────────────────────────
+
+    def _clamp(self, value: float) -> float:
+        return max(self.floor, min(self.ceiling, value))
+
+    def timeout_for(self, model: str, api_key: str = None) -> float:
+        if api_key:
+            pair = self._pairs.get((model, _key_id(api_key)))
+            if pair and len(pair.samples) >= TTFT_MIN_SAMPLES:
+                return self._clamp(pair.percentile(self.percentile))
+        series = self._models.get(model)
+        if series and len(series.samples) >= TTFT_MIN_SAMPLES:
+            return self._clamp(series.percentile(self.percentile))
+        return self.default
+
+    # ── Persistence ─────────────────────────────────────────────────────────
+
+    def _snapshot_samples(self) -> dict:
+        return {
+            "models": {m: list(s.samples) for m, s in self._models.items()},
+            "pairs":  {f"{m}|{k}": list(s.samples) for (m, k), s in self._pairs.items()},
+        }
+
+    def _write(self, data: dict) -> bool:
+        r = self._get_redis() if self._get_redis else None
+        if r is None:
+            return False
+        try:
+            r.set(TTFT_REDIS_KEY, json.dumps(data))
+            return True
+        except Exception as e:
+            print(f"[TTFT] save failed: {e}")
+            return False
+
+    def save(self):
+        """حفظ متزامن — خارج event loop فقط (سكربتات)؛ الخادم يحفظ عبر start()/stop()."""
+        if self._dirty and self._write(self._snapshot_samples()):
+            self._dirty = False
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        # النسخ على الـ loop (العينات تتغير فيه)، الترميز والكتابة في thread
+        self._dirty = False
+        if not await asyncio.to_thread(self._write, self._snapshot_samples()):
+            self._dirty = True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TTFT_PERSIST_SEC)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def load(self):
+        r = self._get_redis() if self._get_redis else None
+        if r is None:
+            return
+        try:
+            raw = r.get(TTFT_REDIS_KEY)
+            if not raw:
+                return
+            data = json.loads(raw)
+            for model, samples in data.get("models", {}).items():
+                self._models[model] = _Series(samples)
+            for pair, samples in data.get("pairs", {}).items():
+                model, _, key_id = pair.rpartition("|")
+                self._pairs[(model, key_id)] = _Series(samples)
+            print(f"[TTFT] loaded samples for {len(self._models)} models")
+        except Exception as e:
+            print(f"[TTFT] load failed: {e}")
+
+    # ── Admin ───────────────────────────────────────────────────────────────
+
+    def snapshot(self) -> dict:
+        def _row(series: _Series) -> dict:
+            n = len(series.samples)
+            return {
+                "samples":   n,
+                "p50_ms":    round(series.percentile(50) * 1000) if n else None,
+                "p95_ms":    round(series.percentile(95) * 1000) if n else None,
+                "learned":   n >= TTFT_MIN_SAMPLES,
+            }
+
+        models = {}
+        for model, series in self._models.items():
+            row = _row(series)
+            row["timeout_sec"] = round(self.timeout_for(model), 2)
+            row["keys"] = {}
+            models[model] = row
+        for (model, key_id), series in self._pairs.items():
+            row = _row(series)
+            if row["learned"]:
+                row["timeout_sec"] = round(self._clamp(series.percentile(self.percentile)), 2)
+            models.setdefault(model, {"keys": {}})["keys"][key_id] = row
+        return {
+            "percentile":      self.percentile,
+            "floor_sec":       self.floor,
+            "ceiling_sec":     self.ceiling,
+            "default_sec":     self.default,
+            "min_samples":     TTFT_MIN_SAMPLES,
+            "models":          models,
+        }
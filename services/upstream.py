@@ -0,0 +1,201 @@
+import time
+import logging
+from collections import deque
+
+import httpx
+
+logger = logging.getLogger("upstream")
+
+# HTTP/2 يتطلب حزمة h2 (httpx[http2]) — بدونها نرجع لـ HTTP/1.1 بصمت
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# ============================================================================
+# PER-HOST SETTINGS — إعدادات كل مزود خارجي
+# ============================================================================
+#  timeout هنا افتراضي فقط؛ كل استدعاء يمرر مهلته الخاصة كما كان سابقاً.
+
+UPSTREAM_SETTINGS = {
+    # integrate.api.nvidia.com — كل طلبات المحادثة والـ embeddings
+    "nvidia": {
+        "http2":            True,
+        "max_connections":  200,
+        "max_keepalive":    64,
+        "keepalive_expiry": 120.0,
+        "timeout":          httpx.Timeout(60.0, connect=10.0, pool=10.0),
+    },
+    # ai.api.nvidia.com — OCR و نماذج الرؤية
+    "nvidia_ai": {
+        "http2":            True,
+        "max_connections":  20,
+        "max_keepalive":    8,
+        "keepalive_expiry": 60.0,
+        "timeout":          httpx.Timeout(40.0, connect=10.0, pool=10.0),
+    },
+    # HuggingFace Space (qwen-mini) — خادم واحد صغير، اتصالات قليلة
+    "hf_space": {
+        "http2":            False,
+        "max_connections":  16,
+        "max_keepalive":    8,
+        "keepalive_expiry": 60.0,
+        "timeout":          httpx.Timeout(90.0, connect=15.0, pool=10.0),
+    },
+    # api.telegram.org — إشعارات وتخزين الجلسات
+    "telegram": {
+        "http2":            True,
+        "max_connections":  20,
+        "max_keepalive":    10,
+        "keepalive_expiry": 60.0,
+        "timeout":          httpx.Timeout(20.0, connect=10.0, pool=10.0),
+    },
+}
+
+# ============================================================================
+# TTFB TRACKING — زمن أول بايت لكل مزود (يُقاس عبر event hooks)
+# ============================================================================
+
+_TTFB_WINDOW = 512
+_ttfb_samples: dict = {name: deque(maxlen=_TTFB_WINDOW) for name in UPSTREAM_SETTINGS}
+_http_versions: dict = {name: {} for name in UPSTREAM_SETTINGS}
+_TTFB_EXT_KEY = "orgteh_ttfb_start"
+
+
+def register_upstream(name: str, **overrides):
+    """
+    مزود إضافي يُعرَّف وقت التشغيل (endpoints خارجية لنموذج — services/endpoint_router.py).
+    نفس إعدادات nvidia ما لم تُستبدل؛ يحصل على عميله المشترك ومقاييس TTFB الخاصة به.
+    """
+    if name in UPSTREAM_SETTINGS:
+        return
+    UPSTREAM_SETTINGS[name] = {**UPSTREAM_SETTINGS["nvidia"], "max_connections": 100,
+                               "max_keepalive": 32, **overrides}
+    _ttfb_samples[name]  = deque(maxlen=_TTFB_WINDOW)
+    _http_versions[name] = {}
+
+
+def _make_hooks(name: str) -> dict:
+    async def _on_request(request: httpx.Request):
+        request.extensions[_TTFB_EXT_KEY] = time.perf_counter()
+
+    async def _on_response(response: httpx.Response):
+        t0 = response.request.extensions.get(_TTFB_EXT_KEY)
+        if t0 is not None:
+            _ttfb_samples[name].append((time.perf_counter() - t0) * 1000)
+        versions = _http_versions[name]
+        versions[response.http_version] = versions.get(response.http_version, 0) + 1
+
+    return {"request": [_on_request], "response": [_on_response]}
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def get_upstream_stats() -> dict:
+    """ملخص TTFB ونسخ HTTP لكل مزود — للوحة الأدمن."""
+    stats = {}
+    for name in UPSTREAM_SETTINGS:
+        values = sorted(_ttfb_samples[name])
+        stats[name] = {
+            "open":          name in _clients,
+            "http2_enabled": UPSTREAM_SETTINGS[name]["http2"] and HTTP2_AVAILABLE,
+            "samples":       len(values),
+            "ttfb_p50_ms":   round(_percentile(values, 50), 1),
+            "ttfb_p95_ms":   round(_percentile(values, 95), 1),
+            "ttfb_p99_ms":   round(_percentile(values, 99), 1),
+            "http_versions": dict(_http_versions[name]),
+        }
+    return stats
+
+# ============================================================================
+# CLIENT REGISTRY — عميل واحد مشترك لكل مزود طوال عمر التطبيق
+# ============================================================================
+
+_clients: dict = {}
+
+
+def _build_client(name: str) -> httpx.AsyncClient:
+    cfg = UPSTREAM_SETTINGS[name]
+    return httpx.AsyncClient(
+        http2=cfg["http2"] and HTTP2_AVAILABLE,
+        timeout=cfg["timeout"],
+        limits=httpx.Limits(
+            max_connections=cfg["max_connections"],
+            max_keepalive_connections=cfg["max_keepalive"],
+            keepalive_expiry=cfg["keepalive_expiry"],
+        ),
+        event_hooks=_make_hooks(name),
+    )
+
+
+def get_upstream_client(name: str) -> httpx.AsyncClient:
+    """
+    يُعيد العميل المشترك للمزود المطلوب.
+    يُنشأ عند بدء التطبيق، أو عند أول استخدام إذا استُدعي خارج الـ app
+    (سكربتات، اختبارات). لا تُغلقه أبداً من الكود المستدعي.
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _build_client(name)
+        _clients[name] = client
+    return client
+
+
+class _ScopedClient:
+    """غلاف رفيع حول العميل المشترك يطبق مهلة افتراضية ولا يُغلق عند الخروج."""
+
+    def __init__(self, client: httpx.AsyncClient, timeout=None):
+        self._client = client
+        self._timeout = timeout
+
+    def _with_timeout(self, kwargs: dict) -> dict:
+        if self._timeout is not None:
+            kwargs.setdefault("timeout", self._timeout)
+        return kwargs
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self._client.post(url, **self._with_timeout(kwargs))
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self._client.get(url, **self._with_timeout(kwargs))
+
+    def stream(self, method: str, url: str, **kwargs):
+        return self._client.stream(method, url, **self._with_timeout(kwargs))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+def upstream_client(name: str, timeout=None) -> _ScopedClient:
+    """
+    بديل مباشر لـ `async with httpx.AsyncClient(timeout=...) as client:`
+    يستخدم العميل المشترك ويطبق المهلة على كل طلب، والاتصالات تبقى
+    في الـ pool للطلب التالي بدل TLS handshake جديد.
+    """
+    return _ScopedClient(get_upstream_client(name), timeout)
+
+
+async def startup_upstream_clients():
+    """تُستدعى من main.py عند بدء التشغيل — تفتح كل العملاء مسبقاً."""
+    for name in UPSTREAM_SETTINGS:
+        get_upstream_client(name)
+    logger.info(f"Upstream clients ready: {list(_clients)} (http2={'on' if HTTP2_AVAILABLE else 'off'})")
+
+
+async def shutdown_upstream_clients():
+    """تُستدعى من main.py عند الإيقاف — تغلق كل الاتصالات المفتوحة."""
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Upstream client {name} close error: {e}")
+    _clients.clear()
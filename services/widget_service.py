@@ -616,7 +616,10 @@ async def widget_chat_stream(widget_id: str, message: str, history: list,
       Queue → Token Bucket
       L3 → Branding SSE event (أول شيء يُرسَل)
     """
-    import httpx
+    from services.upstream import upstream_client
+    from services.semantic_cache import semantic_cache, tenant_namespace
+    from services.sse import aiter_sse
+    from services.coalescing import coalescer, coalesce_key
 
     # ── L5: حظر IP ──────────────────────────────────────────────────────
     if _is_ip_blocked(client_ip):
@@ -669,43 +672,69 @@ async def widget_chat_stream(widget_id: str, message: str, history: list,
             messages.append({"role": h["role"], "content": h["content"]})
     messages.append({"role": "user", "content": message})
 
+    # ── كاش دلالي (أول سؤال فقط — مع سجل محادثة الرد يعتمد على السياق) ──
+    cache_ns, query_vec = None, None
+    if len(messages) == 2:
+        cache_ns = tenant_namespace("widget", widget_id, system_prompt)
+        cached, query_vec = await semantic_cache.lookup("widget", cache_ns, message)
+        if cached is not None:
+            chunk = {"choices": [{"index": 0, "delta": {"content": cached}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+            yield b"data: [DONE]\n\n"
+            return
+
     nvidia_key = os.environ.get("NVIDIA_API_KEY", "")
     if not nvidia_key:
         yield b'data: {"error":"NVIDIA API key not configured"}\n\n'
         return
 
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            async with client.stream(
-                "POST",
-                "https://integrate.api.nvidia.com/v1/chat/completions",
-                json={
-                    "model":       "meta/llama-3.1-8b-instruct",
-                    "messages":    messages,
-                    "temperature": 0.3,
-                    "top_p":       0.7,
-                    "max_tokens":  4096,
-                    "stream":      True,
-                },
-                headers={
-                    "Authorization": f"Bearer {nvidia_key}",
-                    "Content-Type":  "application/json",
-                    "Accept":        "text/event-stream",
-                },
-            ) as resp:
-                if resp.status_code != 200:
-                    yield json.dumps({"error": f"upstream_{resp.status_code}"}).encode()
-                    return
-                async for line in resp.aiter_lines():
-                    if not line.startswith("data: "):
-                        continue
-                    raw = line[6:].strip()
-                    if raw == "[DONE]":
-                        yield b"data: [DONE]\n\n"
-                        break
-                    yield f"data: {raw}\n\n".encode("utf-8")
-    except Exception as e:
-        yield json.dumps({"error": str(e)}).encode("utf-8")
+    payload = {
+        "model":       "meta/llama-3.1-8b-instruct",
+        "messages":    messages,
+        "temperature": 0.3,
+        "top_p":       0.7,
+        "max_tokens":  4096,
+        "stream":      True,
+    }
+
+    async def upstream():
+        try:
+            async with upstream_client("nvidia", timeout=60.0) as client:
+                async with client.stream(
+                    "POST",
+                    "https://integrate.api.nvidia.com/v1/chat/completions",
+                    json=payload,
+                    headers={
+                        "Authorization": f"Bearer {nvidia_key}",
+                        "Content-Type":  "application/json",
+                        "Accept":        "text/event-stream",
+                    },
+                ) as resp:
+                    if resp.status_code != 200:
+                        yield json.dumps({"error": f"upstream_{resp.status_code}"}).encode()
+                        return
+                    answer_parts = []
+                    async for ev in aiter_sse(resp.aiter_bytes()):
+                        if ev.done:
+                            if cache_ns:
+                                semantic_cache.store("widget", cache_ns, query_vec, "".join(answer_parts))
+                            yield b"data: [DONE]\n\n"
+                            break
+                        if cache_ns:
+                            try:
+                                delta = ev.json()["choices"][0]["delta"].get("content")
+                                if delta:
+                                    answer_parts.append(delta)
+                            except (TypeError, KeyError, IndexError):
+                                pass
+                        yield b"data: " + ev.data + b"\n\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}).encode("utf-8")
+
+    # ── دمج الطلبات المتطابقة المتزامنة (إعادة تحميل الصفحة، عدة تبويبات) ──
+    # الاستخدام احتُسب أعلاه لكل طلب (_increment_usage) — الدمج يوفّر NVIDIA فقط
+    async for chunk in coalescer.stream("widget", coalesce_key("widget", widget_id, payload), upstream):
+        yield chunk
 
 
 def _increment_usage(w: dict):
@@ -5,10 +5,11 @@ import gzip
 import time
 import hashlib
 import logging
-import httpx
 from datetime import datetime
 from typing import Optional
 
+from services.upstream import upstream_client
+
 logger = logging.getLogger("telegram_bot")
 
 # ============================================================================
@@ -76,7 +77,7 @@ async def send_telegram_message(text: str) -> bool:
         print("[TelegramBot] ⚠️  TELEGRAM_BOT_TOKEN أو TELEGRAM_OWNER_ID غير مضبوطَين.")
         return False
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
+        async with upstream_client("telegram", timeout=10.0) as client:
             response = await client.post(
                 _api_url("sendMessage"),
                 json={
@@ -196,7 +197,7 @@ async def save_v1_turn(
     turn_count   = 0
     if existing_file_id:
         try:
-            async with httpx.AsyncClient(timeout=15.0) as client:
+            async with upstream_client("telegram", timeout=15.0) as client:
                 r = await client.post(_agent_api_url("getFile"),
                                       json={"file_id": existing_file_id})
                 if r.json().get("ok"):
@@ -231,7 +232,7 @@ async def save_v1_turn(
     )
 
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
+        async with upstream_client("telegram", timeout=20.0) as client:
             if existing_msg_id:
                 try:
                     await client.post(_agent_api_url("deleteMessage"),
@@ -366,7 +367,7 @@ async def save_agent_session(
     file_name = f"ag_{safe_id}.json.gz"
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        async with upstream_client("telegram", timeout=30.0) as client:
             # حذف الرسالة القديمة إن وُجدت
             if existing_msg_id:
                 try:
@@ -412,7 +413,7 @@ async def load_agent_session(file_id: str) -> Optional[dict]:
     if not _agent_configured():
         return None
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
+        async with upstream_client("telegram", timeout=20.0) as client:
             resp = await client.post(_agent_api_url("getFile"), json={"file_id": file_id})
             result = resp.json()
             if not result.get("ok"):
@@ -453,7 +454,7 @@ async def notify_agent_complete(
         f"🕐 {now}"
     )
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
+        async with upstream_client("telegram", timeout=10.0) as client:
             resp = await client.post(
                 _agent_api_url("sendMessage"),
                 json={
@@ -474,7 +475,7 @@ async def check_agent_bot_status() -> dict:
     if not _agent_configured():
         return {"ok": False, "error": "AGENT_TG_BOT_TOKEN not set"}
     try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
+        async with upstream_client("telegram", timeout=8.0) as client:
             resp = await client.post(_agent_api_url("getMe"))
             data = resp.json()
             if data.get("ok"):
@@ -698,7 +699,8 @@ def _build_user_txt(profile: dict) -> str:
     lines.append("└" + "─" * 62 + "┘")
 
     # ── الاستخدام اليومي ──────────────────────────────────────────────────────
-    usage = profile.get("usage", {})
+    from services.metrics_pipeline import metrics_pipeline
+    usage = metrics_pipeline.user_usage(profile)
     MODEL_KEYS = ["deepseek", "kimi", "mistral", "llama", "gemma",
                   "llama-large", "llama-scout", "qwen-coder", "qwen-mini"]
     lines += [
@@ -813,7 +815,7 @@ async def _upload_user_file(
     )
 
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
+        async with upstream_client("telegram", timeout=20.0) as client:
             if existing_msg_id:
                 try:
                     await client.post(
@@ -1059,7 +1061,7 @@ async def get_user_file_content(email: str) -> Optional[str]:
         return None
 
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
+        async with upstream_client("telegram", timeout=20.0) as client:
             r = await client.post(_users_api_url("getFile"), json={"file_id": file_id})
             if not r.json().get("ok"):
                 return None
@@ -1082,7 +1084,7 @@ async def check_users_bot_status() -> dict:
             "hint":  "أنشئ بوتاً جديداً من @BotFather وأضف USERS_TG_BOT_TOKEN في البيئة.",
         }
     try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
+        async with upstream_client("telegram", timeout=8.0) as client:
             data = (await client.post(_users_api_url("getMe"))).json()
             if data.get("ok"):
                 bot = data["result"]
@@ -1129,7 +1131,7 @@ async def schedule_log_v1(
         f"🕐 {now}"
     )
     try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
+        async with upstream_client("telegram", timeout=8.0) as client:
             await client.post(
                 _agent_api_url("sendMessage"),
                 json={
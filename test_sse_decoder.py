@@ -0,0 +1,174 @@
+import re
+import sys
+import json
+import random
+
+from services.sse import SSEDecoder
+
+# ============================================================================
+# SSE DECODER — مقارنة services/sse.py بمحلل مرجعي مستقل
+# ============================================================================
+#  المولّد يبني أحداثاً عشوائية ويعرف ناتجها المتوقع، والمحلل المرجعي يطبق
+#  المواصفة سطراً بسطر على نص مفكوك (بدون أي كود مشترك مع SSEDecoder).
+#  SSEDecoder يجب أن يطابق الاثنين على البث كاملاً وعلى أي تقطيع عشوائي له —
+#  مقارنة الـ decoder بنفسه فقط لا تكشف خطأ يتكرر بنفس الشكل في كل مرة.
+#
+#  التشغيل:  python -m pytest -q test_sse_decoder.py   أو   python test_sse_decoder.py
+
+SEED   = 1337
+TRIALS = 300
+
+_LINE_END_RE = re.compile(r"\r\n|\r|\n")
+
+
+def reference_parse(body: bytes) -> list:
+    """
+    محلل المواصفة (HTML Living Standard — event stream interpretation) حرفياً:
+    [(event, id, data)] حيث event = None للنوع الافتراضي "message".
+    مثل SSEDecoder: حدث بلا سطر فارغ في نهاية البث يُرسل (المواصفة تهمله).
+    """
+    text = body.decode("utf-8")
+    lines = _LINE_END_RE.split(text)
+    complete, tail = lines[:-1], lines[-1]
+    if tail:
+        complete.append(tail)
+
+    events = []
+    data_buffer, event_type, last_id = "", "", None
+    for line in complete:
+        if line == "":
+            if data_buffer:
+                events.append((event_type or None, last_id, data_buffer[:-1]))
+            data_buffer, event_type = "", ""
+            continue
+        if line.startswith(":"):
+            continue
+        if ":" in line:
+            field, value = line.split(":", 1)
+            if value.startswith(" "):
+                value = value[1:]
+        else:
+            field, value = line, ""
+        if field == "data":
+            data_buffer += value + "\n"
+        elif field == "event":
+            event_type = value
+        elif field == "id":
+            last_id = value
+        # retry وأي حقل آخر يُتجاهل
+    if data_buffer:
+        events.append((event_type or None, last_id, data_buffer[:-1]))
+    return [(ev, id_, data.encode("utf-8")) for ev, id_, data in events]
+
+
+def generate_stream(rng: random.Random, n_events: int) -> tuple:
+    """(body، الأحداث المتوقعة) — نهايات أسطر مختلطة، تعليقات، أحداث متعددة الأسطر، [DONE]."""
+    parts, expected = [], []
+    last_id = None
+    for i in range(n_events):
+        nl = rng.choice(("\n", "\r\n", "\r"))
+        event_type = None
+        if rng.random() < 0.15:
+            parts.append(": keepalive" + nl)
+        if rng.random() < 0.05:
+            parts.append("retry: 3000" + nl)
+        if rng.random() < 0.2:
+            event_type = rng.choice(("delta", "ping"))
+            parts.append(f"event: {event_type}" + nl)
+        if rng.random() < 0.1:
+            last_id = str(i)
+            parts.append(f"id: {last_id}" + nl)
+
+        values = []
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):
+            obj = {"i": i, "t": rng.choice(("hello ", "مرحبا ", "日本語 ", "emoji 🚀 ", " leading", ""))}
+            values.append(json.dumps(obj, ensure_ascii=False))
+        if rng.random() < 0.05:
+            values.append("")                      # سطر "data" بلا قيمة → سطر فارغ داخل البيانات
+        if rng.random() < 0.05:
+            values.append(rng.choice((" indented", "  two spaces", "a: b")))   # تُحذف مسافة واحدة فقط
+        for value in values:
+            if value == "":
+                parts.append("data" + nl)
+            elif rng.random() < 0.3 and not value.startswith(" "):
+                parts.append("data:" + value + nl)          # بدون مسافة بعد النقطتين
+            else:
+                parts.append("data: " + value + nl)
+            if rng.random() < 0.05:
+                parts.append(":comment between data lines" + nl)
+        parts.append(nl)
+        expected.append((event_type, last_id, "\n".join(values).encode("utf-8")))
+
+    nl = rng.choice(("\n", "\r\n", "\r"))
+    parts.append("data: [DONE]" + nl + nl)
+    expected.append((None, last_id, b"[DONE]"))
+    return "".join(parts).encode("utf-8"), expected
+
+
+def decode(body: bytes, sizes=None) -> list:
+    decoder = SSEDecoder()
+    events, pos = [], 0
+    for size in sizes or [len(body)]:
+        if pos >= len(body):
+            break
+        events += decoder.feed(body[pos:pos + size])
+        pos += size
+    if pos < len(body):
+        events += decoder.feed(body[pos:])
+    events += decoder.flush()
+    return [(e.event, e.id, e.data) for e in events]
+
+
+# ============================================================================
+# TESTS
+# ============================================================================
+
+def test_reference_parser_agrees_with_generator():
+    rng = random.Random(SEED)
+    for _ in range(TRIALS):
+        body, expected = generate_stream(rng, rng.randint(1, 60))
+        assert reference_parse(body) == expected
+
+
+def test_whole_buffer_matches_reference():
+    rng = random.Random(SEED + 1)
+    for _ in range(TRIALS):
+        body, expected = generate_stream(rng, rng.randint(1, 60))
+        assert decode(body) == expected
+
+
+def test_random_chunking_matches_reference():
+    rng = random.Random(SEED + 2)
+    for _ in range(TRIALS):
+        body, expected = generate_stream(rng, rng.randint(1, 60))
+        max_split = rng.choice((1, 2, 3, 16, 256))
+        sizes = [rng.randint(1, max_split) for _ in range(len(body))]
+        assert decode(body, sizes) == expected, f"max split {max_split}"
+
+
+def test_crlf_split_between_chunks():
+    body = b"data: a\r\ndata: b\r\n\r\ndata: c\r\r"
+    for cut in range(1, len(body)):
+        assert decode(body, [cut]) == reference_parse(body) == [
+            (None, None, b"a\nb"), (None, None, b"c"),
+        ], f"cut at {cut}"
+
+
+def test_done_and_trailing_event_without_blank_line():
+    events = SSEDecoder().feed(b"data: x\n\ndata: [DONE]\n\n")
+    assert [e.done for e in events] == [False, True]
+    body = b"event: delta\ndata: tail"
+    assert decode(body) == reference_parse(body) == [("delta", None, b"tail")]
+
+
+if __name__ == "__main__":
+    failed = 0
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            try:
+                fn()
+                print(f"PASS {name}")
+            except AssertionError as e:
+                failed += 1
+                print(f"FAIL {name}: {e}")
+    sys.exit(1 if failed else 0)
@@ -1,9 +1,10 @@
 # tools/nvidia_engine.py
 import os
-import httpx
 import base64
 from fastapi import UploadFile
 
+from services.upstream import upstream_client
+
 NVIDIA_API_KEY = os.environ.get("NVIDIA_API_KEY")
 NVIDIA_BASE_URL = "https://integrate.api.nvidia.com/v1"
 
@@ -16,7 +17,7 @@ async def execute_ocr(file_input: UploadFile):
         payload = {"input": [{"type": "image_url", "url": f"data:image/png;base64,{image_b64}"}]}
         headers = {"Authorization": f"Bearer {NVIDIA_API_KEY}", "Accept": "application/json"}
 
-        async with httpx.AsyncClient() as client:
+        async with upstream_client("nvidia_ai") as client:
             resp = await client.post(invoke_url, json=payload, headers=headers, timeout=40.0)
             return resp.json()
     except Exception as e:
@@ -24,21 +25,12 @@ async def execute_ocr(file_input: UploadFile):
 
 async def execute_embedding(text_input: str, truncate: str):
     if not text_input: return {"error": "Text required"}
+    # عبر مُجمِّع /v1/embeddings — استدعاءات الأداة المتزامنة تُرسل في طلب upstream واحد
+    from services.embeddings import embedding_batcher
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"{NVIDIA_BASE_URL}/embeddings",
-                headers={"Authorization": f"Bearer {NVIDIA_API_KEY}"},
-                json={
-                    "input": [text_input],
-                    "model": "nvidia/llama-3.2-nemoretriever-300m-embed-v2",
-                    "encoding_format": "float",
-                    "extra_body": {"input_type": "query", "truncate": truncate}
-                }, timeout=10.0
-            )
-            data = resp.json()
-            if "data" not in data: return {"error": "API Error", "details": data}
-            vector = data["data"][0]["embedding"]
-            return {"object": "embedding", "vector_preview": vector[:5], "dims": len(vector)}
+        truncate = truncate if truncate in ("NONE", "START", "END") else "END"
+        vector = (await embedding_batcher.embed([text_input], truncate=truncate))[0]
+        return {"object": "embedding", "vector": vector, "vector_preview": vector[:5],
+                "dims": len(vector), "dimensions": len(vector)}
     except Exception as e:
         return {"error": str(e)}
\ No newline at end of file